@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""管理コマンド
+
+使い方:
+    python3 admin.py rebuild-stats                 統計サマリーを全件集計から作り直す
+    python3 admin.py export-parquet <ディレクトリ>   Parquetスナップショットを出力
+    python3 admin.py import-parquet <ディレクトリ>   Parquetスナップショットをインポート
+    python3 admin.py forget-invalid-tickers [銘柄]   存在しない・上場廃止として記憶した銘柄を消す
+    python3 admin.py load-fx-rates <ファイル>        為替レートを読み込み、全件をUSD換算し直す
+    python3 admin.py renormalize-usd                現在の為替レートで全件をUSD換算し直す
+"""
+import sys
+import json
+import argparse
+
+from db_backend import get_database
+
+
+def rebuild_stats(args):
+    """統計サマリーを再構築"""
+    db = get_database()
+    stats = db.rebuild_stats_summary()
+    print(f"✅ 統計サマリーを再構築しました: {json.dumps(stats, ensure_ascii=False, default=str)}")
+
+
+def export_parquet(args):
+    """Parquetスナップショットを出力"""
+    import columnar_export
+    result = columnar_export.export_parquet(get_database(), args.directory, batch_size=args.batch_size)
+    print(f"✅ {result['stock_count']}銘柄 / 年次データ{result['annual_data_count']}件を出力しました: {args.directory}")
+
+
+def import_parquet(args):
+    """Parquetスナップショットをインポート"""
+    import columnar_export
+    result = columnar_export.import_parquet(get_database(), args.directory, clear_existing=args.clear)
+    print(
+        f"✅ インポート完了: 新規{result['imported_count']}件 / 更新{result['updated_count']}件 / "
+        f"変更なし{result['skipped_count']}件（年次データ: 追加{result['annual_inserted_count']}件 / "
+        f"更新{result['annual_updated_count']}件 / 変更なし{result['annual_skipped_count']}件 / "
+        f"削除{result['annual_deleted_count']}件）"
+    )
+
+
+def forget_invalid_tickers(args):
+    """存在しない・上場廃止として記憶した銘柄を消す"""
+    from stock_analysis import StockAnalyzer
+    ticker = args.ticker.upper() if args.ticker else None
+    count = StockAnalyzer().forget_invalid_tickers(ticker)
+    print(f"✅ {count}件の記憶を消しました" + (f": {ticker}" if ticker else ''))
+
+
+def print_usd_result(result):
+    print(f"✅ {result['normalized_stock_count']}銘柄をUSD換算しました")
+    if result['missing_currencies']:
+        print(f"⚠️ レート未登録の通貨（USD換算はNULL）: {', '.join(str(c) for c in result['missing_currencies'])}")
+
+
+def load_fx_rates(args):
+    """為替レートをファイルから読み込み、全件をUSD換算し直す"""
+    import fx_rates
+    result = get_database().set_fx_rates(fx_rates.load_rates_file(args.file), replace=args.replace)
+    print(f"✅ 為替レート{result['rate_count']}件を登録しました")
+    print_usd_result(result)
+
+
+def renormalize_usd(args):
+    """現在の為替レートで全件をUSD換算し直す"""
+    print_usd_result(get_database().renormalize_usd())
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='株主還元率分析ツールの管理コマンド')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('rebuild-stats', help='統計サマリーを全件集計から作り直す').set_defaults(func=rebuild_stats)
+
+    export_parser = subparsers.add_parser('export-parquet', help='Parquetスナップショットを出力')
+    export_parser.add_argument('directory', help='出力ディレクトリ')
+    export_parser.add_argument('--batch-size', type=int, default=5000, help='1つのrow groupに含める銘柄数')
+    export_parser.set_defaults(func=export_parquet)
+
+    import_parser = subparsers.add_parser('import-parquet', help='Parquetスナップショットをインポート')
+    import_parser.add_argument('directory', help='stocks.parquet と annual_data.parquet のあるディレクトリ')
+    import_parser.add_argument('--clear', action='store_true', help='既存データを削除してからインポート')
+    import_parser.set_defaults(func=import_parquet)
+
+    forget_parser = subparsers.add_parser('forget-invalid-tickers', help='存在しない・上場廃止として記憶した銘柄を消す')
+    forget_parser.add_argument('ticker', nargs='?', help='消す銘柄（省略時は全て）')
+    forget_parser.set_defaults(func=forget_invalid_tickers)
+
+    fx_parser = subparsers.add_parser('load-fx-rates', help='為替レートを読み込み、全件をUSD換算し直す')
+    fx_parser.add_argument('file', help='CSV（currency,usd_rate）またはJSON（{"JPY": 0.0067}）のファイル')
+    fx_parser.add_argument('--replace', action='store_true', help='ファイルにない通貨のレートを削除する')
+    fx_parser.set_defaults(func=load_fx_rates)
+
+    subparsers.add_parser('renormalize-usd', help='現在の為替レートで全件をUSD換算し直す').set_defaults(func=renormalize_usd)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        args.func(args)
+    except Exception as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""国・セクター・年度ごとの利回り集計
+
+集計はデータベース側のGROUP BYで行い、結果はデータベースの識別子ごとに、データバージョン（書き込みのたびに増える）が
+変わるまで共有キャッシュ（cache_backend）に保存する。PostgreSQLでは percentile_cont で分位点まで SQL で求め、
+SQLiteでは件数・平均をSQLで求めた上で、グループ・値の順に並んだ行を1グループずつ読んで分位点を計算する。
+
+国別・セクター別は各銘柄の最新年度の行を、年度別は全ての年次データを対象にする。
+"""
+from itertools import groupby
+
+# 集計対象の指標
+AGGREGATE_METRICS = [
+    'dividend_yield', 'buyback_yield', 'capex_yield',
+    'total_return_without_capex', 'total_return_with_capex'
+]
+
+# 集計の単位と、グループのキーになるカラム
+GROUP_COLUMNS = {
+    'country': 's.country',
+    'sector': 's.sector',
+    'year': 'a.year'
+}
+
+QUANTILE_LEVELS = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+
+def _source_sql(by):
+    """集計対象の行（国別・セクター別は銘柄ごとの最新年度のみ）"""
+    sql = 'FROM annual_data a JOIN stocks s ON s.id = a.stock_id'
+    if by != 'year':
+        sql += ' WHERE a.year = (SELECT MAX(year) FROM annual_data WHERE stock_id = a.stock_id)'
+    return sql
+
+
+def summary_sql(by):
+    """グループごとの件数・平均を求めるSQL"""
+    key = GROUP_COLUMNS[by]
+    columns = ', '.join(f'COUNT(a.{name}), AVG(a.{name})' for name in AGGREGATE_METRICS)
+    return f'SELECT {key}, COUNT(*), {columns} {_source_sql(by)} GROUP BY {key} ORDER BY {key}'
+
+
+def values_sql(by, metric):
+    """グループ・値の順に並んだ指標値を返すSQL（SQLiteでの分位点計算用）"""
+    key = GROUP_COLUMNS[by]
+    source = _source_sql(by)
+    condition = ' AND ' if 'WHERE' in source else ' WHERE '
+    return f'SELECT {key}, a.{metric} {source}{condition}a.{metric} IS NOT NULL ORDER BY {key}, a.{metric}'
+
+
+def postgres_sql(by):
+    """件数・平均・分位点を1回で求めるSQL（PostgreSQL用）"""
+    key = GROUP_COLUMNS[by]
+    levels = ', '.join(str(level) for level in QUANTILE_LEVELS)
+    columns = ', '.join(
+        f'COUNT(a.{name}), AVG(a.{name}), '
+        f'percentile_cont(ARRAY[{levels}]) WITHIN GROUP (ORDER BY a.{name})'
+        for name in AGGREGATE_METRICS
+    )
+    return f'SELECT {key}, COUNT(*), {columns} {_source_sql(by)} GROUP BY {key} ORDER BY {key}'
+
+
+def _quantile_dict(values):
+    if values is None:
+        values = [None] * len(QUANTILE_LEVELS)
+    return {f'p{int(round(level * 100))}': None if value is None else float(value)
+            for level, value in zip(QUANTILE_LEVELS, values)}
+
+
+def _metric_entry(count, mean, quantile_values):
+    quantiles = _quantile_dict(quantile_values if count else None)
+    return {
+        'count': count,
+        'mean': float(mean) if count and mean is not None else None,
+        'median': quantiles['p50'],
+        'quantiles': quantiles
+    }
+
+
+def sorted_quantiles(values):
+    """昇順の値リストから分位点を線形補間で求める"""
+    count = len(values)
+    result = []
+    for level in QUANTILE_LEVELS:
+        position = level * (count - 1)
+        lower = int(position)
+        upper = min(lower + 1, count - 1)
+        result.append(values[lower] + (values[upper] - values[lower]) * (position - lower))
+    return result
+
+
+def rows_from_postgres(rows):
+    """postgres_sqlの結果を整形"""
+    groups = []
+    for row in rows:
+        entry = {'key': row[0], 'row_count': row[1], 'metrics': {}}
+        for i, name in enumerate(AGGREGATE_METRICS):
+            count, mean, quantile_values = row[2 + i * 3: 5 + i * 3]
+            entry['metrics'][name] = _metric_entry(count, mean, quantile_values)
+        groups.append(entry)
+    return groups
+
+
+def rows_from_summary(summary_rows, iter_values):
+    """summary_sqlの結果と、指標ごとの並んだ値（iter_values(metric)）から整形"""
+    groups = []
+    by_key = {}
+    for row in summary_rows:
+        entry = {'key': row[0], 'row_count': row[1], 'metrics': {}}
+        for i, name in enumerate(AGGREGATE_METRICS):
+            count, mean = row[2 + i * 2: 4 + i * 2]
+            entry['metrics'][name] = _metric_entry(count, mean, None)
+        groups.append(entry)
+        by_key[row[0]] = entry
+
+    for name in AGGREGATE_METRICS:
+        # 1グループ分の値だけをメモリに載せて分位点を求める
+        for key, items in groupby(iter_values(name), key=lambda item: item[0]):
+            values = [value for _, value in items]
+            quantiles = _quantile_dict(sorted_quantiles(values))
+            metric = by_key[key]['metrics'][name]
+            metric['quantiles'] = quantiles
+            metric['median'] = quantiles['p50']
+    return groups
+
+
+def get_aggregates(db, by):
+    """集計結果を取得（データバージョンが変わるまでキャッシュ）"""
+    if by not in GROUP_COLUMNS:
+        raise ValueError(f"未対応の集計単位です: {by}（指定可能: {', '.join(GROUP_COLUMNS)}）")
+
+    import cache_backend
+
+    version = db.get_data_version()
+    return cache_backend.get_cache().get_or_set(
+        f'aggregates:{db.cache_namespace()}:{version}:{by}',
+        lambda: {
+            'by': by,
+            'data_version': version,
+            'metrics': AGGREGATE_METRICS,
+            'groups': db.compute_aggregates(by)
+        },
+        ttl=cache_backend.DATABASE_TTL, metric='aggregates'
+    )
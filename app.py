@@ -1,16 +1,106 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, jsonify, render_template, g, Response
 from flask_cors import CORS
 import sys
 import os
+import time
+import threading
 
-# 既存のStockAnalyzerクラスをインポート
+# 同じディレクトリのモジュールを読み込めるようにする
+# yfinance・pandas・SQLAlchemyは重いため、必要なエンドポイントで初めて読み込む
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from stock_analysis import StockAnalyzer
-from database_postgres import PostgreSQLDatabase as StockDatabase
+import metrics
+import db_backend
 
 app = Flask(__name__)
 CORS(app)
 
+def get_database():
+    """データベースインスタンスを取得（DATABASE_BACKENDで実装を選択）"""
+    from db_backend import get_database as get_configured_database
+    return get_configured_database()
+
+def get_analyzer():
+    """分析エンジンを取得"""
+    from stock_analysis import StockAnalyzer
+    return StockAnalyzer()
+
+def get_snapshot_manager():
+    """全銘柄スナップショットの管理オブジェクトを取得"""
+    import universe_snapshot
+    return universe_snapshot.get_manager()
+
+def notify_data_changed():
+    """データ更新を通知し、スナップショットと検索索引の再生成を促す"""
+    try:
+        import search_index
+        search_index.get_manager().invalidate()
+        get_snapshot_manager().notify_write()
+    except Exception as e:
+        print(f"⚠️ データ更新通知エラー: {e}")
+
+def cached_database_read(db, name, compute):
+    """データベースの読み取り結果を共有キャッシュから取得
+    
+    キーにデータベースの識別子とデータバージョンを含めるので、別のデータベースの結果は返さず、書き込み後は読み直す。
+    """
+    import cache_backend
+    cache_key = f'database:{db.cache_namespace()}:{db.get_data_version()}:{name}'
+    return cache_backend.get_cache().get_or_set(
+        cache_key, compute, ttl=cache_backend.DATABASE_TTL, metric='database'
+    )
+
+def get_percentile_report(stock_data):
+    """保存済みデータから全銘柄中の順位・分布を取得（スナップショット未作成ならNone）"""
+    try:
+        import universe_snapshot
+        view = get_current_snapshot()
+        if view is None or not stock_data:
+            return None
+        return universe_snapshot.percentile_report(view, stock_data)
+    except Exception as e:
+        print(f"⚠️ パーセンタイル計算エラー: {e}")
+        return None
+
+def warm_up():
+    """起動時にスキーマ確認と重いモジュールの読み込みをバックグラウンドで済ませる"""
+    try:
+        get_database()
+        import stock_analysis  # noqa: F401
+        get_snapshot_manager()
+    except Exception as e:
+        print(f"⚠️ ウォームアップエラー: {e}")
+
+_warm_up_started = False
+
+def start_warm_up():
+    """ウォームアップをバックグラウンドで開始（サーバーの起動時に一度だけ呼ぶ。WARMUP_ON_BOOT=false なら何もしない）
+    
+    インポートしただけ（テストやスクリプト）ではデータベースに接続しないよう、
+    python3 app.py・wsgi.py・asgi_app.py の起動処理から呼ぶ。
+    """
+    global _warm_up_started
+    if _warm_up_started or os.environ.get('WARMUP_ON_BOOT', 'true').lower() != 'true':
+        return
+    _warm_up_started = True
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # 同じリクエスト内で書き込んだ後の読み取りはプライマリで行う
+    db_backend.begin_request()
+
+@app.after_request
+def record_request_metrics(response):
+    """ルート単位のリクエスト数とレイテンシを記録"""
+    start = g.get('request_start')
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_requests.inc(method=request.method, route=route, status=response.status_code)
+        metrics.http_request_duration.observe(time.perf_counter() - start, method=request.method, route=route)
+        metrics.registry.maybe_flush()
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -25,11 +115,69 @@ def health_check():
         'message': 'Stock analysis app is running'
     })
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus形式のメトリクスを出力"""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/test')
 def test_route():
     """デプロイテスト用エンドポイント"""
     return "Deploy test successful"
 
+def parse_sections(value):
+    """分析するセクションの指定（カンマ区切りの文字列または配列）を解釈（未指定ならNone）"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list):
+        raise ValueError('sections はカンマ区切りの文字列か配列で指定してください')
+    sections = [str(section).strip().lower() for section in value if str(section).strip()]
+    return sections or None
+
+# 一括分析で1回に受け付ける銘柄数と、同時に分析する銘柄数
+MAX_BATCH_TICKERS = int(os.environ.get('MAX_BATCH_TICKERS', '50'))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '8'))
+
+# 一括分析で財務諸表の抽出・計算に使うプロセス数（0ならリクエストを処理するスレッドで計算する）
+BATCH_PROCESSES = int(os.environ.get('BATCH_PROCESSES', '0'))
+
+def parse_tickers(value):
+    """一括分析の銘柄指定（配列またはカンマ区切り）を重複を除いて解釈"""
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list):
+        raise ValueError('tickers は配列かカンマ区切りの文字列で指定してください')
+    tickers = []
+    for ticker in value:
+        ticker = str(ticker).upper().strip()
+        if ticker and ticker not in tickers:
+            tickers.append(ticker)
+    if not tickers:
+        raise ValueError('ティッカーコードが必要です')
+    if len(tickers) > MAX_BATCH_TICKERS:
+        raise ValueError(f'一度に分析できるのは{MAX_BATCH_TICKERS}銘柄までです')
+    return tickers
+
+def analysis_error(e):
+    """分析の例外を応答用の辞書にする（無効な銘柄なら種類と、記憶済みだったかを付ける）"""
+    from stock_analysis import InvalidTicker, AnalysisTimeout
+    if isinstance(e, InvalidTicker):
+        return {'error': str(e), 'error_class': e.error_class, 'cached': e.cached}
+    if isinstance(e, AnalysisTimeout):
+        return {'error': str(e)}
+    return {'error': f'エラーが発生しました: {str(e)}'}
+
+def complete_analysis(analyzer, ticker, result, planned):
+    """分析結果に計算したセクションと、全セクションを分析した場合は順位を付ける"""
+    result['sections'] = list(planned)
+    if planned == analyzer.WEB_SECTIONS:
+        # 全セクションを分析した場合のみ保存されるので、そのときだけ順位を付ける
+        notify_data_changed()
+        result['percentiles'] = get_percentile_report(analyzer.db.get_stock_analysis(ticker))
+    return result
+
 @app.route('/api/analyze', methods=['POST'])
 def analyze_stock():
     try:
@@ -39,30 +187,136 @@ def analyze_stock():
         if not ticker:
             return jsonify({'error': 'ティッカーコードが必要です'}), 400
         
-        analyzer = StockAnalyzer()
+        analyzer = get_analyzer()
+        try:
+            sections = parse_sections(data.get('sections', request.args.get('sections')))
+            planned, _ = analyzer.plan_sections(sections)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         # プログレス情報を無効化するために、一時的にprintを無効化
         import io
         import contextlib
         
+        from stock_analysis import AnalysisTimeout, InvalidTicker
+        
         f = io.StringIO()
-        with contextlib.redirect_stdout(f):
-            result = analyzer.analyze_stock_for_web(ticker)
+        try:
+            with contextlib.redirect_stdout(f):
+                result = analyzer.analyze_stock_for_web(ticker, sections)
+        except InvalidTicker as e:
+            return jsonify(analysis_error(e)), 404
+        except AnalysisTimeout as e:
+            return jsonify(analysis_error(e)), 504
         
         if result is None:
             return jsonify({'error': f'{ticker}のデータを取得できませんでした'}), 404
         
-        return jsonify(result)
+        return jsonify(complete_analysis(analyzer, ticker, result, planned))
+        
+    except Exception as e:
+        return jsonify({'error': f'エラーが発生しました: {str(e)}'}), 500
+
+def analyze_batch_item(analyzer, ticker, sections, planned):
+    """一括分析の1銘柄分（返り値: (分析結果, エラーの辞書)）"""
+    try:
+        if BATCH_PROCESSES > 0:
+            result = analyzer.analyze_stock_in_process(ticker, sections, processes=BATCH_PROCESSES)
+        else:
+            result = analyzer.analyze_stock_for_web(ticker, sections)
+        if result is None:
+            return None, {'error': f'{ticker}のデータを取得できませんでした'}
+        return complete_analysis(analyzer, ticker, result, planned), None
+    except Exception as e:
+        return None, analysis_error(e)
+
+def batch_response(tickers, outcomes):
+    """一括分析の応答（入力の順に、成功した結果と失敗した銘柄を分ける）"""
+    results = []
+    errors = []
+    for ticker, (result, error) in zip(tickers, outcomes):
+        if error is None:
+            results.append(result)
+        else:
+            errors.append({'ticker': ticker, **error})
+    return {'results': results, 'errors': errors}
+
+@app.route('/api/analyze/batch', methods=['POST'])
+def analyze_stock_batch():
+    """複数銘柄をまとめて分析（BATCH_CONCURRENCY銘柄ずつ並行）"""
+    try:
+        data = request.get_json() or {}
+        analyzer = get_analyzer()
+        try:
+            tickers = parse_tickers(data.get('tickers', []))
+            sections = parse_sections(data.get('sections', request.args.get('sections')))
+            planned, _ = analyzer.plan_sections(sections)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+        # 保存後の読み取りをプライマリで行えるよう、各スレッドにリクエストのコンテキストを引き継ぐ
+        contexts = [contextvars.copy_context() for _ in tickers]
+        with ThreadPoolExecutor(max_workers=min(len(tickers), BATCH_CONCURRENCY)) as executor:
+            outcomes = list(executor.map(
+                lambda context, ticker: context.run(analyze_batch_item, analyzer, ticker, sections, planned),
+                contexts, tickers
+            ))
+        return jsonify(batch_response(tickers, outcomes))
         
     except Exception as e:
         return jsonify({'error': f'エラーが発生しました: {str(e)}'}), 500
 
+def format_sse(event, data):
+    """Server-Sent Events形式の1イベントに変換"""
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
+
+@app.route('/api/analyze/stream', methods=['GET'])
+def analyze_stock_stream():
+    """分析結果をセクションごとにServer-Sent Eventsで返す"""
+    ticker = request.args.get('ticker', '').upper().strip()
+    if not ticker:
+        return jsonify({'error': 'ティッカーコードが必要です'}), 400
+    
+    analyzer = get_analyzer()
+    try:
+        sections = parse_sections(request.args.get('sections'))
+        planned, _ = analyzer.plan_sections(sections)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    def generate():
+        analysis_result = {}
+        sections_iter = analyzer.iter_analysis_for_web(ticker, sections)
+        try:
+            for section, fields in sections_iter:
+                analysis_result.update(fields)
+                yield format_sse(section, fields)
+            
+            if not analysis_result:
+                yield format_sse('error', {'error': f'{ticker}のデータを取得できませんでした'})
+                return
+            
+            done = complete_analysis(analyzer, ticker, {}, planned)
+            yield format_sse('done', {'sections': done['sections'], 'percentiles': done.get('percentiles')})
+        except Exception as e:
+            yield format_sse('error', analysis_error(e))
+        finally:
+            # クライアントが切断した場合は未開始の財務諸表の取得を取り消す
+            sections_iter.close()
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/database/stocks', methods=['GET'])
 def get_database_stocks():
     """データベースに保存されている全銘柄を取得"""
     try:
-        db = StockDatabase()
-        stocks = db.get_all_stocks()
+        db = get_database()
+        stocks = cached_database_read(db, 'stocks', db.get_all_stocks)
         return jsonify({'stocks': stocks})
     except Exception as e:
         return jsonify({'error': f'データベースエラー: {str(e)}'}), 500
@@ -71,45 +325,141 @@ def get_database_stocks():
 def get_database_stats():
     """データベースの統計情報を取得"""
     try:
-        db = StockDatabase()
+        db = get_database()
         stats = db.get_database_stats()
         return jsonify(stats)
     except Exception as e:
         return jsonify({'error': f'データベースエラー: {str(e)}'}), 500
 
+@app.route('/api/database/aggregates', methods=['GET'])
+def get_database_aggregates():
+    """国・セクター・年度ごとの利回り集計（件数・平均・中央値・分位点）を取得"""
+    try:
+        import aggregates
+        
+        db = get_database()
+        return jsonify(aggregates.get_aggregates(db, request.args.get('by', 'country')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'データベースエラー: {str(e)}'}), 500
+
+@app.route('/api/database/usd-ranking', methods=['GET'])
+def get_database_usd_ranking():
+    """USD換算した金額で通貨をまたいだ上位銘柄を取得（年次データの指標は year 年度、省略時は最新年度）"""
+    try:
+        import fx_rates
+        
+        metric = request.args.get('metric', 'market_cap')
+        year = request.args.get('year')
+        year = int(year) if year else None
+        limit = max(1, min(int(request.args.get('limit', fx_rates.DEFAULT_RANKING_LIMIT)), 1000))
+        
+        db = get_database()
+        return jsonify(cached_database_read(
+            db, f'usd_ranking:{metric}:{year}:{limit}', lambda: db.get_usd_ranking(metric, year, limit)
+        ))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'データベースエラー: {str(e)}'}), 500
+
 @app.route('/api/database/stock/<ticker>', methods=['GET'])
 def get_stock_from_database(ticker):
     """データベースから特定銘柄の分析データを取得"""
     try:
-        db = StockDatabase()
-        stock_data = db.get_stock_analysis(ticker.upper())
+        db = get_database()
+        ticker = ticker.upper()
+        stock_data = cached_database_read(db, f'stock:{ticker}', lambda: db.get_stock_analysis(ticker))
         if stock_data:
+            stock_data['percentiles'] = get_percentile_report(stock_data)
             return jsonify(stock_data)
         else:
             return jsonify({'error': f'{ticker}のデータが見つかりません'}), 404
     except Exception as e:
         return jsonify({'error': f'データベースエラー: {str(e)}'}), 500
 
+@app.route('/api/database/stock/<ticker>/history', methods=['GET'])
+def get_stock_history(ticker):
+    """銘柄の分析値の推移を取得（from以上to未満、日付だけのtoはその日を含む）"""
+    try:
+        import stock_history
+        
+        ticker = ticker.upper()
+        start = stock_history.parse_time(request.args.get('from'))
+        end = stock_history.parse_time(request.args.get('to'), end=True)
+        names = stock_history.parse_metrics(request.args.get('metrics'))
+        limit = max(1, min(int(request.args.get('limit', stock_history.HISTORY_MAX_POINTS)), stock_history.HISTORY_MAX_POINTS))
+        
+        db = get_database()
+        history = cached_database_read(
+            db, f'history:{ticker}:{start}:{end}:{",".join(names)}:{limit}',
+            lambda: db.get_stock_history(ticker, start, end, names, limit)
+        )
+        if not history['points'] and history['previous'] is None:
+            return jsonify({'error': f'{ticker}の履歴が見つかりません'}), 404
+        return jsonify(history)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'データベースエラー: {str(e)}'}), 500
+
 @app.route('/api/database/stock/<ticker>', methods=['DELETE'])
 def delete_stock_from_database(ticker):
     """データベースから特定銘柄を削除"""
     try:
-        db = StockDatabase()
+        db = get_database()
         db.delete_stock(ticker.upper())
+        notify_data_changed()
         return jsonify({'message': f'{ticker}を削除しました'})
     except Exception as e:
         return jsonify({'error': f'データベースエラー: {str(e)}'}), 500
 
+@app.route('/api/invalid-tickers', methods=['DELETE'])
+@app.route('/api/invalid-tickers/<ticker>', methods=['DELETE'])
+def forget_invalid_tickers(ticker=None):
+    """存在しない・上場廃止として記憶している銘柄を消す（ticker省略時は全て）"""
+    try:
+        count = get_analyzer().forget_invalid_tickers(ticker.upper() if ticker else None)
+        return jsonify({'message': f'{count}件の記憶を消しました', 'count': count})
+    except Exception as e:
+        return jsonify({'error': f'エラーが発生しました: {str(e)}'}), 500
+
 @app.route('/api/database/export', methods=['GET'])
 def export_database():
-    """データベース全体をJSONとしてエクスポート"""
+    """データベース全体をJSON（またはformat=parquetでParquetのzip）としてエクスポート
+    
+    since（ISO形式の日時）を指定すると、その後に変更・削除された銘柄だけをJSONで返す（インスタンス間の同期用）。
+    """
     try:
-        db = StockDatabase()
-        export_data = db.export_database()
+        db = get_database()
         
         # ファイル名に現在時刻を含める
         from datetime import datetime
-        filename = f"stock_analysis_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        
+        since = request.args.get('since')
+        if since:
+            try:
+                since = datetime.fromisoformat(since)
+            except ValueError:
+                return jsonify({'error': f'since はISO形式の日時で指定してください: {since}'}), 400
+            if since.tzinfo is not None:
+                # 保存されている日時はサーバーのローカル時刻
+                since = since.astimezone().replace(tzinfo=None)
+        else:
+            since = None
+        
+        if request.args.get('format', 'json').lower() == 'parquet':
+            if since is not None:
+                return jsonify({'error': 'since はJSON形式のエクスポートでのみ指定できます'}), 400
+            return export_database_parquet(db, f"stock_analysis_backup_{timestamp}.zip")
+        
+        export_data = db.export_database(since=since)
+        if since is None:
+            filename = f"stock_analysis_backup_{timestamp}.json"
+        else:
+            filename = f"stock_analysis_changes_{timestamp}.json"
         
         response = jsonify(export_data)
         response.headers['Content-Disposition'] = f'attachment; filename={filename}'
@@ -119,31 +469,284 @@ def export_database():
     except Exception as e:
         return jsonify({'error': f'エクスポートエラー: {str(e)}'}), 500
 
+def export_database_parquet(db, filename):
+    """Parquetスナップショットを一時ファイルに書き出して送信"""
+    import tempfile
+    import columnar_export
+    from flask import send_file
+    
+    fd, zip_path = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    try:
+        columnar_export.export_parquet_archive(db, zip_path)
+        response = send_file(zip_path, mimetype='application/zip', as_attachment=True, download_name=filename)
+    except Exception:
+        os.remove(zip_path)
+        raise
+    
+    # 送信完了後に一時ファイルを削除
+    response.call_on_close(lambda: os.path.exists(zip_path) and os.remove(zip_path))
+    return response
+
+def import_database_parquet(db, clear_existing):
+    """リクエスト本文のParquetスナップショット（zip）をインポート"""
+    import tempfile
+    import columnar_export
+    
+    fd, zip_path = tempfile.mkstemp(suffix='.zip')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(request.get_data())
+        return columnar_export.import_parquet_archive(db, zip_path, clear_existing=clear_existing)
+    finally:
+        os.remove(zip_path)
+
 @app.route('/api/database/import', methods=['POST'])
 def import_database():
-    """JSONファイルからデータベースをインポート"""
+    """JSONファイル（またはformat=parquetでParquetのzip）からデータベースをインポート"""
     try:
-        data = request.get_json()
+        clear_existing = request.args.get('clear', 'false').lower() == 'true'
         
-        if not data:
-            return jsonify({'error': 'JSONデータが必要です'}), 400
+        db = get_database()
         
-        clear_existing = request.args.get('clear', 'false').lower() == 'true'
+        if request.args.get('format', 'json').lower() == 'parquet':
+            result = import_database_parquet(db, clear_existing)
+        else:
+            data = request.get_json()
+            
+            if not data:
+                return jsonify({'error': 'JSONデータが必要です'}), 400
+            
+            result = db.import_database(data, clear_existing=clear_existing)
         
-        db = StockDatabase()
-        result = db.import_database(data, clear_existing=clear_existing)
+        notify_data_changed()
         
         return jsonify({
             'message': 'インポートが完了しました',
-            'imported_count': result['imported_count'],
-            'updated_count': result['updated_count'],
-            'total_processed': result['total_processed']
+            **{key: value for key, value in result.items() if key != 'success'}
         })
         
     except Exception as e:
         return jsonify({'error': f'インポートエラー: {str(e)}'}), 500
 
+@app.route('/api/search', methods=['GET'])
+def search_stocks():
+    """保存済み銘柄をティッカー・会社名で検索（前方一致・あいまい一致）"""
+    try:
+        import search_index
+        
+        query = request.args.get('q', '')
+        limit = int(request.args.get('limit', search_index.DEFAULT_LIMIT))
+        
+        db = get_database()
+        return jsonify(search_index.search(db, query, limit))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'検索エラー: {str(e)}'}), 500
+
+def get_current_snapshot():
+    """現在のスナップショットを取得（未作成なら作成を促してNone）"""
+    manager = get_snapshot_manager()
+    view = manager.current()
+    if view is None:
+        manager.notify_write()
+    return view
+
+def parse_float_arg(name):
+    """クエリパラメータを数値として取得（未指定ならNone）"""
+    value = request.args.get(name)
+    return float(value) if value not in (None, '') else None
+
+@app.route('/api/universe/screen', methods=['GET'])
+def screen_universe():
+    """スナップショットから指標の範囲・国で銘柄を絞り込む"""
+    try:
+        import universe_snapshot
+        
+        view = get_current_snapshot()
+        if view is None:
+            return jsonify({'error': 'スナップショットを作成中です。しばらくしてから再度お試しください'}), 503
+        
+        metric = request.args.get('metric', 'total_return_with_capex')
+        order = request.args.get('order', 'desc')
+        limit = max(1, min(int(request.args.get('limit', 50)), 1000))
+        
+        result = universe_snapshot.screen(
+            view, metric,
+            min_value=parse_float_arg('min'),
+            max_value=parse_float_arg('max'),
+            country=request.args.get('country'),
+            order=order,
+            limit=limit
+        )
+        result['snapshot'] = view.info()
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'スクリーニングエラー: {str(e)}'}), 500
+
+@app.route('/api/universe/rank', methods=['GET'])
+def rank_universe():
+    """スナップショットから指標の上位銘柄（ticker指定時はその順位）を取得"""
+    try:
+        import universe_snapshot
+        
+        view = get_current_snapshot()
+        if view is None:
+            return jsonify({'error': 'スナップショットを作成中です。しばらくしてから再度お試しください'}), 503
+        
+        metric = request.args.get('metric', 'total_return_with_capex')
+        country = request.args.get('country')
+        ticker = request.args.get('ticker', '').upper().strip()
+        
+        if ticker:
+            rank = universe_snapshot.rank_of(view, metric, ticker, country=country)
+            if rank is None:
+                return jsonify({'error': f'{ticker}のデータが見つかりません'}), 404
+            rank['snapshot'] = view.info()
+            return jsonify(rank)
+        
+        limit = max(1, min(int(request.args.get('limit', 20)), 1000))
+        result = universe_snapshot.screen(view, metric, country=country, order='desc', limit=limit)
+        for position, item in enumerate(result['results'], start=1):
+            item['rank'] = position
+        result['snapshot'] = view.info()
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'ランキングエラー: {str(e)}'}), 500
+
+@app.route('/api/universe/stats', methods=['GET'])
+def universe_stats():
+    """スナップショットから指標の統計量を取得"""
+    try:
+        import universe_snapshot
+        
+        view = get_current_snapshot()
+        if view is None:
+            return jsonify({'error': 'スナップショットを作成中です。しばらくしてから再度お試しください'}), 503
+        
+        country = request.args.get('country')
+        metrics = request.args.get('metric')
+        metrics = metrics.split(',') if metrics else view.metrics
+        
+        return jsonify({
+            'metrics': [universe_snapshot.summarize(view, metric, country=country) for metric in metrics],
+            'snapshot': view.info()
+        })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'統計エラー: {str(e)}'}), 500
+
+@app.route('/api/backtest', methods=['POST'])
+def run_backtest():
+    """年度ごとに指標の上位N銘柄を選ぶバックテスト"""
+    try:
+        import backtest
+        
+        data = request.get_json(silent=True) or {}
+        try:
+            start_year = data.get('start_year')
+            end_year = data.get('end_year')
+            options = {
+                'metric': data.get('metric', backtest.DEFAULT_METRIC),
+                'top_n': int(data.get('top_n', backtest.DEFAULT_TOP_N)),
+                'lag': int(data.get('lag', 1)),
+                'order': data.get('order', 'desc'),
+                'country': data.get('country') or None,
+                'start_year': int(start_year) if start_year is not None else None,
+                'end_year': int(end_year) if end_year is not None else None,
+                'include_holdings': bool(data.get('include_holdings', False))
+            }
+        except (TypeError, ValueError):
+            return jsonify({'error': 'top_n・lag・start_year・end_year は整数で指定してください'}), 400
+        
+        return jsonify(backtest.run_backtest(backtest.get_panel(get_database()), **options))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'バックテストエラー: {str(e)}'}), 500
+
+def fetch_portfolio_holding(analyzer, ticker):
+    """保有銘柄を分析する（返り値: (分析結果, エラーの辞書)）"""
+    try:
+        result = analyzer.analyze_stock_for_web(ticker)
+        if result is None:
+            return None, {'error': f'{ticker}のデータを取得できませんでした'}
+        return result, None
+    except Exception as e:
+        return None, analysis_error(e)
+
+@app.route('/api/portfolio', methods=['POST'])
+def analyze_portfolio():
+    """保有銘柄とウェイトから、ポートフォリオ全体の年度ごとの株主還元利回りと銘柄ごとの寄与を求める"""
+    try:
+        import portfolio
+        
+        data = request.get_json(silent=True) or {}
+        try:
+            tickers, weights = portfolio.parse_holdings(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        try:
+            max_age_days = float(data.get('max_age_days', portfolio.PORTFOLIO_MAX_AGE_DAYS))
+        except (TypeError, ValueError):
+            return jsonify({'error': 'max_age_days は数値（日数）で指定してください'}), 400
+        refresh = data.get('refresh', True)
+        if not isinstance(refresh, bool):
+            return jsonify({'error': 'refresh は true か false で指定してください'}), 400
+        
+        db = get_database()
+        holdings = db.get_portfolio_holdings(tickers)
+        sources = {ticker: 'database' for ticker in holdings}
+        
+        # 保存されていない銘柄を優先して、古い銘柄とあわせて MAX_PORTFOLIO_FETCH 銘柄まで並行して分析する
+        targets = [ticker for ticker in tickers if refresh and portfolio.needs_fetch(holdings.get(ticker), max_age_days)]
+        targets.sort(key=lambda ticker: ticker in holdings)
+        fetch = targets[:portfolio.MAX_PORTFOLIO_FETCH]
+        
+        errors = []
+        if fetch:
+            import contextvars
+            from concurrent.futures import ThreadPoolExecutor
+            analyzer = get_analyzer()
+            contexts = [contextvars.copy_context() for _ in fetch]
+            with ThreadPoolExecutor(max_workers=min(len(fetch), BATCH_CONCURRENCY)) as executor:
+                outcomes = list(executor.map(
+                    lambda context, ticker: context.run(fetch_portfolio_holding, analyzer, ticker),
+                    contexts, fetch
+                ))
+            for ticker, (result, error) in zip(fetch, outcomes):
+                if error is None:
+                    holdings[ticker] = portfolio.holding_from_analysis(result)
+                    sources[ticker] = 'analyzed'
+                else:
+                    errors.append({'ticker': ticker, **error})
+            analyzed = [ticker for ticker, source in sources.items() if source == 'analyzed']
+            if analyzed:
+                # 分析キャッシュから返した銘柄も確かめたことにする（次のリクエストで分析し直さないよう）
+                db.mark_checked(analyzed)
+                notify_data_changed()
+        
+        # 分析し直せなかった古い銘柄は保存済みのデータを使う
+        for ticker, source in sources.items():
+            if source == 'database' and portfolio.needs_fetch(holdings[ticker], max_age_days):
+                sources[ticker] = 'stale'
+        
+        result = portfolio.compute_portfolio(tickers, weights, holdings, sources)
+        result['analyzed_count'] = sum(1 for source in sources.values() if source == 'analyzed')
+        result['errors'] = errors
+        return jsonify(result)
+        
+    except Exception as e:
+        return jsonify({'error': f'ポートフォリオ計算エラー: {str(e)}'}), 500
+
 if __name__ == '__main__':
     import os
+    start_warm_up()
     port = int(os.environ.get('PORT', 8080))
     app.run(debug=False, host='0.0.0.0', port=port)
\ No newline at end of file
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""非同期（ASGI）サーバーで動かすためのエントリーポイント
+
+分析系のエンドポイント（/api/analyze, /api/analyze/batch, /api/analyze/stream）は
+イベントループ上で財務諸表の取得完了を待つため、上流（Yahoo Finance）の応答待ちの間、
+リクエストがスレッドを占有しない。yfinanceでの取得は共有スレッドプール（STATEMENT_FETCH_WORKERS）、
+pandasでの計算とデータベースの読み書きはイベントループの既定のスレッドプールで実行する。
+その他のエンドポイントはFlaskアプリをasgirefで包んでそのまま動かす（データベースへの接続は
+各実装の接続プールを使う）。ルートと応答のJSONはFlask版と同じ。
+
+起動:
+    uvicorn asgi_app:application --host 0.0.0.0 --port 8080
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import contextlib
+import contextvars
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import metrics
+import db_backend
+import app as flask_module
+
+flask_app = flask_module.app
+wsgi_application = WsgiToAsgi(flask_app)
+
+
+class ClientDisconnected(Exception):
+    """リクエストの受信中にクライアントが切断した"""
+
+
+async def read_json(receive):
+    """リクエスト本文をJSONとして読む（本文がなければNone）"""
+    body = b''
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return json.loads(body) if body else None
+
+
+def query_arg(scope, name):
+    """クエリパラメータを取得（未指定ならNone）"""
+    values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(name)
+    return values[0] if values else None
+
+
+async def send_json(send, data, status=200):
+    """jsonifyと同じ形式でJSONを返す"""
+    body = (flask_app.json.dumps(data) + '\n').encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*')
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+    return status
+
+
+def run_in_thread(func, *args):
+    """既定のスレッドプールで実行（同じリクエスト内の書き込みの記録を共有するため、コンテキストを引き継ぐ）"""
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def run_until_disconnect(coro, receive):
+    """応答処理を実行し、途中でクライアントが切断したら取り消す"""
+    task = asyncio.ensure_future(coro)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        # 499: nginxと同様にクライアント切断を表す
+        return 499
+    return task.result()
+
+
+async def wait_futures(futures, timeout):
+    """スレッドプールで実行中の取得の完了を待つ（取得の例外は計算の中で扱う）"""
+    if not futures:
+        return
+    waiters = [asyncio.wrap_future(future) for future in futures]
+    try:
+        done, _ = await asyncio.wait(waiters, timeout=timeout)
+    finally:
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.cancel()
+    for waiter in done:
+        if not waiter.cancelled():
+            waiter.exception()
+
+
+async def iter_analysis(analyzer, ticker, sections, planned):
+    """分析結果をセクションごとに返す（財務諸表の取得完了をイベントループ上で待つ）
+
+    StockAnalyzer.iter_analysis_for_web を1セクションずつスレッドプールで進めるが、
+    進める前にそのセクションに必要な財務諸表の取得完了を待つため、スレッドは計算にしか使わない。
+    """
+    _, _, statements = analyzer.start_statements(ticker, sections)
+    sections_iter = analyzer.iter_analysis_for_web(ticker, sections, statements=statements)
+    try:
+        for section in planned:
+            # 制限時間を過ぎた場合は、次の計算の中でAnalysisTimeoutになる
+            await wait_futures(statements.futures(analyzer.SECTION_STATEMENTS[section]), statements.remaining())
+            item = await run_in_thread(next, sections_iter, None)
+            if item is None:
+                return
+            yield item
+    finally:
+        # 取り消された場合も未開始の取得を取り消す（計算中の分析は次のセクションで止まる）
+        statements.cancel()
+
+
+async def analyze(analyzer, ticker, sections, planned):
+    """1銘柄を分析して、Flask版と同じ形の結果を返す（データがなければNone）"""
+    result = {}
+    async with contextlib.aclosing(iter_analysis(analyzer, ticker, sections, planned)) as sections_iter:
+        async for _, fields in sections_iter:
+            result.update(fields)
+    if not result:
+        return None
+    return await run_in_thread(flask_module.complete_analysis, analyzer, ticker, result, planned)
+
+
+async def analyze_in_process(analyzer, ticker, sections, planned):
+    """analyze と同じ結果を、財務諸表の抽出・計算をプロセスプールで行って返す（一括分析用）"""
+    from stock_analysis import InvalidTicker, get_process_pool, compute_packed_analysis
+
+    loop = asyncio.get_running_loop()
+    _, statement_names, statements = analyzer.start_statements(ticker, sections)
+    try:
+        await wait_futures(statements.futures(statement_names), statements.remaining())
+        packed, errors = analyzer.pack_statements(statements, statement_names)
+    finally:
+        statements.cancel()
+
+    try:
+        items = await loop.run_in_executor(
+            get_process_pool(flask_module.BATCH_PROCESSES), compute_packed_analysis, ticker, sections, packed, errors
+        )
+    except InvalidTicker as e:
+        analyzer.remember_invalid_ticker(e)
+        raise
+    result = await run_in_thread(analyzer.finish_packed_analysis, planned, items)
+    if result is None:
+        return None
+    return await run_in_thread(flask_module.complete_analysis, analyzer, ticker, result, planned)
+
+
+def parse_analysis_request(scope, data):
+    """リクエストから分析エンジンと計算するセクションを決める（不正な指定はValueError）"""
+    analyzer = flask_module.get_analyzer()
+    sections = flask_module.parse_sections(data.get('sections', query_arg(scope, 'sections')))
+    planned, _ = analyzer.plan_sections(sections)
+    return analyzer, sections, planned
+
+
+async def analyze_endpoint(scope, receive, send):
+    """POST /api/analyze"""
+    try:
+        data = await read_json(receive)
+    except ValueError:
+        return await send_json(send, {'error': 'JSON形式のリクエストが必要です'}, 400)
+    if not isinstance(data, dict):
+        return await send_json(send, {'error': 'JSON形式のリクエストが必要です'}, 400)
+
+    ticker = str(data.get('ticker', '')).upper().strip()
+    if not ticker:
+        return await send_json(send, {'error': 'ティッカーコードが必要です'}, 400)
+    try:
+        analyzer, sections, planned = parse_analysis_request(scope, data)
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+
+    async def respond():
+        from stock_analysis import AnalysisTimeout, InvalidTicker
+        try:
+            result = await analyze(analyzer, ticker, sections, planned)
+        except InvalidTicker as e:
+            return await send_json(send, flask_module.analysis_error(e), 404)
+        except AnalysisTimeout as e:
+            return await send_json(send, flask_module.analysis_error(e), 504)
+        except Exception as e:
+            return await send_json(send, flask_module.analysis_error(e), 500)
+        if result is None:
+            return await send_json(send, {'error': f'{ticker}のデータを取得できませんでした'}, 404)
+        return await send_json(send, result)
+
+    return await run_until_disconnect(respond(), receive)
+
+
+async def batch_endpoint(scope, receive, send):
+    """POST /api/analyze/batch"""
+    try:
+        data = await read_json(receive)
+    except ValueError:
+        return await send_json(send, {'error': 'JSON形式のリクエストが必要です'}, 400)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return await send_json(send, {'error': 'JSON形式のリクエストが必要です'}, 400)
+    try:
+        tickers = flask_module.parse_tickers(data.get('tickers', []))
+        analyzer, sections, planned = parse_analysis_request(scope, data)
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+
+    semaphore = asyncio.Semaphore(flask_module.BATCH_CONCURRENCY)
+    analyze_ticker = analyze_in_process if flask_module.BATCH_PROCESSES > 0 else analyze
+
+    async def analyze_item(ticker):
+        async with semaphore:
+            try:
+                result = await analyze_ticker(analyzer, ticker, sections, planned)
+            except Exception as e:
+                return None, flask_module.analysis_error(e)
+        if result is None:
+            return None, {'error': f'{ticker}のデータを取得できませんでした'}
+        return result, None
+
+    async def respond():
+        outcomes = await asyncio.gather(*(analyze_item(ticker) for ticker in tickers))
+        return await send_json(send, flask_module.batch_response(tickers, outcomes))
+
+    return await run_until_disconnect(respond(), receive)
+
+
+async def stream_endpoint(scope, receive, send):
+    """GET /api/analyze/stream"""
+    ticker = (query_arg(scope, 'ticker') or '').upper().strip()
+    if not ticker:
+        return await send_json(send, {'error': 'ティッカーコードが必要です'}, 400)
+    try:
+        analyzer, sections, planned = parse_analysis_request(scope, {})
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+
+    async def send_event(event, data):
+        await send({
+            'type': 'http.response.body',
+            'body': flask_module.format_sse(event, data).encode('utf-8'),
+            'more_body': True
+        })
+
+    async def respond():
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+                (b'access-control-allow-origin', b'*')
+            ]
+        })
+        received = False
+        try:
+            async with contextlib.aclosing(iter_analysis(analyzer, ticker, sections, planned)) as sections_iter:
+                async for section, fields in sections_iter:
+                    received = True
+                    await send_event(section, fields)
+
+            if not received:
+                await send_event('error', {'error': f'{ticker}のデータを取得できませんでした'})
+            else:
+                done = await run_in_thread(flask_module.complete_analysis, analyzer, ticker, {}, planned)
+                await send_event('done', {'sections': done['sections'], 'percentiles': done.get('percentiles')})
+        except Exception as e:
+            await send_event('error', flask_module.analysis_error(e))
+        await send({'type': 'http.response.body', 'body': b''})
+        return 200
+
+    return await run_until_disconnect(respond(), receive)
+
+
+# イベントループ上で処理するルート（その他はFlaskアプリで処理）
+ROUTES = {
+    ('POST', '/api/analyze'): analyze_endpoint,
+    ('POST', '/api/analyze/batch'): batch_endpoint,
+    ('GET', '/api/analyze/stream'): stream_endpoint
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            flask_module.start_warm_up()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGIアプリケーション"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        await wsgi_application(scope, receive, send)
+        return
+
+    start = time.perf_counter()
+    db_backend.begin_request()
+    try:
+        status = await handler(scope, receive, send)
+    except ClientDisconnected:
+        status = 499
+    metrics.http_requests.inc(method=scope['method'], route=scope['path'], status=status)
+    metrics.http_request_duration.observe(time.perf_counter() - start, method=scope['method'], route=scope['path'])
+    metrics.registry.maybe_flush()
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""株主還元利回りによる銘柄選択のバックテスト
+
+年次データを (指標 × 銘柄 × 年度) のNumPy配列（パネル）にまとめ、年度ごとに指標の上位N銘柄を選び、
+選んだ銘柄の利回りの平均をユニバース全体の平均と比べる。選択・集計は銘柄や年度のループではなく
+パネル全体への配列演算で行う。
+
+パネルはデータバージョン（書き込みのたびに増える）が変わるまでプロセス内に保持するため、
+2回目以降のバックテストはデータベースに触れずに配列演算だけで終わる。
+
+先読みを避けるため、既定では選択した年度の翌年度（lag=1）の値で評価する。lag=0 なら選択と同じ年度の値を集計する。
+
+使い方:
+    python3 backtest.py --metric total_return_with_capex --top 20
+    python3 backtest.py --metric buyback_yield --top 50 --country US --from 2019 --to 2023 --lag 0 --json
+"""
+import sys
+import json
+import argparse
+import threading
+
+import numpy as np
+
+# 選択・評価に使える年次データの指標
+BACKTEST_METRICS = [
+    'dividend_yield', 'buyback_yield', 'capex_yield',
+    'total_return_without_capex', 'total_return_with_capex',
+    'ocf_ratio', 'roi'
+]
+
+DEFAULT_METRIC = 'total_return_with_capex'
+DEFAULT_TOP_N = 20
+MAX_TOP_N = 1000
+MAX_LAG = 5
+
+_panel = None
+_panel_lock = threading.Lock()
+
+
+class Panel:
+    """銘柄 × 年度の年次指標（欠損はNaN）"""
+
+    def __init__(self, data_version, tickers, countries, years, values):
+        self.data_version = data_version
+        self.tickers = tickers          # 銘柄（データベースの銘柄ID順）
+        self.countries = countries
+        self.years = years              # 最小〜最大の連続した年度（データのない年度も含む）
+        self.values = values            # (指標数 × 銘柄数 × 年度数)
+        self.metric_index = {name: i for i, name in enumerate(BACKTEST_METRICS)}
+
+    def info(self):
+        return {
+            'data_version': self.data_version,
+            'stock_count': len(self.tickers),
+            'first_year': int(self.years[0]) if len(self.years) else None,
+            'last_year': int(self.years[-1]) if len(self.years) else None
+        }
+
+
+def build_panel(db):
+    """データベースの全年次データからパネルを作る"""
+    # 読み出し中の書き込みを取りこぼさないよう、版は読み出し前に取得する
+    data_version = db.get_data_version()
+
+    tickers = []
+    countries = []
+    row_tickers = []
+    row_years = []
+    columns = {name: [] for name in BACKTEST_METRICS}
+    for stock_rows, annual_rows in db.iter_export_batches():
+        for stock in stock_rows:
+            tickers.append(stock['ticker'])
+            countries.append(stock['country'] or '')
+        for annual in annual_rows:
+            if annual['year'] is None:
+                continue
+            row_tickers.append(annual['ticker'])
+            row_years.append(annual['year'])
+            for name in BACKTEST_METRICS:
+                columns[name].append(annual[name])
+
+    ticker_index = {ticker: i for i, ticker in enumerate(tickers)}
+    rows = np.array([ticker_index[ticker] for ticker in row_tickers], dtype=np.int64)
+    row_years = np.array(row_years, dtype=np.int64)
+    if len(row_years):
+        years = np.arange(row_years.min(), row_years.max() + 1)
+    else:
+        years = np.zeros(0, dtype=np.int64)
+
+    values = np.full((len(BACKTEST_METRICS), len(tickers), len(years)), np.nan, dtype=np.float64)
+    if len(row_years):
+        cols = row_years - years[0]
+        for m, name in enumerate(BACKTEST_METRICS):
+            # Noneは dtype=float の変換でNaNになる
+            values[m, rows, cols] = np.array(columns[name], dtype=np.float64)
+
+    return Panel(data_version, np.array(tickers, dtype=str), np.array(countries, dtype=str), years, values)
+
+
+def get_panel(db):
+    """パネルを取得（データバージョンが変わるまでプロセス内で再利用）"""
+    global _panel
+    version = db.get_data_version()
+    panel = _panel
+    if panel is not None and panel.data_version == version:
+        return panel
+    with _panel_lock:
+        if _panel is None or _panel.data_version != version:
+            _panel = build_panel(db)
+        return _panel
+
+
+def _masked_means(values, mask):
+    """mask（銘柄 × 年度）で選んだ値の年度ごとの件数・平均（values は 指標 × 銘柄 × 年度）"""
+    selected = mask & ~np.isnan(values)
+    counts = selected.sum(axis=1)
+    sums = np.where(selected, values, 0.0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    return counts, np.where(counts > 0, means, np.nan)
+
+
+def _to_float(value):
+    return None if np.isnan(value) else float(value)
+
+
+def run_backtest(panel, metric=DEFAULT_METRIC, top_n=DEFAULT_TOP_N, lag=1, order='desc',
+                 country=None, start_year=None, end_year=None, include_holdings=False):
+    """年度ごとに metric の上位 top_n 銘柄を選び、lag 年度後の各指標の平均をユニバース平均と比べる"""
+    if metric not in panel.metric_index:
+        raise ValueError(f"未対応の指標です: {metric}（指定可能: {', '.join(BACKTEST_METRICS)}）")
+    if order not in ('desc', 'asc'):
+        raise ValueError(f"order は desc か asc で指定してください: {order}")
+    if not 1 <= top_n <= MAX_TOP_N:
+        raise ValueError(f"top_n は1〜{MAX_TOP_N}で指定してください: {top_n}")
+    if not 0 <= lag <= MAX_LAG:
+        raise ValueError(f"lag は0〜{MAX_LAG}で指定してください: {lag}")
+
+    values = panel.values
+    if country:
+        values = values[:, panel.countries == country, :]
+    ticker_ids = np.flatnonzero(panel.countries == country) if country else np.arange(len(panel.tickers))
+
+    # 評価値：lag 年度後の値を選択年度の位置にずらす（範囲外はNaN）
+    evaluation = np.full_like(values, np.nan)
+    if lag == 0:
+        evaluation = values
+    elif lag < values.shape[2]:
+        evaluation[:, :, :-lag] = values[:, :, lag:]
+
+    signal = values[panel.metric_index[metric]]        # (銘柄 × 年度)
+    universe = ~np.isnan(signal)
+    stock_count, year_count = signal.shape
+
+    # 年度ごとの上位N銘柄（全年度を一度に部分ソート）
+    n = min(top_n, stock_count)
+    keys = np.where(universe, -signal if order == 'desc' else signal, np.inf)
+    selected = np.zeros_like(universe)
+    top = np.zeros((0, year_count), dtype=np.int64)
+    if n:
+        top = np.argpartition(keys, n - 1, axis=0)[:n]
+        top = np.take_along_axis(top, np.argsort(np.take_along_axis(keys, top, axis=0), axis=0, kind='stable'), axis=0)
+        selected[top, np.arange(year_count)] = True
+        selected &= universe
+
+    portfolio_counts, portfolio_means = _masked_means(evaluation, selected)
+    universe_counts, universe_means = _masked_means(evaluation, universe)
+    selected_counts = selected.sum(axis=0)
+    universe_sizes = universe.sum(axis=0)
+
+    # 対象年度：期間内で、選択できる銘柄があり、評価年度がデータの範囲内
+    active = universe_sizes > 0
+    if lag:
+        active[max(0, year_count - lag):] = False
+    if start_year is not None:
+        active &= panel.years >= start_year
+    if end_year is not None:
+        active &= panel.years <= end_year
+
+    results = []
+    for y in np.flatnonzero(active):
+        entry = {
+            'year': int(panel.years[y]),
+            'evaluation_year': int(panel.years[y]) + lag,
+            'universe_count': int(universe_sizes[y]),
+            'selected_count': int(selected_counts[y]),
+            'portfolio': {},
+            'universe': {}
+        }
+        for m, name in enumerate(BACKTEST_METRICS):
+            entry['portfolio'][name] = {'count': int(portfolio_counts[m, y]), 'mean': _to_float(portfolio_means[m, y])}
+            entry['universe'][name] = {'count': int(universe_counts[m, y]), 'mean': _to_float(universe_means[m, y])}
+        m = panel.metric_index[metric]
+        excess = portfolio_means[m, y] - universe_means[m, y]
+        entry['excess'] = _to_float(excess)
+        if include_holdings:
+            entry['holdings'] = [
+                {'ticker': str(panel.tickers[ticker_ids[i]]), metric: float(signal[i, y])}
+                for i in top[:selected_counts[y], y]
+            ]
+        results.append(entry)
+
+    return {
+        'metric': metric,
+        'top_n': top_n,
+        'lag': lag,
+        'order': order,
+        'country': country,
+        'panel': panel.info(),
+        'years': results,
+        'summary': _summarize(results)
+    }
+
+
+def _summarize(results):
+    """年度ごとの結果を平均する（評価値のない年度は除く）"""
+    summary = {'year_count': 0, 'outperformed_years': 0, 'mean_excess': None, 'portfolio': {}, 'universe': {}}
+    excesses = [entry['excess'] for entry in results if entry['excess'] is not None]
+    if excesses:
+        summary['year_count'] = len(excesses)
+        summary['outperformed_years'] = sum(1 for excess in excesses if excess > 0)
+        summary['mean_excess'] = sum(excesses) / len(excesses)
+    for side in ('portfolio', 'universe'):
+        for name in BACKTEST_METRICS:
+            means = [entry[side][name]['mean'] for entry in results if entry[side][name]['mean'] is not None]
+            summary[side][name] = sum(means) / len(means) if means else None
+    return summary
+
+
+def _format_value(value):
+    return '-' if value is None else f'{value:.4f}'
+
+
+def print_result(result):
+    """バックテスト結果を表で表示"""
+    metric = result['metric']
+    print(f"📊 {metric} 上位{result['top_n']}銘柄（評価: {result['lag']}年度後）")
+    print(f"{'年度':>6} {'評価':>6} {'対象':>6} {'選択':>6} {'ポートフォリオ':>14} {'ユニバース':>12} {'差':>10}")
+    for entry in result['years']:
+        print(
+            f"{entry['year']:>6} {entry['evaluation_year']:>6} {entry['universe_count']:>6} "
+            f"{entry['selected_count']:>6} {_format_value(entry['portfolio'][metric]['mean']):>14} "
+            f"{_format_value(entry['universe'][metric]['mean']):>12} {_format_value(entry['excess']):>10}"
+        )
+    summary = result['summary']
+    print(
+        f"平均: ポートフォリオ {_format_value(summary['portfolio'][metric])} / "
+        f"ユニバース {_format_value(summary['universe'][metric])} / 差 {_format_value(summary['mean_excess'])}"
+        f"（上回った年度 {summary['outperformed_years']}/{summary['year_count']}）"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='株主還元利回りの上位銘柄を年度ごとに選ぶバックテスト')
+    parser.add_argument('--metric', default=DEFAULT_METRIC, choices=BACKTEST_METRICS, help='銘柄を選ぶ指標')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP_N, help='年度ごとに選ぶ銘柄数')
+    parser.add_argument('--lag', type=int, default=1, help='選択から評価までの年度数（0なら同じ年度）')
+    parser.add_argument('--order', default='desc', choices=['desc', 'asc'], help='desc: 大きい順, asc: 小さい順')
+    parser.add_argument('--country', help='国で絞り込む')
+    parser.add_argument('--from', dest='start_year', type=int, help='最初の選択年度')
+    parser.add_argument('--to', dest='end_year', type=int, help='最後の選択年度')
+    parser.add_argument('--holdings', action='store_true', help='年度ごとの選択銘柄を含める（--json と併用）')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力する')
+    args = parser.parse_args(argv)
+
+    from db_backend import get_database
+
+    try:
+        result = run_backtest(
+            get_panel(get_database()), args.metric, args.top, lag=args.lag, order=args.order,
+            country=args.country, start_year=args.start_year, end_year=args.end_year,
+            include_holdings=args.holdings
+        )
+    except Exception as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        return 1
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_result(result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""起動時間のベンチマーク
+
+新しいPythonプロセスでサーバー用のエントリーポイント（wsgi）を読み込み、以下を計測する。
+- wsgi モジュールのインポート時間（既定の設定ではバックグラウンドのウォームアップも始まる）
+- プロセス起動から最初の /health 応答までの時間
+- インポート時間の大きいモジュール上位（python -X importtime）
+
+既定の設定（ウォームアップあり）と WARMUP_ON_BOOT=false の両方を計測する。
+
+使い方:
+    python3 bench_startup.py [--runs 5]
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# 子プロセスで実行する計測コード
+PROBE = r'''
+import time, json, sys
+t0 = time.perf_counter()
+sys.path.insert(0, {here!r})
+import wsgi
+t1 = time.perf_counter()
+response = wsgi.app.test_client().get('/health')
+t2 = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (t1 - t0) * 1000,
+    'first_health_ms': (t2 - t0) * 1000,
+    'status': response.status_code,
+    'heavy_modules_loaded': [m for m in ('pandas', 'yfinance', 'sqlalchemy') if m in sys.modules],
+}}))
+'''
+
+
+def run_probe(env):
+    """1回分の計測を子プロセスで実行"""
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE.format(here=HERE)],
+        capture_output=True, text=True, env=env, cwd=HERE, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def top_imports(env, limit):
+    """-X importtime の結果から累積時間の大きいモジュールを抽出"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import sys; sys.path.insert(0, {HERE!r}); import wsgi'],
+        capture_output=True, text=True, env=env, cwd=HERE
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        # 形式: "import time:   self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), name.strip()))
+    rows.sort(reverse=True)
+    return rows[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='起動時間のベンチマーク')
+    parser.add_argument('--runs', type=int, default=5, help='計測回数')
+    parser.add_argument('--top', type=int, default=10, help='表示するインポート上位件数')
+    args = parser.parse_args()
+
+    print(f"計測回数: {args.runs}")
+    for label, warm_up in (('既定（ウォームアップあり）', 'true'), ('WARMUP_ON_BOOT=false', 'false')):
+        env = dict(os.environ, WARMUP_ON_BOOT=warm_up)
+        samples = [run_probe(env) for _ in range(args.runs)]
+        import_ms = [s['import_ms'] for s in samples]
+        health_ms = [s['first_health_ms'] for s in samples]
+
+        print(f"\n[{label}]")
+        print(f"wsgi インポート: 中央値 {statistics.median(import_ms):.1f} ms (最小 {min(import_ms):.1f} / 最大 {max(import_ms):.1f})")
+        print(f"最初の /health 応答: 中央値 {statistics.median(health_ms):.1f} ms (最小 {min(health_ms):.1f} / 最大 {max(health_ms):.1f})")
+        print(f"応答時点で読み込み済みの重いモジュール: {samples[-1]['heavy_modules_loaded'] or 'なし'}")
+
+    # インポート自体の内訳はウォームアップの有無によらない
+    print(f"\nインポート時間上位 {args.top} 件（累積）:")
+    for cumulative_us, name in top_imports(dict(os.environ, WARMUP_ON_BOOT='false'), args.top):
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
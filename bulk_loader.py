@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""ティッカー一覧ファイルから多数の銘柄を一括で分析・保存する
+
+分析結果は銘柄ごとにデータベースへ保存し、同時にJSONLファイルへ1行ずつ追記する。
+完了した銘柄はチェックポイントファイルに追記していくため、途中で止まっても
+同じコマンドを再実行すれば未完了の銘柄から再開できる（JSONLへの追記後・チェックポイント記録前に
+止まった銘柄は再開時にもう一度分析されるため、JSONLに重複して出力されることがある）。
+
+同時に処理中の銘柄数は --concurrency で制限し、結果は保持せずに書き出すので、
+1万銘柄以上でもメモリ使用量はほぼ一定。進捗と残り時間の目安は標準エラー出力に表示する。
+--processes を指定すると、取得した財務諸表の抽出・計算をプロセスプールで行い、全コアを使う
+（取得待ちの銘柄が計算を待たせないよう、--concurrency はプロセス数より大きくする）。
+
+ティッカー一覧ファイルは1行に1銘柄（空行と # 以降は無視）。
+
+使い方:
+    python3 bulk_loader.py tickers.txt [--concurrency 4] [--output results.jsonl]
+                                       [--checkpoint results.jsonl.checkpoint] [--retry-failed]
+                                       [--processes 8]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# 進捗表示の最小間隔（秒）
+PROGRESS_INTERVAL = 1.0
+
+
+def iter_tickers(path):
+    """ティッカー一覧ファイルを1行ずつ読む"""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            ticker = line.split('#', 1)[0].strip().upper()
+            if ticker:
+                yield ticker
+
+
+def load_checkpoint(path, retry_failed=False):
+    """チェックポイントから処理済みの銘柄を読み込む（retry_failed時は失敗した銘柄を除く）"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) < 2:
+                # 書き込み途中で止まった行は未完了として扱う
+                continue
+            ticker, status = parts[0], parts[1]
+            if status == 'ok' or not retry_failed:
+                done.add(ticker)
+            else:
+                done.discard(ticker)
+    return done
+
+
+def format_duration(seconds):
+    """秒数を H:MM:SS 形式にする"""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    """進捗と残り時間の目安を標準エラー出力に表示"""
+
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.ok = 0
+        self.failed = 0
+        self.start = time.monotonic()
+        self._last_report = 0.0
+
+    @property
+    def processed(self):
+        return self.ok + self.failed
+
+    def update(self, ticker, success):
+        if success:
+            self.ok += 1
+        else:
+            self.failed += 1
+
+        now = time.monotonic()
+        if now - self._last_report < PROGRESS_INTERVAL and self.processed < self.total:
+            return
+        self._last_report = now
+
+        elapsed = now - self.start
+        rate = self.processed / elapsed if elapsed > 0 else 0
+        remaining = (self.total - self.processed) / rate if rate > 0 else 0
+        percent = self.processed / self.total * 100 if self.total else 100
+        print(
+            f"[{self.processed}/{self.total}] {percent:5.1f}% 成功 {self.ok} / 失敗 {self.failed} "
+            f"| {rate:.2f}銘柄/秒 | 経過 {format_duration(elapsed)} | 残り約 {format_duration(remaining)} | {ticker}",
+            file=self.stream, flush=True
+        )
+
+
+def analyze_one(analyzer, ticker, processes=0):
+    """1銘柄を分析（分析と同時にデータベースへ保存される）"""
+    try:
+        if processes > 0:
+            result = analyzer.analyze_stock_in_process(ticker, processes=processes)
+        else:
+            result = analyzer.analyze_stock_for_web(ticker)
+        if result is None:
+            return ticker, None, 'データを取得できませんでした'
+        return ticker, result, None
+    except Exception as e:
+        return ticker, None, str(e)
+
+
+def run(tickers_file, output, checkpoint, concurrency=4, retry_failed=False, analyzer=None, verbose=False,
+        processes=0):
+    """一括分析を実行して結果の件数を返す"""
+    done = load_checkpoint(checkpoint, retry_failed)
+
+    # 進捗表示のため、未処理の銘柄数を先に数える
+    seen = set()
+    total = 0
+    for ticker in iter_tickers(tickers_file):
+        if ticker not in done and ticker not in seen:
+            seen.add(ticker)
+            total += 1
+    seen = None
+
+    print(
+        f"対象 {total}銘柄（処理済み {len(done)}銘柄をスキップ） / 同時実行数 {concurrency}"
+        + (f" / 計算プロセス数 {processes}" if processes > 0 else ''),
+        file=sys.stderr
+    )
+    if total == 0:
+        return {'ok': 0, 'failed': 0}
+
+    if analyzer is None:
+        from stock_analysis import StockAnalyzer
+        analyzer = StockAnalyzer()
+
+    progress = Progress(total)
+    queued = set()
+    interrupted = False
+
+    with contextlib.ExitStack() as stack, \
+            open(output, 'a', encoding='utf-8') as output_file, \
+            open(checkpoint, 'a', encoding='utf-8') as checkpoint_file, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if not verbose:
+            # 分析中の進捗メッセージ（標準出力）は抑止し、進捗は標準エラー出力にのみ出す
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, 'w'))))
+
+        def record(future):
+            ticker, result, error = future.result()
+            if result is not None:
+                output_file.write(json.dumps(result, ensure_ascii=False, default=str) + '\n')
+                output_file.flush()
+            # JSONLへの書き込み後にチェックポイントを記録する
+            checkpoint_file.write(f"{ticker}\t{'ok' if error is None else 'failed'}\t{error or ''}\n")
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+            if error is not None:
+                print(f"❌ {ticker}: {error}", file=sys.stderr)
+            progress.update(ticker, error is None)
+
+        pending = set()
+        try:
+            for ticker in iter_tickers(tickers_file):
+                if ticker in done or ticker in queued:
+                    continue
+                queued.add(ticker)
+
+                # 実行待ちを同時実行数の2倍までに抑え、一覧全体を投入しない
+                while len(pending) >= concurrency * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record(future)
+                pending.add(executor.submit(analyze_one, analyzer, ticker, processes))
+
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record(future)
+        except KeyboardInterrupt:
+            interrupted = True
+            print("\n中断しました。実行中の銘柄の完了を待っています...", file=sys.stderr)
+            for future in pending:
+                future.cancel()
+            for future in pending:
+                if not future.cancelled():
+                    record(future)
+
+    print(
+        f"{'中断' if interrupted else '完了'}: 成功 {progress.ok} / 失敗 {progress.failed} "
+        f"（経過 {format_duration(time.monotonic() - progress.start)}）",
+        file=sys.stderr
+    )
+    return {'ok': progress.ok, 'failed': progress.failed, 'interrupted': interrupted}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ティッカー一覧から一括で分析・保存する')
+    parser.add_argument('tickers_file', help='1行に1銘柄のティッカー一覧ファイル')
+    parser.add_argument('--concurrency', type=int, default=4, help='同時に分析する銘柄数')
+    parser.add_argument('--output', default='bulk_results.jsonl', help='分析結果を追記するJSONLファイル')
+    parser.add_argument('--checkpoint', help='チェックポイントファイル（既定: <output>.checkpoint）')
+    parser.add_argument('--retry-failed', action='store_true', help='前回失敗した銘柄も再度分析する')
+    parser.add_argument('--verbose', action='store_true', help='分析中のメッセージを標準出力に表示する')
+    parser.add_argument('--processes', type=int, default=0,
+                        help='財務諸表の抽出・計算に使うプロセス数（0ならスレッドで計算）')
+    args = parser.parse_args(argv)
+
+    if args.concurrency < 1:
+        parser.error('--concurrency は1以上を指定してください')
+    if args.processes < 0:
+        parser.error('--processes は0以上を指定してください')
+
+    try:
+        result = run(
+            args.tickers_file,
+            args.output,
+            args.checkpoint or args.output + '.checkpoint',
+            concurrency=args.concurrency,
+            retry_failed=args.retry_failed,
+            verbose=args.verbose,
+            processes=args.processes
+        )
+    except OSError as e:
+        print(f"❌ エラー: {e}", file=sys.stderr)
+        return 1
+    return 130 if result.get('interrupted') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""ワーカープロセス間で共有するキャッシュ
+
+gunicornなどで複数のワーカープロセスを動かしても、同じホストのワーカーが1つのキャッシュを共有する。
+CACHE_BACKEND で実装を選ぶ:
+- sqlite（既定）: CACHE_PATH のSQLiteファイル。書き込みはトランザクションで行うため、
+  他のプロセスから書きかけの値が見えることはない。合計サイズ（CACHE_MAX_BYTES）・件数（CACHE_MAX_ENTRIES）を
+  超えたら、期限切れの値、次に最近使われていない値から削除する
+- redis: REDIS_URL のRedis（上限と削除方針はRedisの maxmemory / maxmemory-policy で設定する）
+- none: キャッシュしない
+
+値はpickleで保存する（同じホストのこのアプリだけが読み書きする前提）。
+キャッシュの読み書きに失敗しても、キャッシュなしとして処理を続ける。
+"""
+import os
+import time
+import pickle
+import sqlite3
+import threading
+
+import metrics
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite').lower()
+CACHE_PATH = os.environ.get('CACHE_PATH', 'analysis_cache.db')
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', '100000'))
+
+# 1件の値の上限（これより大きい値はキャッシュしない）
+CACHE_MAX_ENTRY_BYTES = int(os.environ.get('CACHE_MAX_ENTRY_BYTES', str(CACHE_MAX_BYTES // 8)))
+
+# 有効期限（秒）
+# 株価（info）は変わりやすいので短く、決算書は四半期ごとにしか変わらないので長くする
+STATEMENT_TTL = {
+    'info': float(os.environ.get('CACHE_TTL_INFO', '900')),
+    'default': float(os.environ.get('CACHE_TTL_STATEMENTS', '43200'))
+}
+ANALYSIS_TTL = float(os.environ.get('CACHE_TTL_ANALYSIS', '900'))
+# 存在しない・上場廃止の銘柄を記憶する期間（一時的な取得失敗の可能性もあるため短くする）
+INVALID_TICKER_TTL = {
+    'not_found': float(os.environ.get('CACHE_TTL_NOT_FOUND', '600')),
+    'delisted': float(os.environ.get('CACHE_TTL_DELISTED', '3600'))
+}
+# データベースの読み取り結果はキーにデータバージョンを含めるため、期限は古い値を消すためのもの
+DATABASE_TTL = float(os.environ.get('CACHE_TTL_DATABASE', '3600'))
+
+# 上限を超えたら、この割合まで減らす（削除が毎回起きないようにする）
+EVICTION_TARGET = 0.9
+
+# 最終使用時刻の更新間隔（秒）。読み取りのたびに書き込まないようにする
+ACCESS_UPDATE_INTERVAL = 60.0
+
+
+class CacheBackend:
+    """キャッシュの共通インターフェース（値がなければ get は None を返す）"""
+
+    name = 'none'
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl=None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self, prefix=''):
+        """prefix で始まるキーを削除し、削除した件数を返す"""
+        return 0
+
+    def get_or_set(self, key, compute, ttl=None, metric=None):
+        """値がなければ compute() の結果を保存して返す（compute() が None なら保存しない）"""
+        value = self.get(key)
+        if metric is not None:
+            metrics.record_cache(metric, value is not None)
+        if value is None:
+            value = compute()
+            if value is not None:
+                self.set(key, value, ttl)
+        return value
+
+
+class NullCache(CacheBackend):
+    """キャッシュしない"""
+
+
+class SQLiteCache(CacheBackend):
+    """SQLiteファイルに保存するキャッシュ（同じファイルを使うプロセス間で共有）"""
+
+    name = 'sqlite'
+
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES, max_entries=CACHE_MAX_ENTRIES,
+                 max_entry_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.max_entry_bytes = max_entry_bytes or max(1, max_bytes // 8)
+        self._local = threading.local()
+        self._warned = False
+        self._init_schema()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_entries_accessed ON cache_entries(accessed_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_entries_expires ON cache_entries(expires_at)')
+        # 合計サイズ・件数（書き込みと同じトランザクションで更新する）
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_usage (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_bytes INTEGER NOT NULL,
+                entry_count INTEGER NOT NULL
+            )
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO cache_usage (id, total_bytes, entry_count)
+            SELECT 1, COALESCE(SUM(size), 0), COUNT(*) FROM cache_entries
+        ''')
+
+    def _warn(self, e):
+        if not self._warned:
+            self._warned = True
+            print(f"⚠️ キャッシュの読み書きに失敗しました（キャッシュなしで続行）: {e}")
+
+    def _delete_keys(self, conn, condition, params=()):
+        """条件に合う値を削除して合計サイズ・件数を更新（トランザクション内で呼ぶ）"""
+        row = conn.execute(
+            f'SELECT COALESCE(SUM(size), 0), COUNT(*) FROM cache_entries WHERE {condition}', params
+        ).fetchone()
+        if row[1]:
+            conn.execute(f'DELETE FROM cache_entries WHERE {condition}', params)
+            conn.execute(
+                'UPDATE cache_usage SET total_bytes = total_bytes - ?, entry_count = entry_count - ? WHERE id = 1',
+                row
+            )
+        return row[1]
+
+    def get(self, key):
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT value, expires_at, accessed_at FROM cache_entries WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, expires_at, accessed_at = row
+            now = time.time()
+            if expires_at is not None and expires_at <= now:
+                with conn:
+                    conn.execute('BEGIN IMMEDIATE')
+                    self._delete_keys(conn, 'key = ? AND expires_at <= ?', (key, now))
+                return None
+            if now - accessed_at > ACCESS_UPDATE_INTERVAL:
+                conn.execute('UPDATE cache_entries SET accessed_at = ? WHERE key = ?', (now, key))
+            return pickle.loads(value)
+        except (sqlite3.Error, pickle.PickleError, EOFError, AttributeError, ImportError) as e:
+            self._warn(e)
+            return None
+
+    def set(self, key, value, ttl=None):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(blob) > self.max_entry_bytes:
+                return
+            now = time.time()
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._delete_keys(conn, 'key = ?', (key,))
+                conn.execute(
+                    'INSERT INTO cache_entries (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                    (key, blob, len(blob), now + ttl if ttl else None, now)
+                )
+                conn.execute(
+                    'UPDATE cache_usage SET total_bytes = total_bytes + ?, entry_count = entry_count + 1 WHERE id = 1',
+                    (len(blob),)
+                )
+                self._evict(conn, now)
+        except (sqlite3.Error, pickle.PickleError, TypeError, AttributeError) as e:
+            self._warn(e)
+
+    def _evict(self, conn, now):
+        """上限を超えていれば、期限切れの値、次に最近使われていない値から削除（トランザクション内で呼ぶ）"""
+        total_bytes, entry_count = conn.execute(
+            'SELECT total_bytes, entry_count FROM cache_usage WHERE id = 1'
+        ).fetchone()
+        if total_bytes <= self.max_bytes and entry_count <= self.max_entries:
+            return
+        self._delete_keys(conn, 'expires_at <= ?', (now,))
+
+        target_bytes = self.max_bytes * EVICTION_TARGET
+        target_entries = self.max_entries * EVICTION_TARGET
+        while True:
+            total_bytes, entry_count = conn.execute(
+                'SELECT total_bytes, entry_count FROM cache_usage WHERE id = 1'
+            ).fetchone()
+            if (total_bytes <= target_bytes and entry_count <= target_entries) or entry_count == 0:
+                return
+            self._delete_keys(
+                conn, 'key IN (SELECT key FROM cache_entries ORDER BY accessed_at LIMIT ?)',
+                (max(1, entry_count // 20),)
+            )
+
+    def delete(self, key):
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._delete_keys(conn, 'key = ?', (key,))
+        except sqlite3.Error as e:
+            self._warn(e)
+
+    def clear(self, prefix=''):
+        try:
+            conn = self._connect()
+            pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                return self._delete_keys(conn, "key LIKE ? ESCAPE '\\'", (pattern,))
+        except sqlite3.Error as e:
+            self._warn(e)
+            return 0
+
+    def usage(self):
+        """合計サイズ・件数"""
+        total_bytes, entry_count = self._connect().execute(
+            'SELECT total_bytes, entry_count FROM cache_usage WHERE id = 1'
+        ).fetchone()
+        return {'total_bytes': total_bytes, 'entry_count': entry_count,
+                'max_bytes': self.max_bytes, 'max_entries': self.max_entries}
+
+
+class RedisCache(CacheBackend):
+    """Redisに保存するキャッシュ（redisパッケージが必要）"""
+
+    name = 'redis'
+
+    def __init__(self, url=None, namespace='real-dividend:', max_entry_bytes=CACHE_MAX_ENTRY_BYTES):
+        import redis
+        self.client = redis.Redis.from_url(url or os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+        self.namespace = namespace
+        self.max_entry_bytes = max_entry_bytes
+        self._warned = False
+
+    def _warn(self, e):
+        if not self._warned:
+            self._warned = True
+            print(f"⚠️ キャッシュの読み書きに失敗しました（キャッシュなしで続行）: {e}")
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.namespace + key)
+            return pickle.loads(value) if value is not None else None
+        except Exception as e:
+            self._warn(e)
+            return None
+
+    def set(self, key, value, ttl=None):
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(blob) > self.max_entry_bytes:
+                return
+            self.client.set(self.namespace + key, blob, px=int(ttl * 1000) if ttl else None)
+        except Exception as e:
+            self._warn(e)
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.namespace + key)
+        except Exception as e:
+            self._warn(e)
+
+    def clear(self, prefix=''):
+        try:
+            deleted = 0
+            batch = []
+            for key in self.client.scan_iter(match=self.namespace + prefix + '*', count=1000):
+                batch.append(key)
+                if len(batch) >= 1000:
+                    deleted += self.client.delete(*batch)
+                    batch = []
+            if batch:
+                deleted += self.client.delete(*batch)
+            return deleted
+        except Exception as e:
+            self._warn(e)
+            return 0
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def create_cache(backend=None):
+    """設定に応じたキャッシュを作成（作成に失敗したらキャッシュなし）"""
+    backend = (backend or CACHE_BACKEND).lower()
+    try:
+        if backend == 'sqlite':
+            return SQLiteCache()
+        if backend == 'redis':
+            return RedisCache()
+        if backend != 'none':
+            print(f"⚠️ 未対応のCACHE_BACKENDです: {backend}（キャッシュなしで続行）")
+    except Exception as e:
+        print(f"⚠️ キャッシュを初期化できませんでした（キャッシュなしで続行）: {e}")
+    return NullCache()
+
+
+def get_cache():
+    """プロセス内で共有するキャッシュを取得"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = create_cache()
+        return _cache
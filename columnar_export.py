@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""データベース全体のParquetスナップショット（エクスポート/インポート）
+
+stocks.parquet と annual_data.parquet の2ファイルに、型付きの列として出力する。
+銘柄はデータベースからバッチ単位で読み出し、バッチごとに1つのrow groupとして書き込むため、
+銘柄数が増えてもメモリ使用量は一定に保たれる。
+
+使い方（CLI）:
+    python3 admin.py export-parquet <出力ディレクトリ>
+    python3 admin.py import-parquet <入力ディレクトリ> [--clear]
+"""
+import os
+import zipfile
+from datetime import datetime
+
+FORMAT_VERSION = '1.0'
+STOCKS_FILE = 'stocks.parquet'
+ANNUAL_FILE = 'annual_data.parquet'
+
+DEFAULT_BATCH_SIZE = 5000
+
+STOCK_FLOAT_COLUMNS = ['current_price', 'market_cap', 'current_dividend_yield']
+ANNUAL_FLOAT_COLUMNS = [
+    'total_revenue', 'operating_cash_flow', 'ocf_ratio',
+    'dividend_amount', 'dividend_yield', 'buyback_amount', 'buyback_yield',
+    'capex_amount', 'capex_yield', 'debt_issuance', 'debt_repayment', 'roi',
+    'total_return_without_capex', 'total_return_with_capex',
+    'net_income', 'total_assets'
+]
+
+
+def _require_pyarrow():
+    """pyarrowを読み込む（未インストールなら分かりやすいエラーにする）"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet形式の入出力には pyarrow が必要です（pip install pyarrow）")
+    return pyarrow, pyarrow.parquet
+
+
+def stock_schema(pa):
+    """stocks.parquet のスキーマ"""
+    return pa.schema(
+        [
+            ('ticker', pa.string()),
+            ('company_name', pa.string()),
+            ('country', pa.string()),
+            ('currency', pa.string()),
+        ]
+        + [(name, pa.float64()) for name in STOCK_FLOAT_COLUMNS]
+        + [('last_updated', pa.timestamp('us')), ('sector', pa.string()), ('industry', pa.string()),
+           ('financial_currency', pa.string())]
+    )
+
+
+def annual_schema(pa):
+    """annual_data.parquet のスキーマ"""
+    return pa.schema(
+        [('ticker', pa.string()), ('year', pa.int32())]
+        + [(name, pa.float64()) for name in ANNUAL_FLOAT_COLUMNS]
+    )
+
+
+def _to_datetime(value):
+    """SQLiteの文字列タイムスタンプもdatetimeに揃える"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def export_parquet(db, out_dir, batch_size=DEFAULT_BATCH_SIZE, compression='zstd'):
+    """データベース全体をParquetファイルとして出力"""
+    pa, pq = _require_pyarrow()
+    os.makedirs(out_dir, exist_ok=True)
+
+    metadata = {
+        'format_version': FORMAT_VERSION,
+        'export_date': datetime.now().isoformat()
+    }
+    stocks_schema = stock_schema(pa).with_metadata(metadata)
+    annual_data_schema = annual_schema(pa).with_metadata(metadata)
+
+    stocks_path = os.path.join(out_dir, STOCKS_FILE)
+    annual_path = os.path.join(out_dir, ANNUAL_FILE)
+    stock_count = 0
+    annual_count = 0
+
+    with pq.ParquetWriter(stocks_path, stocks_schema, compression=compression) as stocks_writer, \
+            pq.ParquetWriter(annual_path, annual_data_schema, compression=compression) as annual_writer:
+        for stock_rows, annual_rows in db.iter_export_batches(batch_size):
+            for row in stock_rows:
+                row['last_updated'] = _to_datetime(row['last_updated'])
+
+            # 銘柄バッチと対応する年次データを、それぞれ1つのrow groupとして書き込む
+            stocks_writer.write_batch(pa.RecordBatch.from_pylist(stock_rows, schema=stocks_schema))
+            annual_writer.write_batch(pa.RecordBatch.from_pylist(annual_rows, schema=annual_data_schema))
+
+            stock_count += len(stock_rows)
+            annual_count += len(annual_rows)
+
+    return {
+        'stocks_path': stocks_path,
+        'annual_data_path': annual_path,
+        'stock_count': stock_count,
+        'annual_data_count': annual_count
+    }
+
+
+def export_parquet_archive(db, zip_path, batch_size=DEFAULT_BATCH_SIZE):
+    """2つのParquetファイルをzipにまとめて出力（HTTPダウンロード用）"""
+    work_dir = zip_path + '.parts'
+    try:
+        result = export_parquet(db, work_dir, batch_size)
+        # Parquetは圧縮済みなのでzipでは再圧縮しない
+        with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as archive:
+            archive.write(result['stocks_path'], STOCKS_FILE)
+            archive.write(result['annual_data_path'], ANNUAL_FILE)
+    finally:
+        for name in (STOCKS_FILE, ANNUAL_FILE):
+            path = os.path.join(work_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.isdir(work_dir):
+            os.rmdir(work_dir)
+    return result
+
+
+def _row_groups_aligned(stocks_file, annual_file):
+    """同じ番号のrow groupが同じ銘柄群に対応しているか（ticker列のみ読んで確認）"""
+    if stocks_file.num_row_groups != annual_file.num_row_groups:
+        return False
+    for i in range(stocks_file.num_row_groups):
+        tickers = set(stocks_file.read_row_group(i, columns=['ticker']).column('ticker').to_pylist())
+        annual_tickers = set(annual_file.read_row_group(i, columns=['ticker']).column('ticker').to_pylist())
+        if not annual_tickers <= tickers:
+            return False
+    return True
+
+
+def _iter_import_batches(pq, stocks_path, annual_path):
+    """銘柄と年次データを対応するrow groupごとに読み出す
+
+    本モジュールで出力したファイルは、同じ番号のrow groupが同じ銘柄群に対応する。
+    対応していない（他のツールで加工された）場合は年次データを一括で読み込む。
+    """
+    stocks_file = pq.ParquetFile(stocks_path)
+    annual_file = pq.ParquetFile(annual_path)
+
+    if _row_groups_aligned(stocks_file, annual_file):
+        for i in range(stocks_file.num_row_groups):
+            yield stocks_file.read_row_group(i).to_pylist(), annual_file.read_row_group(i).to_pylist()
+        return
+
+    annual_rows = annual_file.read().to_pylist()
+    for batch in stocks_file.iter_batches(batch_size=DEFAULT_BATCH_SIZE):
+        stock_rows = batch.to_pylist()
+        tickers = {row['ticker'] for row in stock_rows}
+        yield stock_rows, [row for row in annual_rows if row['ticker'] in tickers]
+
+
+def import_parquet(db, in_dir, clear_existing=False):
+    """export_parquetで出力したファイルをデータベースにインポート"""
+    _, pq = _require_pyarrow()
+    stocks_path = os.path.join(in_dir, STOCKS_FILE)
+    annual_path = os.path.join(in_dir, ANNUAL_FILE)
+
+    totals = {
+        'imported_count': 0, 'updated_count': 0, 'skipped_count': 0, 'total_processed': 0,
+        'annual_inserted_count': 0, 'annual_updated_count': 0, 'annual_skipped_count': 0, 'annual_deleted_count': 0
+    }
+    first_batch = True
+
+    for stock_rows, annual_rows in _iter_import_batches(pq, stocks_path, annual_path):
+        annual_by_ticker = {}
+        for row in annual_rows:
+            annual_by_ticker.setdefault(row.pop('ticker'), []).append(row)
+
+        stocks = []
+        for row in stock_rows:
+            if row.get('last_updated') is not None:
+                row['last_updated'] = row['last_updated'].isoformat()
+            row['annual_data'] = annual_by_ticker.get(row['ticker'], [])
+            stocks.append(row)
+
+        # 既存データの削除は最初のバッチでのみ行う
+        result = db.import_database({'stocks': stocks}, clear_existing=clear_existing and first_batch)
+        first_batch = False
+
+        for key in totals:
+            totals[key] += result[key]
+
+    if clear_existing and first_batch:
+        # 空のスナップショットでも既存データの削除は行う
+        db.import_database({'stocks': []}, clear_existing=True)
+
+    return totals
+
+
+def import_parquet_archive(db, zip_path, clear_existing=False):
+    """export_parquet_archiveで出力したzipをインポート"""
+    work_dir = zip_path + '.parts'
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            archive.extract(STOCKS_FILE, work_dir)
+            archive.extract(ANNUAL_FILE, work_dir)
+        return import_parquet(db, work_dir, clear_existing)
+    finally:
+        for name in (STOCKS_FILE, ANNUAL_FILE):
+            path = os.path.join(work_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.isdir(work_dir):
+            os.rmdir(work_dir)
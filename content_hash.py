@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""銘柄・年次データの内容ハッシュ（変更の有無の判定用）
+
+保存・インポート時に銘柄の行と年次データの行ごとにハッシュを計算して content_hash カラムに保存し、
+次の書き込みで同じハッシュになる行は書き込まない（同じバックアップの再インポートはほぼ何もしない）。
+ハッシュの対象は入力される値だけで、最終更新日時と、レートから計算するUSD換算の値は含めない。
+数値は整数・浮動小数点数を区別せずに比べる（0 と 0.0 は同じ）。
+"""
+import json
+import hashlib
+import numbers
+
+# ハッシュの対象（年次データはINSERT文のカラム順）
+STOCK_FIELDS = (
+    'company_name', 'country', 'currency', 'current_price', 'market_cap', 'current_dividend_yield',
+    'sector', 'industry', 'financial_currency'
+)
+ANNUAL_FIELDS = (
+    'year', 'total_revenue', 'operating_cash_flow', 'ocf_ratio',
+    'dividend_amount', 'dividend_yield', 'buyback_amount', 'buyback_yield',
+    'capex_amount', 'capex_yield', 'debt_issuance', 'debt_repayment', 'roi',
+    'total_return_without_capex', 'total_return_with_capex',
+    'net_income', 'total_assets'
+)
+
+
+def _normalize(value):
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return float(value)
+    return value
+
+
+def _hash(values, fields):
+    payload = json.dumps([_normalize(values.get(name)) for name in fields], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def stock_hash(values):
+    """銘柄の行の内容ハッシュ"""
+    return _hash(values, STOCK_FIELDS)
+
+
+def annual_hash(values):
+    """年次データの行の内容ハッシュ（年度を含む）"""
+    return _hash(values, ANNUAL_FIELDS)
+
+
+def empty_counts():
+    """年次データの書き込み件数（追加・更新・変更なし・削除）"""
+    return {'inserted': 0, 'updated': 0, 'skipped': 0, 'deleted': 0}
@@ -1,19 +1,334 @@
 #!/usr/bin/env python3
 import sqlite3
 import json
+import time
+import threading
 from datetime import datetime
 import os
+import metrics
+import aggregates
+import fx_rates
+import stock_history
+import content_hash
+import db_backend
+
+# SQLITE_MODE=production で有効になるチューニング設定
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', '5'))
+SQLITE_CACHED_STATEMENTS = int(os.environ.get('SQLITE_CACHED_STATEMENTS', '256'))
+
+# スレッドごとの永続コネクション（db_path → コネクション）
+_thread_local = threading.local()
+
+# テーブル初期化済みのdb_path
+_initialized_paths = set()
+_init_lock = threading.Lock()
+
+class _TimedCursor(sqlite3.Cursor):
+    """クエリ実行時間を計測するカーソル"""
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.db_query_duration.observe(
+                time.perf_counter() - start, backend='sqlite', operation=metrics.sql_operation(sql))
+    
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.db_query_duration.observe(
+                time.perf_counter() - start, backend='sqlite', operation=metrics.sql_operation(sql))
+
+class _TimedConnection(sqlite3.Connection):
+    """計測付きカーソルを返すコネクション"""
+    
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+def _apply_stats_delta(cursor, stock_delta=0, annual_delta=0, country_delta=0, last_updated=None):
+    """統計サマリーを差分で更新（呼び出し元のトランザクション内で実行）"""
+    cursor.execute('''
+        UPDATE stats_summary SET
+            stock_count = stock_count + ?,
+            annual_data_count = annual_data_count + ?,
+            country_count = country_count + ?,
+            data_version = data_version + 1,
+            last_updated = CASE
+                WHEN ? IS NOT NULL AND (last_updated IS NULL OR last_updated < ?) THEN ?
+                ELSE last_updated
+            END
+        WHERE id = 1
+    ''', (stock_delta, annual_delta, country_delta, last_updated, last_updated, last_updated))
+
+def _change_country_count(cursor, country, delta):
+    """国別銘柄数を増減し、country_countの増減（+1/0/-1）を返す"""
+    if not country:
+        return 0
+    
+    if delta > 0:
+        cursor.execute('''
+            INSERT INTO stats_country_counts (country, stock_count) VALUES (?, 1)
+            ON CONFLICT (country) DO UPDATE SET stock_count = stock_count + 1
+        ''', (country,))
+        cursor.execute('SELECT stock_count FROM stats_country_counts WHERE country = ?', (country,))
+        return 1 if cursor.fetchone()[0] == 1 else 0
+    
+    cursor.execute('UPDATE stats_country_counts SET stock_count = stock_count - 1 WHERE country = ?', (country,))
+    cursor.execute('SELECT stock_count FROM stats_country_counts WHERE country = ?', (country,))
+    row = cursor.fetchone()
+    if row is not None and row[0] <= 0:
+        cursor.execute('DELETE FROM stats_country_counts WHERE country = ?', (country,))
+        return -1
+    return 0
+
+def _parse_timestamp(value):
+    """インポートされたISO形式の日時をdatetimeに変換（保存時と同じ形式で格納するため）"""
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    return value
+
+# stocksテーブルに後から追加したカラム（CREATE TABLEと同じ順）
+_ADDED_STOCK_COLUMNS = [('sector', 'TEXT'), ('industry', 'TEXT'), ('fx_rate_usd', 'REAL')] + [
+    (fx_rates.usd_column(name), 'REAL') for name in fx_rates.USD_STOCK_COLUMNS
+] + [('content_hash', 'TEXT'), ('checked_at', 'TIMESTAMP'), ('financial_currency', 'TEXT'), ('financial_fx_rate_usd', 'REAL')]
+
+def _fx_rates(cursor):
+    """登録済みのUSDレート {通貨: レート}"""
+    cursor.execute('SELECT currency, usd_rate FROM fx_rates')
+    return dict(cursor.fetchall())
+
+def _annual_usd_params(values, rate):
+    """年次データのUSD換算カラムの値（INSERT文のカラム順）"""
+    converted = fx_rates.usd_values(values, fx_rates.USD_ANNUAL_COLUMNS, rate)
+    return tuple(converted[fx_rates.usd_column(name)] for name in fx_rates.USD_ANNUAL_COLUMNS)
+
+_ANNUAL_USD_COLUMNS = [fx_rates.usd_column(name) for name in fx_rates.USD_ANNUAL_COLUMNS]
+
+# 年次データの書き込み（ハッシュの対象のカラム、USD換算カラム、内容ハッシュの順）
+_ANNUAL_WRITE_COLUMNS = list(content_hash.ANNUAL_FIELDS) + _ANNUAL_USD_COLUMNS + ['content_hash']
+_ANNUAL_INSERT_SQL = f'''
+    INSERT INTO annual_data (stock_id, {', '.join(_ANNUAL_WRITE_COLUMNS)})
+    VALUES (?, {', '.join('?' * len(_ANNUAL_WRITE_COLUMNS))})
+'''
+_ANNUAL_UPDATE_SQL = f'''
+    UPDATE annual_data SET {', '.join(f'{column} = ?' for column in _ANNUAL_WRITE_COLUMNS)} WHERE id = ?
+'''
+_ANNUAL_RECONVERT_SQL = f'''
+    UPDATE annual_data SET {', '.join(f'{fx_rates.usd_column(name)} = {name} * :rate' for name in fx_rates.USD_ANNUAL_COLUMNS)}
+    WHERE stock_id = :stock_id
+'''
+
+def _sync_annual_rows(cursor, stock_id, rows, rate):
+    """年次データを年度ごとに内容ハッシュで比べ、変わった行だけ書き込む（返り値: 件数）"""
+    cursor.execute('SELECT id, year, content_hash FROM annual_data WHERE stock_id = ? ORDER BY id', (stock_id,))
+    existing = {}
+    stale_ids = []
+    for row_id, year, row_hash in cursor.fetchall():
+        if year in existing:
+            # 同じ年度の重複行は削除する
+            stale_ids.append(row_id)
+        else:
+            existing[year] = (row_id, row_hash)
+    
+    counts = content_hash.empty_counts()
+    for row in rows:
+        row_hash = content_hash.annual_hash(row)
+        params = (*(row.get(name) for name in content_hash.ANNUAL_FIELDS), *_annual_usd_params(row, rate), row_hash)
+        current = existing.pop(row.get('year'), None)
+        if current is None:
+            cursor.execute(_ANNUAL_INSERT_SQL, (stock_id, *params))
+            counts['inserted'] += 1
+        elif current[1] == row_hash:
+            counts['skipped'] += 1
+        else:
+            cursor.execute(_ANNUAL_UPDATE_SQL, (*params, current[0]))
+            counts['updated'] += 1
+    
+    # 入力にない年度は削除
+    stale_ids += [row_id for row_id, _ in existing.values()]
+    if stale_ids:
+        cursor.executemany('DELETE FROM annual_data WHERE id = ?', [(row_id,) for row_id in stale_ids])
+        counts['deleted'] = len(stale_ids)
+    return counts
+
+def _write_stock(cursor, ticker, values, annual_rows, last_updated, rates):
+    """銘柄と年次データを、内容ハッシュが変わった行だけ書き込む
+    
+    values は content_hash.STOCK_FIELDS の値、rates は fx_rates.stock_rates の換算レート。
+    年次データだけが変わった場合も最終更新日時は更新する。
+    返り値: (銘柄の状態 'inserted' / 'updated' / 'skipped', country_countの増減, 年次データの件数)
+    """
+    price_rate, market_cap_rate, annual_rate = rates
+    stock_hash = content_hash.stock_hash(values)
+    cursor.execute('SELECT id, country, content_hash, financial_fx_rate_usd FROM stocks WHERE ticker = ?', (ticker,))
+    existing = cursor.fetchone()
+    
+    country_delta = 0
+    if existing is not None and existing[2] == stock_hash:
+        status = 'skipped'
+    else:
+        # 銘柄基本情報を保存または更新（IDを変えないようにUPSERT）
+        cursor.execute('''
+            INSERT INTO stocks 
+            (ticker, company_name, country, currency, current_price, market_cap, current_dividend_yield,
+             sector, industry, financial_currency, last_updated, fx_rate_usd, financial_fx_rate_usd,
+             current_price_usd, market_cap_usd, content_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (ticker) DO UPDATE SET
+                company_name = excluded.company_name, country = excluded.country,
+                currency = excluded.currency, current_price = excluded.current_price,
+                market_cap = excluded.market_cap, current_dividend_yield = excluded.current_dividend_yield,
+                sector = excluded.sector, industry = excluded.industry,
+                financial_currency = excluded.financial_currency,
+                last_updated = excluded.last_updated, fx_rate_usd = excluded.fx_rate_usd,
+                financial_fx_rate_usd = excluded.financial_fx_rate_usd,
+                current_price_usd = excluded.current_price_usd, market_cap_usd = excluded.market_cap_usd,
+                content_hash = excluded.content_hash
+        ''', (
+            ticker,
+            *(values[name] for name in content_hash.STOCK_FIELDS),
+            last_updated,
+            price_rate,
+            annual_rate,
+            fx_rates.to_usd(values['current_price'], price_rate),
+            fx_rates.to_usd(values['market_cap'], market_cap_rate),
+            stock_hash
+        ))
+        if existing is None:
+            status = 'inserted'
+            country_delta = _change_country_count(cursor, values['country'], +1)
+            cursor.execute('DELETE FROM stock_tombstones WHERE ticker = ?', (ticker,))
+        else:
+            status = 'updated'
+            if existing[1] != values['country']:
+                country_delta = _change_country_count(cursor, existing[1], -1) + _change_country_count(cursor, values['country'], +1)
+    
+    cursor.execute('SELECT id FROM stocks WHERE ticker = ?', (ticker,))
+    stock_id = cursor.fetchone()[0]
+    if status == 'updated' and existing[3] != annual_rate:
+        # 財務諸表の通貨が変わったら、内容の変わらない年次データもUSD換算をやり直す
+        cursor.execute(_ANNUAL_RECONVERT_SQL, {'rate': annual_rate, 'stock_id': stock_id})
+    counts = _sync_annual_rows(cursor, stock_id, annual_rows, annual_rate)
+    if status == 'skipped' and (counts['inserted'] or counts['updated'] or counts['deleted']):
+        cursor.execute('UPDATE stocks SET last_updated = ? WHERE id = ?', (last_updated, stock_id))
+        status = 'updated'
+    return status, country_delta, counts
+
+def _append_history(cursor, snapshots):
+    """履歴を追記（(ticker, as_of, 値) のリスト。直前の履歴と同じ値のものは省いてまとめて書き込む）"""
+    rows = []
+    for ticker, as_of, values in snapshots:
+        cursor.execute(stock_history.previous_sql(), {'ticker': ticker, 'as_of': as_of})
+        if not stock_history.unchanged(cursor.fetchone(), values):
+            rows.append(stock_history.insert_params(ticker, as_of, values))
+    if rows:
+        cursor.executemany(stock_history.insert_sql(), rows)
+
+def _delete_stock(cursor, ticker, deleted_at, keep_newer=False):
+    """銘柄と年次データを削除し、削除の記録（tombstone）を残す
+    
+    keep_newer=True（同期のインポート用）なら、deleted_at より後に更新された銘柄は削除せず、
+    銘柄がなくても記録は残す（さらに別のインスタンスへ同期できるように）。
+    返り値: 削除した場合は (年次データの件数, country_countの増減, 銘柄の最終更新日時)、しなかった場合はNone
+    """
+    cursor.execute('SELECT id, country, last_updated FROM stocks WHERE ticker = ?', (ticker,))
+    existing = cursor.fetchone()
+    if existing is None and not keep_newer:
+        return None
+    if existing is not None and keep_newer and existing[2] is not None and _parse_timestamp(existing[2]) > deleted_at:
+        return None
+    
+    cursor.execute('''
+        INSERT INTO stock_tombstones (ticker, deleted_at) VALUES (?, ?)
+        ON CONFLICT (ticker) DO UPDATE SET deleted_at = CASE
+            WHEN excluded.deleted_at > stock_tombstones.deleted_at THEN excluded.deleted_at
+            ELSE stock_tombstones.deleted_at
+        END
+    ''', (ticker, deleted_at))
+    if existing is None:
+        return None
+    
+    cursor.execute('DELETE FROM annual_data WHERE stock_id = ?', (existing[0],))
+    annual_rows = cursor.rowcount
+    cursor.execute('DELETE FROM stocks WHERE id = ?', (existing[0],))
+    return annual_rows, _change_country_count(cursor, existing[1], -1), existing[2]
+
+def _refresh_last_updated(cursor):
+    """最終更新日時をインデックスから再取得（最新の銘柄が削除・変更された場合）"""
+    cursor.execute('UPDATE stats_summary SET last_updated = (SELECT MAX(last_updated) FROM stocks) WHERE id = 1')
 
 class StockDatabase:
-    """株式分析データベースクラス"""
+    """株式分析データベースクラス
+    
+    mode='production'（または環境変数 SQLITE_MODE=production）では、スレッドごとに
+    永続コネクションを保持し、WALジャーナル・synchronous=NORMAL・mmapを有効にする。
+    """
+    
+    def __init__(self, db_path=None, mode=None):
+        self.db_path = db_path or os.environ.get('SQLITE_PATH', 'stock_analysis.db')
+        self.mode = mode or os.environ.get('SQLITE_MODE', 'default')
+        self.production = self.mode == 'production'
+        
+        # テーブル作成はプロセス内でパスごとに一度だけ
+        with _init_lock:
+            if self.db_path not in _initialized_paths:
+                self.init_database()
+                _initialized_paths.add(self.db_path)
+    
+    def _open_connection(self):
+        """新しいコネクションを作成"""
+        if not self.production:
+            return sqlite3.connect(self.db_path, factory=_TimedConnection)
+        
+        # 書き込みトランザクションは開始時にロックを取得し、
+        # 読み取り後の書き込み昇格でSQLITE_BUSYになるのを避ける
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            cached_statements=SQLITE_CACHED_STATEMENTS,
+            isolation_level='IMMEDIATE',
+            factory=_TimedConnection
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        conn.execute(f'PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    def _connect(self):
+        """コネクションを取得（productionモードではスレッドごとに再利用）"""
+        if not self.production:
+            return self._open_connection()
+        
+        connections = getattr(_thread_local, 'connections', None)
+        if connections is None:
+            connections = _thread_local.connections = {}
+        
+        conn = connections.get(self.db_path)
+        if conn is None:
+            conn = self._open_connection()
+            connections[self.db_path] = conn
+        return conn
     
-    def __init__(self, db_path="stock_analysis.db"):
-        self.db_path = db_path
-        self.init_database()
+    def _release(self, conn):
+        """コネクションを返却（productionモードでは閉じずに保持）"""
+        if not self.production:
+            conn.close()
+        elif conn.in_transaction:
+            # 例外などで残ったトランザクションを次の利用者に持ち越さない
+            conn.rollback()
     
     def init_database(self):
         """データベースとテーブルを初期化"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         # 銘柄基本情報テーブル
@@ -27,10 +342,31 @@ class StockDatabase:
                 current_price REAL,
                 market_cap REAL,
                 current_dividend_yield REAL,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                sector TEXT,
+                industry TEXT,
+                fx_rate_usd REAL,
+                current_price_usd REAL,
+                market_cap_usd REAL,
+                content_hash TEXT,
+                checked_at TIMESTAMP,
+                financial_currency TEXT,
+                financial_fx_rate_usd REAL
             )
         ''')
         
+        # 既存テーブルに後から追加したカラムを補う
+        cursor.execute('PRAGMA table_info(stocks)')
+        stock_columns = {row[1] for row in cursor.fetchall()}
+        added_columns = [
+            (column, column_type)
+            for column, column_type in _ADDED_STOCK_COLUMNS
+            if column not in stock_columns
+        ]
+        for column, column_type in added_columns:
+            cursor.execute(f'ALTER TABLE stocks ADD COLUMN {column} {column_type}')
+            print(f"  カラム追加: stocks.{column}")
+        
         # 年次分析データテーブル
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS annual_data (
@@ -54,47 +390,133 @@ class StockDatabase:
                 net_income REAL,
                 total_assets REAL,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                total_revenue_usd REAL,
+                operating_cash_flow_usd REAL,
+                dividend_amount_usd REAL,
+                buyback_amount_usd REAL,
+                capex_amount_usd REAL,
+                debt_issuance_usd REAL,
+                debt_repayment_usd REAL,
+                net_income_usd REAL,
+                total_assets_usd REAL,
+                content_hash TEXT,
                 FOREIGN KEY (stock_id) REFERENCES stocks (id)
             )
         ''')
         
+        cursor.execute('PRAGMA table_info(annual_data)')
+        annual_columns = {row[1] for row in cursor.fetchall()}
+        for name in fx_rates.USD_ANNUAL_COLUMNS:
+            column = fx_rates.usd_column(name)
+            if column not in annual_columns:
+                cursor.execute(f'ALTER TABLE annual_data ADD COLUMN {column} REAL')
+                print(f"  カラム追加: annual_data.{column}")
+                added_columns.append((column, 'REAL'))
+        if 'content_hash' not in annual_columns:
+            cursor.execute('ALTER TABLE annual_data ADD COLUMN content_hash TEXT')
+            print("  カラム追加: annual_data.content_hash")
+        
+        # 為替レート（1通貨単位あたりの米ドル）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fx_rates (
+                currency TEXT PRIMARY KEY,
+                usd_rate REAL NOT NULL,
+                updated_at TIMESTAMP
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO fx_rates (currency, usd_rate) VALUES ('USD', 1.0)")
+        
+        # 分析値の履歴（追記のみ。主キー順に格納し、銘柄・期間の読み取りは主キーの範囲を読む）
+        metric_columns = ''.join(
+            f"                {name} {'INTEGER' if name == 'fiscal_year' else 'REAL'},\n"
+            for name in stock_history.HISTORY_METRICS
+        )
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS stock_history (
+                ticker TEXT NOT NULL,
+                as_of TIMESTAMP NOT NULL,
+{metric_columns}                PRIMARY KEY (ticker, as_of)
+            ) WITHOUT ROWID
+        ''')
+        
+        # 削除した銘柄の記録（差分エクスポートで削除を伝えるため）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_tombstones (
+                ticker TEXT PRIMARY KEY,
+                deleted_at TIMESTAMP NOT NULL
+            )
+        ''')
+        
+        # 統計サマリーテーブル（1行のみ、書き込み時に更新）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_summary (
+                id INTEGER PRIMARY KEY,
+                stock_count INTEGER NOT NULL DEFAULT 0,
+                annual_data_count INTEGER NOT NULL DEFAULT 0,
+                country_count INTEGER NOT NULL DEFAULT 0,
+                last_updated TIMESTAMP,
+                data_version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
+        # 国別の銘柄数（country_countの増減判定用）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_country_counts (
+                country TEXT PRIMARY KEY,
+                stock_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        
         # インデックス作成
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_ticker ON stocks(ticker)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_stock_year ON annual_data(stock_id, year)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_last_updated ON stocks(last_updated)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tombstones_deleted_at ON stock_tombstones(deleted_at)')
+        for index_name, table, columns in fx_rates.usd_indexes():
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table}({", ".join(columns)})')
+        
+        # USD換算カラムを追加した既存データは、現在のレートで換算しておく
+        if any(column.endswith('_usd') for column, _ in added_columns):
+            for statement in fx_rates.renormalize_sql():
+                cursor.execute(statement)
+        
+        # サマリーが未作成（既存DBの初回起動）なら集計して作成
+        cursor.execute('SELECT 1 FROM stats_summary WHERE id = 1')
+        if cursor.fetchone() is None:
+            self._rebuild_stats_summary(cursor)
+            print("統計サマリーを作成しました")
         
         conn.commit()
-        conn.close()
+        self._release(conn)
     
     def save_stock_analysis(self, analysis_data):
-        """分析データをデータベースに保存"""
-        conn = sqlite3.connect(self.db_path)
+        """分析データをデータベースに保存（保存済みの内容と同じ行は書き込まない）
+        
+        返り値: {'status': 銘柄の状態（inserted / updated / skipped）, 'annual': 年次データの件数}
+        """
+        conn = self._connect()
         cursor = conn.cursor()
         
         try:
-            # 銘柄基本情報を保存または更新
-            cursor.execute('''
-                INSERT OR REPLACE INTO stocks 
-                (ticker, company_name, country, currency, current_price, market_cap, current_dividend_yield, last_updated)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                analysis_data['ticker'],
-                analysis_data['company_name'],
-                analysis_data.get('country', 'N/A'),
-                analysis_data.get('currency', 'USD'),
-                analysis_data['current_price'],
-                analysis_data['market_cap'],
-                analysis_data['current_dividend_yield'],
-                datetime.now()
-            ))
-            
-            # 銘柄IDを取得
-            cursor.execute('SELECT id FROM stocks WHERE ticker = ?', (analysis_data['ticker'],))
-            stock_id = cursor.fetchone()[0]
-            
-            # 既存の年次データを削除（更新のため）
-            cursor.execute('DELETE FROM annual_data WHERE stock_id = ?', (stock_id,))
+            now = datetime.now()
+            ticker = analysis_data['ticker']
+            currency = analysis_data.get('currency', 'USD')
+            financial_currency = analysis_data.get('financial_currency')
+            rates = fx_rates.stock_rates(_fx_rates(cursor), currency, financial_currency)
+            values = {
+                'company_name': analysis_data['company_name'],
+                'country': analysis_data.get('country', 'N/A'),
+                'currency': currency,
+                'current_price': analysis_data['current_price'],
+                'market_cap': analysis_data['market_cap'],
+                'current_dividend_yield': analysis_data['current_dividend_yield'],
+                'sector': analysis_data.get('sector'),
+                'industry': analysis_data.get('industry'),
+                'financial_currency': financial_currency
+            }
             
-            # 年次データを保存
+            # 年度ごとの年次データ
+            annual_rows = []
             for return_data in analysis_data['total_returns']['annual_returns']:
                 year = return_data['year']
                 
@@ -121,48 +543,60 @@ class StockDatabase:
                 if analysis_data.get('roi_data'):
                     roi_data = next((r for r in analysis_data['roi_data']['annual_data'] if r['year'] == year), None)
                 
-                cursor.execute('''
-                    INSERT INTO annual_data (
-                        stock_id, year, total_revenue, operating_cash_flow, ocf_ratio,
-                        dividend_amount, dividend_yield, buyback_amount, buyback_yield,
-                        capex_amount, capex_yield, debt_issuance, debt_repayment, roi,
-                        total_return_without_capex, total_return_with_capex,
-                        net_income, total_assets
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    stock_id,
-                    year,
-                    revenue_data['total_revenue'] if revenue_data else 0,
-                    revenue_data['operating_cash_flow'] if revenue_data else 0,
-                    revenue_data['ocf_ratio'] if revenue_data else 0,
-                    return_data['dividend_amount'],
-                    return_data['dividend_yield'],
-                    buyback_data['amount'] if buyback_data else 0,
-                    return_data['buyback_yield'],
-                    capex_data['amount'] if capex_data else 0,
-                    capex_data['yield'] if capex_data else 0,
-                    debt_issuance_data['amount'] if debt_issuance_data else 0,
-                    debt_repayment_data['amount'] if debt_repayment_data else 0,
-                    roi_data['roi'] if roi_data else 0,
-                    return_data.get('total_return_without_capex', 0),
-                    return_data.get('total_return_with_capex', return_data['total_return']),
-                    roi_data['net_income'] if roi_data else 0,
-                    roi_data['total_assets'] if roi_data else 0
-                ))
+                annual_values = {
+                    'year': year,
+                    'total_revenue': revenue_data['total_revenue'] if revenue_data else 0,
+                    'operating_cash_flow': revenue_data['operating_cash_flow'] if revenue_data else 0,
+                    'ocf_ratio': revenue_data['ocf_ratio'] if revenue_data else 0,
+                    'dividend_amount': return_data['dividend_amount'],
+                    'dividend_yield': return_data['dividend_yield'],
+                    'buyback_amount': buyback_data['amount'] if buyback_data else 0,
+                    'buyback_yield': return_data['buyback_yield'],
+                    'capex_amount': capex_data['amount'] if capex_data else 0,
+                    'capex_yield': capex_data['yield'] if capex_data else 0,
+                    'debt_issuance': debt_issuance_data['amount'] if debt_issuance_data else 0,
+                    'debt_repayment': debt_repayment_data['amount'] if debt_repayment_data else 0,
+                    'roi': roi_data['roi'] if roi_data else 0,
+                    'total_return_without_capex': return_data.get('total_return_without_capex', 0),
+                    'total_return_with_capex': return_data.get('total_return_with_capex', return_data['total_return']),
+                    'net_income': roi_data['net_income'] if roi_data else 0,
+                    'total_assets': roi_data['total_assets'] if roi_data else 0
+                }
+                annual_rows.append(annual_values)
+            
+            status, country_delta, counts = _write_stock(cursor, ticker, values, annual_rows, now, rates)
+            # 取得して確かめた日時（内容が変わらず書き込みを省いた場合も更新する）
+            cursor.execute('UPDATE stocks SET checked_at = ? WHERE ticker = ?', (now, ticker))
+            
+            if status == 'skipped':
+                conn.commit()
+                print(f"✅ {ticker} は保存済みのデータと同じため、書き込みを省略しました")
+                return {'status': status, 'annual': counts}
+            
+            # 履歴を同じトランザクションで追記
+            _append_history(cursor, [(ticker, now, stock_history.snapshot_values({
+                **values, 'market_cap_usd': fx_rates.to_usd(values['market_cap'], rates[1])
+            }, annual_rows))])
+            
+            # 統計サマリーを同じトランザクションで更新
+            _apply_stats_delta(
+                cursor, 1 if status == 'inserted' else 0, counts['inserted'] - counts['deleted'], country_delta, now
+            )
             
             conn.commit()
-            print(f"✅ {analysis_data['ticker']} のデータをデータベースに保存しました")
+            print(f"✅ {ticker} のデータをデータベースに保存しました")
+            return {'status': status, 'annual': counts}
             
         except Exception as e:
             conn.rollback()
             print(f"❌ データベース保存エラー: {e}")
             raise
         finally:
-            conn.close()
+            self._release(conn)
     
     def get_all_stocks(self):
         """保存されている全銘柄を取得"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -176,12 +610,12 @@ class StockDatabase:
                   'market_cap', 'current_dividend_yield', 'last_updated']
         stocks = [dict(zip(columns, row)) for row in cursor.fetchall()]
         
-        conn.close()
+        self._release(conn)
         return stocks
     
     def get_stock_analysis(self, ticker):
         """特定銘柄の分析データを取得"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         # 銘柄基本情報を取得
@@ -189,7 +623,7 @@ class StockDatabase:
         stock_row = cursor.fetchone()
         
         if not stock_row:
-            conn.close()
+            self._release(conn)
             return None
         
         # 年次データを取得
@@ -200,7 +634,7 @@ class StockDatabase:
         ''', (ticker,))
         
         annual_rows = cursor.fetchall()
-        conn.close()
+        self._release(conn)
         
         if not annual_rows:
             return None
@@ -214,7 +648,14 @@ class StockDatabase:
             'current_price': stock_row[5],
             'market_cap': stock_row[6],
             'current_dividend_yield': stock_row[7],
+            'sector': stock_row[9],
+            'industry': stock_row[10],
             'last_updated': stock_row[8],
+            'fx_rate_usd': stock_row[11],
+            'current_price_usd': stock_row[12],
+            'market_cap_usd': stock_row[13],
+            'financial_currency': stock_row[16],
+            'financial_fx_rate_usd': stock_row[17],
             'annual_data': []
         }
         
@@ -238,24 +679,27 @@ class StockDatabase:
                 'net_income': row[17],
                 'total_assets': row[18]
             }
+            annual_data.update(zip(_ANNUAL_USD_COLUMNS, row[20:20 + len(_ANNUAL_USD_COLUMNS)]))
             stock_data['annual_data'].append(annual_data)
         
         return stock_data
     
     def delete_stock(self, ticker):
         """銘柄をデータベースから削除"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         try:
-            # 年次データを削除
-            cursor.execute('''
-                DELETE FROM annual_data 
-                WHERE stock_id = (SELECT id FROM stocks WHERE ticker = ?)
-            ''', (ticker,))
+            deleted = _delete_stock(cursor, ticker, datetime.now())
             
-            # 銘柄基本情報を削除
-            cursor.execute('DELETE FROM stocks WHERE ticker = ?', (ticker,))
+            # 統計サマリーを同じトランザクションで更新
+            if deleted:
+                annual_rows, country_delta, last_updated = deleted
+                _apply_stats_delta(cursor, -1, -annual_rows, country_delta)
+                cursor.execute('SELECT last_updated FROM stats_summary WHERE id = 1')
+                latest = cursor.fetchone()[0]
+                if latest is not None and last_updated is not None and last_updated >= latest:
+                    _refresh_last_updated(cursor)
             
             conn.commit()
             print(f"✅ {ticker} をデータベースから削除しました")
@@ -265,47 +709,245 @@ class StockDatabase:
             print(f"❌ データベース削除エラー: {e}")
             raise
         finally:
-            conn.close()
+            self._release(conn)
     
     def get_database_stats(self):
-        """データベースの統計情報を取得"""
-        conn = sqlite3.connect(self.db_path)
+        """データベースの統計情報を取得（サマリーテーブルから1行読むだけ）"""
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT COUNT(*) FROM stocks')
-        stock_count = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM annual_data')
-        annual_data_count = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(DISTINCT country) FROM stocks')
-        country_count = cursor.fetchone()[0]
+        cursor.execute('''
+            SELECT stock_count, annual_data_count, country_count, last_updated
+            FROM stats_summary WHERE id = 1
+        ''')
+        row = cursor.fetchone()
         
-        cursor.execute('SELECT MAX(last_updated) FROM stocks')
-        last_updated = cursor.fetchone()[0]
+        self._release(conn)
         
-        conn.close()
+        if row is None:
+            return self.rebuild_stats_summary()
         
         return {
-            'stock_count': stock_count,
-            'annual_data_count': annual_data_count,
-            'country_count': country_count,
-            'last_updated': last_updated
+            'stock_count': row[0],
+            'annual_data_count': row[1],
+            'country_count': row[2],
+            'last_updated': row[3]
         }
     
-    def export_database(self):
-        """データベース全体をJSONファイルとしてエクスポート"""
-        conn = sqlite3.connect(self.db_path)
+    def cache_namespace(self):
+        """共有キャッシュのキーに含めるデータベースの識別子"""
+        return db_backend.cache_namespace('sqlite', os.path.abspath(self.db_path), local=True)
+    
+    def get_data_version(self):
+        """書き込みのたびに増えるデータバージョンを取得（キャッシュの無効化判定用）"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT data_version FROM stats_summary WHERE id = 1')
+        row = cursor.fetchone()
+        
+        self._release(conn)
+        return row[0] if row else 0
+    
+    def rebuild_stats_summary(self):
+        """統計サマリーを全件集計から作り直す（管理コマンド用）"""
+        conn = self._connect()
         cursor = conn.cursor()
         
         try:
-            # 全銘柄の基本情報を取得
-            cursor.execute('''
+            self._rebuild_stats_summary(cursor)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ 統計サマリー再構築エラー: {e}")
+            raise
+        finally:
+            self._release(conn)
+        
+        return self.get_database_stats()
+    
+    def _rebuild_stats_summary(self, cursor):
+        """全件集計でサマリーと国別銘柄数を作り直す"""
+        cursor.execute('DELETE FROM stats_country_counts')
+        cursor.execute('''
+            INSERT INTO stats_country_counts (country, stock_count)
+            SELECT country, COUNT(*) FROM stocks WHERE country IS NOT NULL GROUP BY country
+        ''')
+        cursor.execute('''
+            INSERT INTO stats_summary (id, stock_count, annual_data_count, country_count, last_updated, data_version)
+            VALUES (
+                1,
+                (SELECT COUNT(*) FROM stocks),
+                (SELECT COUNT(*) FROM annual_data),
+                (SELECT COUNT(*) FROM stats_country_counts),
+                (SELECT MAX(last_updated) FROM stocks),
+                1
+            )
+            ON CONFLICT (id) DO UPDATE SET
+                stock_count = excluded.stock_count,
+                annual_data_count = excluded.annual_data_count,
+                country_count = excluded.country_count,
+                last_updated = excluded.last_updated,
+                data_version = stats_summary.data_version + 1
+        ''')
+    
+    def compute_aggregates(self, by):
+        """国・セクター・年度ごとの利回り集計をSQLで求める（キャッシュは aggregates.get_aggregates）"""
+        conn = self._connect()
+        
+        try:
+            summary_rows = conn.execute(aggregates.summary_sql(by)).fetchall()
+            return aggregates.rows_from_summary(
+                summary_rows,
+                lambda metric: conn.execute(aggregates.values_sql(by, metric))
+            )
+        finally:
+            self._release(conn)
+    
+    def get_fx_rates(self):
+        """登録済みの為替レート（通貨 -> 1通貨単位あたりの米ドル）"""
+        conn = self._connect()
+        
+        try:
+            return dict(conn.execute('SELECT currency, usd_rate FROM fx_rates ORDER BY currency').fetchall())
+        finally:
+            self._release(conn)
+    
+    def set_fx_rates(self, rates, replace=False):
+        """為替レートを登録し、同じトランザクションで全件のUSD換算をやり直す（replace時は未指定の通貨を削除）"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        try:
+            rates = fx_rates.expand_rates(rates)
+            if replace:
+                cursor.execute('DELETE FROM fx_rates')
+            now = datetime.now()
+            cursor.executemany('''
+                INSERT INTO fx_rates (currency, usd_rate, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT (currency) DO UPDATE SET usd_rate = excluded.usd_rate, updated_at = excluded.updated_at
+            ''', [(currency, rate, now) for currency, rate in rates.items()])
+            result = self._renormalize_usd(cursor)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ 為替レート登録エラー: {e}")
+            raise
+        finally:
+            self._release(conn)
+        
+        result['rate_count'] = len(rates)
+        return result
+    
+    def renormalize_usd(self):
+        """全銘柄・全年次データのUSD換算カラムを現在のレートで計算し直す"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        try:
+            result = self._renormalize_usd(cursor)
+            conn.commit()
+            return result
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ USD換算エラー: {e}")
+            raise
+        finally:
+            self._release(conn)
+    
+    def _renormalize_usd(self, cursor):
+        """renormalize_usd の本体（呼び出し元のトランザクション内で実行）"""
+        for statement in fx_rates.renormalize_sql():
+            cursor.execute(statement)
+        # 読み取りキャッシュ・スナップショットを作り直させる
+        _apply_stats_delta(cursor)
+        
+        cursor.execute('SELECT COUNT(*) FROM stocks WHERE fx_rate_usd IS NOT NULL AND financial_fx_rate_usd IS NOT NULL')
+        normalized = cursor.fetchone()[0]
+        cursor.execute(fx_rates.missing_currencies_sql())
+        missing = [row[0] for row in cursor.fetchall()]
+        return {'normalized_stock_count': normalized, 'missing_currencies': missing}
+    
+    def get_usd_ranking(self, metric, year=None, limit=fx_rates.DEFAULT_RANKING_LIMIT):
+        """USD換算した金額の上位銘柄（年次データの指標はyear年度、省略時は最新年度）"""
+        conn = self._connect()
+        
+        try:
+            sql = fx_rates.ranking_sql(metric)
+            params = {'limit': limit}
+            if metric in fx_rates.RANKED_ANNUAL_COLUMNS:
+                if year is None:
+                    year = conn.execute('SELECT MAX(year) FROM annual_data').fetchone()[0]
+                params['year'] = year
+            return fx_rates.ranking_result(metric, params.get('year'), conn.execute(sql, params).fetchall())
+        finally:
+            self._release(conn)
+    
+    def get_stock_history(self, ticker, start=None, end=None, names=stock_history.HISTORY_METRICS,
+                          limit=stock_history.HISTORY_MAX_POINTS):
+        """銘柄の分析値の履歴（start以上end未満、古い順）"""
+        conn = self._connect()
+        
+        try:
+            # 上限を超えたかを知るため1件多く読む
+            params = {'ticker': ticker, 'start': start, 'end': end, 'limit': limit + 1}
+            rows = conn.execute(stock_history.range_sql(start, end), params).fetchall()
+            before_row = conn.execute(stock_history.before_sql(), params).fetchone() if start else None
+            return stock_history.history_result(ticker, names, start, end, before_row, rows, limit)
+        finally:
+            self._release(conn)
+    
+    def get_portfolio_holdings(self, tickers):
+        """保有銘柄の情報と年次データの利回りをまとめて取得（返り値は portfolio.holdings_from_rows の形）"""
+        import portfolio
+        conn = self._connect()
+        
+        try:
+            stock_rows = []
+            annual_rows = []
+            for params in portfolio.query_chunks(tickers):
+                stock_rows += conn.execute(portfolio.stocks_sql(params), params).fetchall()
+                annual_rows += conn.execute(portfolio.annual_sql(params), params).fetchall()
+            return portfolio.holdings_from_rows(stock_rows, annual_rows)
+        finally:
+            self._release(conn)
+    
+    def mark_checked(self, tickers):
+        """銘柄を取得して確かめた日時を現在時刻にする（分析キャッシュから返した銘柄用。データバージョンは変えない）"""
+        if not tickers:
+            return
+        conn = self._connect()
+        
+        try:
+            now = datetime.now()
+            conn.executemany('UPDATE stocks SET checked_at = ? WHERE ticker = ?', [(now, ticker) for ticker in tickers])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ 確認日時の更新エラー: {e}")
+            raise
+        finally:
+            self._release(conn)
+    
+    def export_database(self, since=None):
+        """データベース全体をJSONファイルとしてエクスポート
+        
+        since（datetime）を指定すると、その後に更新された銘柄と、削除された銘柄（deleted）だけを返す。
+        export_info.next_since は次回の since に使う日時（読み出しを始めた時刻の少し前。次回と重なる変更もある）。
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        try:
+            # 次回の since は読み出しを始める前の時刻から決める
+            started = datetime.now()
+            # 全銘柄（since指定時は last_updated のインデックスで変更された銘柄だけ）の基本情報を取得
+            cursor.execute(f'''
                 SELECT ticker, company_name, country, currency, current_price, 
-                       market_cap, current_dividend_yield, last_updated
-                FROM stocks 
+                       market_cap, current_dividend_yield, last_updated, sector, industry, financial_currency
+                FROM stocks {'WHERE last_updated > ?' if since is not None else ''}
                 ORDER BY ticker
-            ''')
+            ''', () if since is None else (since,))
             stocks_data = cursor.fetchall()
             
             export_data = {
@@ -342,6 +984,9 @@ class StockDatabase:
                     'current_price': stock_row[4],
                     'market_cap': stock_row[5],
                     'current_dividend_yield': stock_row[6],
+                    'sector': stock_row[8],
+                    'industry': stock_row[9],
+                    'financial_currency': stock_row[10],
                     'last_updated': stock_row[7],
                     'annual_data': []
                 }
@@ -370,120 +1015,179 @@ class StockDatabase:
                 
                 export_data['stocks'].append(stock_data)
             
-            conn.close()
+            if since is not None:
+                cursor.execute(
+                    'SELECT ticker, deleted_at FROM stock_tombstones WHERE deleted_at > ? ORDER BY ticker', (since,)
+                )
+                deleted = [(ticker, _parse_timestamp(deleted_at)) for ticker, deleted_at in cursor.fetchall()]
+                export_data['deleted'] = [
+                    {'ticker': ticker, 'deleted_at': deleted_at.isoformat()} for ticker, deleted_at in deleted
+                ]
+                export_data['export_info'].update({
+                    'format_version': '1.1',
+                    'since': since.isoformat(),
+                    'next_since': db_backend.export_next_since(since, started).isoformat(),
+                    'total_deleted': len(deleted)
+                })
+            
+            self._release(conn)
             return export_data
             
         except Exception as e:
-            conn.close()
+            self._release(conn)
             raise Exception(f"エクスポートエラー: {str(e)}")
     
+    def iter_export_batches(self, batch_size=5000):
+        """全銘柄と年次データを銘柄ID順にバッチで取得（列指向エクスポート用）
+        
+        (銘柄の行リスト, 年次データの行リスト) を銘柄batch_size件ごとに返す。
+        年次データの行には銘柄のtickerが含まれる。
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        
+        stock_columns = ['ticker', 'company_name', 'country', 'currency', 'current_price',
+                         'market_cap', 'current_dividend_yield', 'last_updated', 'sector', 'industry',
+                         'fx_rate_usd', 'current_price_usd', 'market_cap_usd',
+                         'financial_currency', 'financial_fx_rate_usd']
+        annual_columns = ['year', 'total_revenue', 'operating_cash_flow', 'ocf_ratio',
+                          'dividend_amount', 'dividend_yield', 'buyback_amount', 'buyback_yield',
+                          'capex_amount', 'capex_yield', 'debt_issuance', 'debt_repayment', 'roi',
+                          'total_return_without_capex', 'total_return_with_capex',
+                          'net_income', 'total_assets'] + _ANNUAL_USD_COLUMNS
+        
+        try:
+            last_id = 0
+            while True:
+                cursor.execute(f'''
+                    SELECT id, {', '.join(stock_columns)}
+                    FROM stocks WHERE id > ? ORDER BY id LIMIT ?
+                ''', (last_id, batch_size))
+                stocks = cursor.fetchall()
+                if not stocks:
+                    break
+                
+                tickers = {row[0]: row[1] for row in stocks}
+                placeholders = ', '.join('?' * len(tickers))
+                cursor.execute(f'''
+                    SELECT stock_id, {', '.join(annual_columns)}
+                    FROM annual_data WHERE stock_id IN ({placeholders})
+                    ORDER BY stock_id, year DESC
+                ''', list(tickers))
+                
+                stock_batch = [dict(zip(stock_columns, row[1:])) for row in stocks]
+                annual_batch = []
+                for row in cursor.fetchall():
+                    item = dict(zip(annual_columns, row[1:]))
+                    item['ticker'] = tickers[row[0]]
+                    annual_batch.append(item)
+                
+                yield stock_batch, annual_batch
+                last_id = stocks[-1][0]
+        finally:
+            self._release(conn)
+    
     def import_database(self, import_data, clear_existing=False):
-        """JSONデータからデータベースをインポート"""
-        conn = sqlite3.connect(self.db_path)
+        """JSONデータからデータベースをインポート（保存済みの内容と同じ銘柄・年度は書き込まない）"""
+        conn = self._connect()
         cursor = conn.cursor()
         
         try:
             if clear_existing:
-                # 既存データを削除
+                # 既存データを削除（削除の記録も残す。インポートされる銘柄の記録は書き込み時に消える）
+                cursor.execute('''
+                    INSERT INTO stock_tombstones (ticker, deleted_at) SELECT ticker, ? FROM stocks WHERE true
+                    ON CONFLICT (ticker) DO UPDATE SET deleted_at = excluded.deleted_at
+                ''', (datetime.now(),))
                 cursor.execute('DELETE FROM annual_data')
                 cursor.execute('DELETE FROM stocks')
+                self._rebuild_stats_summary(cursor)
                 print("既存データを削除しました")
             
             imported_count = 0
             updated_count = 0
+            skipped_count = 0
+            country_delta = 0
+            annual_counts = content_hash.empty_counts()
+            
+            # USD換算のレートはまとめて1回読む
+            rates = _fx_rates(cursor)
+            
+            # 履歴は最後にまとめて追記する
+            snapshots = []
+            
+            # 差分エクスポートの削除を先に反映（削除後に更新された銘柄は残す。何度適用しても同じ結果になる）
+            deleted_count = 0
+            for item in import_data.get('deleted', []):
+                deleted = _delete_stock(cursor, item['ticker'], _parse_timestamp(item['deleted_at']), keep_newer=True)
+                if deleted:
+                    deleted_count += 1
+                    annual_counts['deleted'] += deleted[0]
+                    country_delta += deleted[1]
             
             for stock_data in import_data.get('stocks', []):
                 ticker = stock_data.get('ticker')
                 if not ticker:
                     continue
+                stock_rates = fx_rates.stock_rates(rates, stock_data.get('currency'), stock_data.get('financial_currency'))
                 
-                # 既存銘柄をチェック
-                cursor.execute('SELECT id FROM stocks WHERE ticker = ?', (ticker,))
-                existing = cursor.fetchone()
+                # 保存済みの内容と同じ銘柄・年度は書き込まない
+                status, delta, counts = _write_stock(
+                    cursor,
+                    ticker,
+                    {name: stock_data.get(name) for name in content_hash.STOCK_FIELDS},
+                    stock_data.get('annual_data', []),
+                    _parse_timestamp(stock_data.get('last_updated')),
+                    stock_rates
+                )
+                country_delta += delta
+                for key, count in counts.items():
+                    annual_counts[key] += count
                 
-                if existing:
-                    # 既存銘柄を更新
-                    cursor.execute('''
-                        UPDATE stocks SET 
-                        company_name = ?, country = ?, currency = ?, current_price = ?,
-                        market_cap = ?, current_dividend_yield = ?, last_updated = ?
-                        WHERE ticker = ?
-                    ''', (
-                        stock_data.get('company_name'),
-                        stock_data.get('country'),
-                        stock_data.get('currency'),
-                        stock_data.get('current_price'),
-                        stock_data.get('market_cap'),
-                        stock_data.get('current_dividend_yield'),
-                        stock_data.get('last_updated'),
-                        ticker
-                    ))
-                    stock_id = existing[0]
-                    updated_count += 1
-                else:
-                    # 新規銘柄を追加
-                    cursor.execute('''
-                        INSERT INTO stocks 
-                        (ticker, company_name, country, currency, current_price, market_cap, current_dividend_yield, last_updated)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        ticker,
-                        stock_data.get('company_name'),
-                        stock_data.get('country'),
-                        stock_data.get('currency'),
-                        stock_data.get('current_price'),
-                        stock_data.get('market_cap'),
-                        stock_data.get('current_dividend_yield'),
-                        stock_data.get('last_updated')
-                    ))
-                    stock_id = cursor.lastrowid
+                if status == 'skipped':
+                    skipped_count += 1
+                    continue
+                if status == 'inserted':
                     imported_count += 1
+                else:
+                    updated_count += 1
                 
-                # 既存の年次データを削除
-                cursor.execute('DELETE FROM annual_data WHERE stock_id = ?', (stock_id,))
-                
-                # 年次データをインポート
-                for annual_data in stock_data.get('annual_data', []):
-                    cursor.execute('''
-                        INSERT INTO annual_data (
-                            stock_id, year, total_revenue, operating_cash_flow, ocf_ratio,
-                            dividend_amount, dividend_yield, buyback_amount, buyback_yield,
-                            capex_amount, capex_yield, debt_issuance, debt_repayment, roi,
-                            total_return_without_capex, total_return_with_capex,
-                            net_income, total_assets
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        stock_id,
-                        annual_data.get('year'),
-                        annual_data.get('total_revenue'),
-                        annual_data.get('operating_cash_flow'),
-                        annual_data.get('ocf_ratio'),
-                        annual_data.get('dividend_amount'),
-                        annual_data.get('dividend_yield'),
-                        annual_data.get('buyback_amount'),
-                        annual_data.get('buyback_yield'),
-                        annual_data.get('capex_amount'),
-                        annual_data.get('capex_yield'),
-                        annual_data.get('debt_issuance'),
-                        annual_data.get('debt_repayment'),
-                        annual_data.get('roi'),
-                        annual_data.get('total_return_without_capex'),
-                        annual_data.get('total_return_with_capex'),
-                        annual_data.get('net_income'),
-                        annual_data.get('total_assets')
-                    ))
+                snapshots.append((
+                    ticker,
+                    _parse_timestamp(stock_data.get('last_updated')) or datetime.now(),
+                    stock_history.snapshot_values(
+                        {**stock_data, 'market_cap_usd': fx_rates.to_usd(stock_data.get('market_cap'), stock_rates[1])},
+                        stock_data.get('annual_data', [])
+                    )
+                ))
+            
+            _append_history(cursor, snapshots)
+            
+            # 統計サマリーを同じトランザクションで更新（インポートでは最終更新日時が古くなり得るので再取得）
+            # 何も変わらなければデータバージョンも上げない（読み取りキャッシュをそのまま使える）
+            if imported_count or updated_count or deleted_count:
+                _apply_stats_delta(
+                    cursor, imported_count - deleted_count, annual_counts['inserted'] - annual_counts['deleted'], country_delta
+                )
+                _refresh_last_updated(cursor)
             
             conn.commit()
-            conn.close()
+            self._release(conn)
             
             return {
                 'success': True,
                 'imported_count': imported_count,
                 'updated_count': updated_count,
-                'total_processed': imported_count + updated_count
+                'skipped_count': skipped_count,
+                'deleted_count': deleted_count,
+                'total_processed': imported_count + updated_count + skipped_count,
+                'annual_inserted_count': annual_counts['inserted'],
+                'annual_updated_count': annual_counts['updated'],
+                'annual_skipped_count': annual_counts['skipped'],
+                'annual_deleted_count': annual_counts['deleted']
             }
             
         except Exception as e:
             conn.rollback()
-            conn.close()
+            self._release(conn)
             raise Exception(f"インポートエラー: {str(e)}")
\ No newline at end of file
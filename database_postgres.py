@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
 import os
 import json
+import time
+import threading
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, text
+from sqlalchemy import create_engine, event, inspect, case, func, Index, Column, Integer, String, Float, DateTime, ForeignKey, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError
+from sqlalchemy.pool import QueuePool
+import metrics
+import aggregates
+import db_backend
+import fx_rates
+import stock_history
+import content_hash
 
 Base = declarative_base()
 
@@ -21,10 +30,27 @@ class Stock(Base):
     current_price = Column(Float)
     market_cap = Column(Float)
     current_dividend_yield = Column(Float)
-    last_updated = Column(DateTime, default=datetime.now)
+    last_updated = Column(DateTime, default=datetime.now, index=True)
+    sector = Column(String(100))
+    industry = Column(String(100))
+    # USD換算（fx_rate_usd は換算に使った1通貨単位あたりの米ドル、未登録の通貨ならNULL）
+    fx_rate_usd = Column(Float)
+    current_price_usd = Column(Float)
+    market_cap_usd = Column(Float)
+    # 入力された値の内容ハッシュ（変更のない書き込みを省くため）
+    content_hash = Column(String(32))
+    # 取得して確かめた日時（内容が変わらず書き込みを省いた場合も更新する。last_updated は内容が変わった日時）
+    checked_at = Column(DateTime)
+    # 財務諸表の通貨（取引通貨と異なることがある）と、年次データの換算に使ったレート
+    financial_currency = Column(String(10))
+    financial_fx_rate_usd = Column(Float)
     
     # リレーション
     annual_data = relationship("AnnualData", back_populates="stock", cascade="all, delete-orphan")
+    
+    __table_args__ = tuple(
+        Index(name, *columns) for name, table, columns in fx_rates.usd_indexes() if table == 'stocks'
+    )
 
 class AnnualData(Base):
     """年次分析データテーブル"""
@@ -50,16 +76,468 @@ class AnnualData(Base):
     net_income = Column(Float)
     total_assets = Column(Float)
     created_at = Column(DateTime, default=datetime.now)
+    total_revenue_usd = Column(Float)
+    operating_cash_flow_usd = Column(Float)
+    dividend_amount_usd = Column(Float)
+    buyback_amount_usd = Column(Float)
+    capex_amount_usd = Column(Float)
+    debt_issuance_usd = Column(Float)
+    debt_repayment_usd = Column(Float)
+    net_income_usd = Column(Float)
+    total_assets_usd = Column(Float)
+    content_hash = Column(String(32))
     
     # リレーション
     stock = relationship("Stock", back_populates="annual_data")
+    
+    __table_args__ = (
+        Index('idx_stock_year', 'stock_id', 'year'),
+        *(Index(name, *columns) for name, table, columns in fx_rates.usd_indexes() if table == 'annual_data')
+    )
+
+class StockTombstone(Base):
+    """削除した銘柄の記録（差分エクスポートで削除を伝えるため）"""
+    __tablename__ = 'stock_tombstones'
+    
+    ticker = Column(String(20), primary_key=True)
+    deleted_at = Column(DateTime, nullable=False, index=True)
+
+class FxRate(Base):
+    """為替レート（1通貨単位あたりの米ドル）"""
+    __tablename__ = 'fx_rates'
+    
+    currency = Column(String(10), primary_key=True)
+    usd_rate = Column(Float, nullable=False)
+    updated_at = Column(DateTime)
+
+class StockHistory(Base):
+    """分析値の履歴（追記のみ、値が変わった時点だけを持つ）"""
+    __tablename__ = 'stock_history'
+    
+    ticker = Column(String(20), primary_key=True)
+    as_of = Column(DateTime, primary_key=True)
+    fiscal_year = Column(Integer)
+    current_price = Column(Float)
+    market_cap = Column(Float)
+    market_cap_usd = Column(Float)
+    current_dividend_yield = Column(Float)
+    dividend_yield = Column(Float)
+    buyback_yield = Column(Float)
+    capex_yield = Column(Float)
+    total_return_without_capex = Column(Float)
+    total_return_with_capex = Column(Float)
+    
+    # SQLiteフォールバックでも主キー順に格納する
+    __table_args__ = {'sqlite_with_rowid': False}
+
+def _append_history(session, snapshots):
+    """履歴を追記（(ticker, as_of, 値) のリスト。直前の履歴と同じ値のものは省いてまとめて書き込む）"""
+    rows = []
+    for ticker, as_of, values in snapshots:
+        previous = session.execute(text(stock_history.previous_sql()), {'ticker': ticker, 'as_of': as_of}).fetchone()
+        if not stock_history.unchanged(previous, values):
+            rows.append(stock_history.insert_params(ticker, as_of, values))
+    if rows:
+        session.execute(text(stock_history.insert_sql()), rows)
+
+_ANNUAL_USD_COLUMNS = [fx_rates.usd_column(name) for name in fx_rates.USD_ANNUAL_COLUMNS]
+
+def _delete_stock(session, ticker, deleted_at, keep_newer=False):
+    """銘柄と年次データを削除し、削除の記録（tombstone）を残す
+    
+    keep_newer=True（同期のインポート用）なら、deleted_at より後に更新された銘柄は削除せず、
+    銘柄がなくても記録は残す（さらに別のインスタンスへ同期できるように）。
+    返り値: 削除した場合は (年次データの件数, country_countの増減, 銘柄の最終更新日時)、しなかった場合はNone
+    """
+    stock = session.query(Stock).filter_by(ticker=ticker).first()
+    if stock is None and not keep_newer:
+        return None
+    if stock is not None and keep_newer and stock.last_updated is not None and stock.last_updated > deleted_at:
+        return None
+    
+    session.execute(text('''
+        INSERT INTO stock_tombstones (ticker, deleted_at) VALUES (:ticker, :deleted_at)
+        ON CONFLICT (ticker) DO UPDATE SET deleted_at = CASE
+            WHEN excluded.deleted_at > stock_tombstones.deleted_at THEN excluded.deleted_at
+            ELSE stock_tombstones.deleted_at
+        END
+    '''), {'ticker': ticker, 'deleted_at': deleted_at})
+    if stock is None:
+        return None
+    
+    annual_rows = len(stock.annual_data)
+    country_delta = _change_country_count(session, stock.country, -1)
+    session.delete(stock)  # カスケード削除で年次データも削除
+    session.flush()
+    return annual_rows, country_delta, stock.last_updated
+
+def _sync_annual_rows(session, stock, rows, rate):
+    """年次データを年度ごとに内容ハッシュで比べ、変わった行だけ書き込む（返り値: 件数）"""
+    existing = {}
+    stale = []
+    for data in session.query(AnnualData).filter_by(stock_id=stock.id).order_by(AnnualData.id):
+        if data.year in existing:
+            # 同じ年度の重複行は削除する
+            stale.append(data)
+        else:
+            existing[data.year] = data
+    
+    counts = content_hash.empty_counts()
+    for row in rows:
+        row_hash = content_hash.annual_hash(row)
+        current = existing.pop(row.get('year'), None)
+        if current is not None and current.content_hash == row_hash:
+            counts['skipped'] += 1
+            continue
+        
+        values = {name: row.get(name) for name in content_hash.ANNUAL_FIELDS}
+        values.update(fx_rates.usd_values(row, fx_rates.USD_ANNUAL_COLUMNS, rate))
+        values['content_hash'] = row_hash
+        if current is None:
+            session.add(AnnualData(stock_id=stock.id, **values))
+            counts['inserted'] += 1
+        else:
+            for name, value in values.items():
+                setattr(current, name, value)
+            counts['updated'] += 1
+    
+    # 入力にない年度は削除
+    stale += existing.values()
+    for data in stale:
+        session.delete(data)
+    counts['deleted'] = len(stale)
+    return counts
+
+def _write_stock(session, ticker, values, annual_rows, last_updated, rates):
+    """銘柄と年次データを、内容ハッシュが変わった行だけ書き込む
+    
+    values は content_hash.STOCK_FIELDS の値、rates は fx_rates.stock_rates の換算レート。
+    年次データだけが変わった場合も最終更新日時は更新する
+    （last_updated がNoneなら、新規銘柄は現在時刻、既存銘柄は元の日時のまま）。
+    返り値: (銘柄, 銘柄の状態 'inserted' / 'updated' / 'skipped', country_countの増減, 年次データの件数)
+    """
+    price_rate, market_cap_rate, annual_rate = rates
+    stock_hash = content_hash.stock_hash(values)
+    stock = session.query(Stock).filter_by(ticker=ticker).first()
+    
+    country_delta = 0
+    if stock is not None and stock.content_hash == stock_hash:
+        status = 'skipped'
+    else:
+        if stock is None:
+            status = 'inserted'
+            old_country = None
+            session.query(StockTombstone).filter_by(ticker=ticker).delete(synchronize_session=False)
+            stock = Stock(ticker=ticker)
+            session.add(stock)
+        else:
+            status = 'updated'
+            old_country = stock.country
+        
+        for name in content_hash.STOCK_FIELDS:
+            setattr(stock, name, values[name])
+        if last_updated is not None:
+            stock.last_updated = last_updated
+        old_annual_rate = stock.financial_fx_rate_usd
+        stock.fx_rate_usd = price_rate
+        stock.financial_fx_rate_usd = annual_rate
+        stock.current_price_usd = fx_rates.to_usd(values['current_price'], price_rate)
+        stock.market_cap_usd = fx_rates.to_usd(values['market_cap'], market_cap_rate)
+        stock.content_hash = stock_hash
+        session.flush()  # IDを取得するため
+        
+        if status == 'updated' and old_annual_rate != annual_rate:
+            # 財務諸表の通貨が変わったら、内容の変わらない年次データもUSD換算をやり直す
+            session.query(AnnualData).filter_by(stock_id=stock.id).update({
+                getattr(AnnualData, fx_rates.usd_column(name)): getattr(AnnualData, name) * annual_rate
+                for name in fx_rates.USD_ANNUAL_COLUMNS
+            }, synchronize_session=False)
+        
+        if status == 'inserted':
+            country_delta = _change_country_count(session, stock.country, +1)
+        elif old_country != stock.country:
+            country_delta = _change_country_count(session, old_country, -1) + _change_country_count(session, stock.country, +1)
+    
+    counts = _sync_annual_rows(session, stock, annual_rows, annual_rate)
+    if status == 'skipped' and (counts['inserted'] or counts['updated'] or counts['deleted']):
+        if last_updated is not None:
+            stock.last_updated = last_updated
+        status = 'updated'
+    return stock, status, country_delta, counts
+
+# 列指向エクスポートで出力するカラム
+_EXPORT_STOCK_COLUMNS = [
+    Stock.ticker, Stock.company_name, Stock.country, Stock.currency, Stock.current_price,
+    Stock.market_cap, Stock.current_dividend_yield, Stock.last_updated, Stock.sector, Stock.industry,
+    Stock.fx_rate_usd, Stock.current_price_usd, Stock.market_cap_usd,
+    Stock.financial_currency, Stock.financial_fx_rate_usd
+]
+_EXPORT_ANNUAL_COLUMNS = [
+    AnnualData.year, AnnualData.total_revenue, AnnualData.operating_cash_flow, AnnualData.ocf_ratio,
+    AnnualData.dividend_amount, AnnualData.dividend_yield, AnnualData.buyback_amount, AnnualData.buyback_yield,
+    AnnualData.capex_amount, AnnualData.capex_yield, AnnualData.debt_issuance, AnnualData.debt_repayment,
+    AnnualData.roi, AnnualData.total_return_without_capex, AnnualData.total_return_with_capex,
+    AnnualData.net_income, AnnualData.total_assets
+] + [getattr(AnnualData, column) for column in _ANNUAL_USD_COLUMNS]
+
+class StatsSummary(Base):
+    """統計情報のサマリーテーブル（1行のみ、書き込み時に更新）"""
+    __tablename__ = 'stats_summary'
+    
+    id = Column(Integer, primary_key=True)
+    stock_count = Column(Integer, nullable=False, default=0)
+    annual_data_count = Column(Integer, nullable=False, default=0)
+    country_count = Column(Integer, nullable=False, default=0)
+    last_updated = Column(DateTime)
+    data_version = Column(Integer, nullable=False, default=0)
+
+class StatsCountryCount(Base):
+    """国別の銘柄数（country_countの増減判定用）"""
+    __tablename__ = 'stats_country_counts'
+    
+    country = Column(String(50), primary_key=True)
+    stock_count = Column(Integer, nullable=False, default=0)
+
+def migrate_schema(engine):
+    """既存テーブルに不足しているカラムとインデックスを追加（create_allは既存テーブルを変更しないため）
+    
+    返り値: 追加したカラムの "テーブル.カラム" のリスト
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added_columns = []
+    
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                    print(f"  カラム追加: {table.name}.{column.name}")
+                    added_columns.append(f'{table.name}.{column.name}')
+            
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn, checkfirst=True)
+                    print(f"  インデックス追加: {index.name}")
+    
+    return added_columns
+
+def _apply_stats_delta(session, stock_delta=0, annual_delta=0, country_delta=0, last_updated=None):
+    """サマリーを差分で更新（呼び出し元のトランザクション内で実行）"""
+    values = {
+        StatsSummary.stock_count: StatsSummary.stock_count + stock_delta,
+        StatsSummary.annual_data_count: StatsSummary.annual_data_count + annual_delta,
+        StatsSummary.country_count: StatsSummary.country_count + country_delta,
+        StatsSummary.data_version: StatsSummary.data_version + 1
+    }
+    if last_updated is not None:
+        values[StatsSummary.last_updated] = case(
+            (StatsSummary.last_updated.is_(None), last_updated),
+            (StatsSummary.last_updated < last_updated, last_updated),
+            else_=StatsSummary.last_updated
+        )
+    session.query(StatsSummary).filter_by(id=1).update(values, synchronize_session=False)
+
+def _change_country_count(session, country, delta):
+    """国別銘柄数を増減し、country_countの増減（+1/0/-1）を返す"""
+    if not country:
+        return 0
+    
+    if delta > 0:
+        session.execute(text('''
+            INSERT INTO stats_country_counts (country, stock_count) VALUES (:country, 1)
+            ON CONFLICT (country) DO UPDATE SET stock_count = stats_country_counts.stock_count + 1
+        '''), {'country': country})
+        count = session.query(StatsCountryCount.stock_count).filter_by(country=country).scalar()
+        return 1 if count == 1 else 0
+    
+    session.query(StatsCountryCount).filter_by(country=country).update(
+        {StatsCountryCount.stock_count: StatsCountryCount.stock_count - 1}, synchronize_session=False)
+    count = session.query(StatsCountryCount.stock_count).filter_by(country=country).scalar()
+    if count is not None and count <= 0:
+        session.query(StatsCountryCount).filter_by(country=country).delete(synchronize_session=False)
+        return -1
+    return 0
+
+def _refresh_last_updated(session):
+    """最終更新日時をインデックスから再取得（最新の銘柄が削除・変更された場合）"""
+    latest = session.query(func.max(Stock.last_updated)).scalar()
+    session.query(StatsSummary).filter_by(id=1).update(
+        {StatsSummary.last_updated: latest}, synchronize_session=False)
+
+class InstrumentedQueuePool(QueuePool):
+    """コネクション取得待ち時間を計測するQueuePool"""
+    
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.db_pool_checkout_wait.observe(time.perf_counter() - start, backend=self._dialect.name)
+
+def instrument_engine(engine):
+    """エンジンにクエリ実行時間の計測を組み込む"""
+    backend = engine.dialect.name
+    
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+    
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['query_start'].pop()
+        metrics.db_query_duration.observe(
+            time.perf_counter() - start, backend=backend, operation=metrics.sql_operation(statement))
+    
+    @event.listens_for(engine, 'handle_error')
+    def _handle_error(exception_context):
+        starts = exception_context.connection.info.get('query_start') if exception_context.connection else None
+        if starts:
+            starts.pop()
+    
+    return engine
+
+def enable_trigram_search(engine):
+    """pg_trgm拡張とティッカー・会社名のGINインデックスを作成（権限不足などで失敗したらFalse）"""
+    try:
+        with engine.begin() as conn:
+            conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+            conn.execute(text(
+                'CREATE INDEX IF NOT EXISTS idx_stocks_ticker_trgm ON stocks USING gin (ticker gin_trgm_ops)'))
+            conn.execute(text(
+                'CREATE INDEX IF NOT EXISTS idx_stocks_company_name_trgm ON stocks USING gin (company_name gin_trgm_ops)'))
+        return True
+    except SQLAlchemyError as e:
+        print(f"⚠️ pg_trgmを有効にできないため、検索はプロセス内の索引を使用します: {e}")
+        return False
+
+# PostgreSQLへの接続を待つ秒数（パケットが捨てられる場合もTCPのタイムアウトまで待たない）
+CONNECT_TIMEOUT = int(os.environ.get('DATABASE_CONNECT_TIMEOUT', '5'))
+
+def _create_url_engine(database_url):
+    """URLに応じた設定で計測付きのエンジンを作成"""
+    # SQLiteの場合のエンジン設定
+    if database_url.startswith('sqlite'):
+        return instrument_engine(create_engine(database_url, echo=False))
+    
+    # PostgreSQLの場合のエンジン設定
+    return instrument_engine(create_engine(
+        database_url,
+        echo=False,
+        pool_pre_ping=True,
+        pool_recycle=300,
+        poolclass=InstrumentedQueuePool,
+        connect_args={'connect_timeout': CONNECT_TIMEOUT}
+    ))
+
+def _normalize_url(database_url):
+    """RenderのPostgreSQL URLは古い形式なので新しい形式に変換"""
+    if database_url.startswith('postgres://'):
+        return database_url.replace('postgres://', 'postgresql://', 1)
+    return database_url
+
+def _like_prefix(query):
+    """LIKEの特殊文字をエスケープして前方一致パターンを作る（エスケープ文字は既定のバックスラッシュ）"""
+    return query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+# pg_trgmによる検索が使えるエンジン
+_trigram_engines = set()
+
+# (DATABASE_URL, DATABASE_READ_URL) ごとのエンジンとセッションファクトリ（プロセス内で共有）
+_engine_cache = {}
+_engine_lock = threading.Lock()
+
+# 読み取り用レプリカに接続できない場合、この秒数の間はプライマリで読み取り、過ぎたら接続し直す
+REPLICA_RETRY_INTERVAL = float(os.environ.get('DATABASE_READ_RETRY_INTERVAL', '30'))
+
+class ReadReplica:
+    """読み取り用レプリカのセッションファクトリ（接続できない間はプライマリを使い、一定間隔で接続し直す）"""
+    
+    def __init__(self, read_url):
+        self.read_url = read_url
+        self.Session = None
+        self.retry_at = 0.0
+        self._lock = threading.Lock()
+    
+    def _label(self):
+        return self.read_url.split('@')[-1] if '@' in self.read_url else 'SQLite'
+    
+    def session_factory(self):
+        """レプリカのセッションファクトリを取得（接続できない間と、ほかのスレッドが接続を試している間はNone）"""
+        Session = self.Session
+        if Session is not None or time.monotonic() < self.retry_at:
+            return Session
+        
+        # 接続を試すのは1スレッドだけ。ほかの読み取りは待たずにプライマリで行う
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            if self.Session is not None or time.monotonic() < self.retry_at:
+                return self.Session
+            read_engine = None
+            try:
+                read_engine = _create_url_engine(self.read_url)
+                with read_engine.connect():
+                    pass
+                self.Session = sessionmaker(bind=read_engine)
+                print(f"✅ 読み取り用レプリカに接続しました: {self._label()}")
+            except Exception as e:
+                if read_engine is not None:
+                    read_engine.dispose()
+                self._fail(e)
+            return self.Session
+        finally:
+            self._lock.release()
+    
+    def mark_failed(self, error):
+        """レプリカへの接続に失敗した（しばらくプライマリで読み取る）"""
+        with self._lock:
+            Session, self.Session = self.Session, None
+            if Session is not None:
+                Session.kw['bind'].dispose()
+            self._fail(error)
+    
+    def _fail(self, error):
+        metrics.db_connection_errors.inc(role='replica')
+        self.retry_at = time.monotonic() + REPLICA_RETRY_INTERVAL
+        print(f"⚠️ 読み取り用レプリカに接続できないため、{REPLICA_RETRY_INTERVAL:.0f}秒間は読み取りもプライマリで行います: {error}")
+
+# PostgreSQLに接続できずSQLiteへフォールバックした場合、この秒数が過ぎたら接続し直す
+FALLBACK_RETRY_INTERVAL = float(os.environ.get('DATABASE_FALLBACK_RETRY_INTERVAL', '30'))
+FALLBACK_DATABASE_URL = 'sqlite:///stock_analysis_fallback.db'
+
+# フォールバック用のエンジン（再接続を試みるたびに作り直さない）
+_fallback_engine = None
+
+def _get_fallback_engine():
+    """フォールバック用のSQLiteエンジンを取得（返り値: (エンジン, 追加したカラム)）"""
+    global _fallback_engine
+    if _fallback_engine is not None:
+        return _fallback_engine, []
+    engine = instrument_engine(create_engine(FALLBACK_DATABASE_URL, echo=False))
+    Base.metadata.create_all(engine)
+    added_columns = migrate_schema(engine)
+    _fallback_engine = engine
+    return engine, added_columns
 
 class PostgreSQLDatabase:
-    """PostgreSQL株式分析データベースクラス"""
+    """PostgreSQL株式分析データベースクラス
+    
+    DATABASE_READ_URL（読み取り用レプリカ）を設定すると、一覧・詳細・統計・検索・集計・
+    エクスポートなどの読み取りはそちらで行い、書き込みはプライマリ（DATABASE_URL）で行う。
+    同じリクエスト内で書き込んだ後の読み取りは、レプリカの遅延で古い値を返さないようプライマリで行う。
+    """
     
     def __init__(self):
         self.engine = None
         self.Session = None
+        self.replica = None
         self.init_database()
     
     def get_database_url(self):
@@ -68,87 +546,149 @@ class PostgreSQLDatabase:
         database_url = os.environ.get('DATABASE_URL')
         
         if database_url:
-            # RenderのPostgreSQL URLは古い形式なので新しい形式に変換
-            if database_url.startswith('postgres://'):
-                database_url = database_url.replace('postgres://', 'postgresql://', 1)
             print(f"PostgreSQLデータベースに接続中...")
-            return database_url
+            return _normalize_url(database_url)
         else:
             # ローカル開発用SQLite
             print(f"SQLiteデータベースを使用...")
             return 'sqlite:///stock_analysis.db'
     
+    def get_read_database_url(self):
+        """読み取り用レプリカのURLを取得（未設定ならNone）"""
+        read_url = os.environ.get('DATABASE_READ_URL')
+        return _normalize_url(read_url) if read_url else None
+    
     def init_database(self):
-        """データベースとテーブルを初期化"""
+        """データベースとテーブルを初期化（エンジン作成とスキーマ確認はプロセス内で一度だけ）"""
+        cache_key = (os.environ.get('DATABASE_URL'), os.environ.get('DATABASE_READ_URL'))
+        
+        reconnect = False
+        with _engine_lock:
+            cached = _engine_cache.get(cache_key)
+            if cached is None:
+                cached = self._create_engine()
+                _engine_cache[cache_key] = cached
+            elif cached[3] is not None and time.monotonic() >= cached[3]:
+                # フォールバック中は一定間隔でPostgreSQLへの接続をやり直す。やり直しは1スレッドだけが
+                # ロックの外で行い、その間ほかのスレッドはフォールバックのエンジンを使い続ける
+                _engine_cache[cache_key] = (*cached[:3], time.monotonic() + FALLBACK_RETRY_INTERVAL)
+                reconnect = True
+        
+        if reconnect:
+            cached = self._create_engine()
+            with _engine_lock:
+                _engine_cache[cache_key] = cached
+        
+        self.engine, self.Session, self.replica, retry_at = cached
+        self.fallback = retry_at is not None
+        if self.fallback:
+            metrics.db_fallback.inc()
+    
+    def _create_engine(self):
+        """エンジンを作成してテーブルを確認
+        
+        返り値: (エンジン, セッションファクトリ, 読み取り用レプリカ（ReadReplica、未設定ならNone）, 再接続を試みる時刻)。
+        再接続の時刻はフォールバックした場合だけ設定する（time.monotonic() の値）。
+        """
+        engine = None
+        retry_at = None
         try:
             database_url = self.get_database_url()
-            
-            # SQLiteの場合のエンジン設定
-            if database_url.startswith('sqlite'):
-                self.engine = create_engine(database_url, echo=False)
-            else:
-                # PostgreSQLの場合のエンジン設定
-                self.engine = create_engine(
-                    database_url,
-                    echo=False,
-                    pool_pre_ping=True,
-                    pool_recycle=300
-                )
+            engine = _create_url_engine(database_url)
             
             # テーブル作成
-            Base.metadata.create_all(self.engine)
-            
-            # セッション作成
-            self.Session = sessionmaker(bind=self.engine)
+            Base.metadata.create_all(engine)
+            added_columns = migrate_schema(engine)
+            if engine.dialect.name == 'postgresql' and enable_trigram_search(engine):
+                _trigram_engines.add(engine)
             
             print(f"✅ データベース接続成功: {database_url.split('@')[0] if '@' in database_url else 'SQLite'}")
             
         except Exception as e:
             print(f"❌ データベース接続エラー: {e}")
-            # フォールバック: SQLite
-            self.engine = create_engine('sqlite:///stock_analysis_fallback.db', echo=False)
-            Base.metadata.create_all(self.engine)
-            self.Session = sessionmaker(bind=self.engine)
-            print("SQLiteフォールバックデータベースを使用")
+            metrics.db_connection_errors.inc(role='primary')
+            if engine is not None:
+                engine.dispose()
+            # フォールバック: SQLite（一定時間後にPostgreSQLへの接続をやり直す）
+            engine, added_columns = _get_fallback_engine()
+            retry_at = time.monotonic() + FALLBACK_RETRY_INTERVAL
+            print(f"⚠️ SQLiteフォールバックデータベースを使用（{FALLBACK_RETRY_INTERVAL:.0f}秒後に再接続を試みます）")
+        
+        # セッション作成
+        Session = sessionmaker(bind=engine)
+        
+        # サマリーが未作成（既存DBの初回起動）なら集計して作成
+        session = Session()
+        try:
+            if session.get(StatsSummary, 1) is None:
+                self._rebuild_stats_summary(session)
+                session.commit()
+                print("統計サマリーを作成しました")
+            if session.get(FxRate, 'USD') is None:
+                session.add(FxRate(currency='USD', usd_rate=1.0))
+                session.commit()
+            # USD換算カラムを追加した既存データは、現在のレートで換算しておく
+            if any(column.endswith('_usd') for column in added_columns):
+                self._renormalize_usd(session)
+                session.commit()
+        finally:
+            session.close()
+        
+        read_url = self.get_read_database_url()
+        return engine, Session, ReadReplica(read_url) if read_url and retry_at is None else None, retry_at
+    
+    def _write_session(self):
+        """書き込み用のセッション（プライマリ。以降の同じリクエスト内の読み取りもプライマリで行う）"""
+        db_backend.mark_write()
+        return self.Session()
+    
+    def _read_session(self):
+        """読み取り用のセッション（レプリカ。未設定か、同じリクエスト内で書き込んだ後か、接続できなければプライマリ）"""
+        if self.replica is None or db_backend.wrote_in_request():
+            return self.Session()
+        ReadSession = self.replica.session_factory()
+        if ReadSession is None:
+            return self.Session()
+        
+        session = ReadSession()
+        try:
+            # 接続をここで確保し、レプリカが落ちていればプライマリで読み取る
+            session.connection()
+        except DBAPIError as e:
+            session.close()
+            self.replica.mark_failed(e)
+            return self.Session()
+        return session
     
     def save_stock_analysis(self, analysis_data):
-        """分析データをデータベースに保存"""
-        session = self.Session()
+        """分析データをデータベースに保存（保存済みの内容と同じ行は書き込まない）
+        
+        返り値: {'status': 銘柄の状態（inserted / updated / skipped）, 'annual': 年次データの件数}
+        """
+        session = self._write_session()
         
         try:
-            # 既存銘柄をチェック
-            existing_stock = session.query(Stock).filter_by(ticker=analysis_data['ticker']).first()
-            
-            if existing_stock:
-                # 既存銘柄を更新
-                existing_stock.company_name = analysis_data['company_name']
-                existing_stock.country = analysis_data.get('country', 'N/A')
-                existing_stock.currency = analysis_data.get('currency', 'USD')
-                existing_stock.current_price = analysis_data['current_price']
-                existing_stock.market_cap = analysis_data['market_cap']
-                existing_stock.current_dividend_yield = analysis_data['current_dividend_yield']
-                existing_stock.last_updated = datetime.now()
-                
-                # 既存の年次データを削除
-                session.query(AnnualData).filter_by(stock_id=existing_stock.id).delete()
-                
-                stock = existing_stock
-            else:
-                # 新規銘柄を作成
-                stock = Stock(
-                    ticker=analysis_data['ticker'],
-                    company_name=analysis_data['company_name'],
-                    country=analysis_data.get('country', 'N/A'),
-                    currency=analysis_data.get('currency', 'USD'),
-                    current_price=analysis_data['current_price'],
-                    market_cap=analysis_data['market_cap'],
-                    current_dividend_yield=analysis_data['current_dividend_yield'],
-                    last_updated=datetime.now()
-                )
-                session.add(stock)
-                session.flush()  # IDを取得するため
+            now = datetime.now()
+            ticker = analysis_data['ticker']
+            currency = analysis_data.get('currency', 'USD')
+            financial_currency = analysis_data.get('financial_currency')
+            rates = fx_rates.stock_rates(
+                dict(session.query(FxRate.currency, FxRate.usd_rate).all()), currency, financial_currency
+            )
+            values = {
+                'company_name': analysis_data['company_name'],
+                'country': analysis_data.get('country', 'N/A'),
+                'currency': currency,
+                'current_price': analysis_data['current_price'],
+                'market_cap': analysis_data['market_cap'],
+                'current_dividend_yield': analysis_data['current_dividend_yield'],
+                'sector': analysis_data.get('sector'),
+                'industry': analysis_data.get('industry'),
+                'financial_currency': financial_currency
+            }
             
-            # 年次データを保存
+            # 年度ごとの年次データ
+            annual_rows = []
             for return_data in analysis_data['total_returns']['annual_returns']:
                 year = return_data['year']
                 
@@ -175,8 +715,7 @@ class PostgreSQLDatabase:
                 if analysis_data.get('roi_data'):
                     roi_data = next((r for r in analysis_data['roi_data']['annual_data'] if r['year'] == year), None)
                 
-                annual_data = AnnualData(
-                    stock_id=stock.id,
+                annual_values = dict(
                     year=year,
                     total_revenue=revenue_data['total_revenue'] if revenue_data else 0,
                     operating_cash_flow=revenue_data['operating_cash_flow'] if revenue_data else 0,
@@ -195,10 +734,29 @@ class PostgreSQLDatabase:
                     net_income=roi_data['net_income'] if roi_data else 0,
                     total_assets=roi_data['total_assets'] if roi_data else 0
                 )
-                session.add(annual_data)
+                annual_rows.append(annual_values)
+            
+            stock, status, country_delta, counts = _write_stock(session, ticker, values, annual_rows, now, rates)
+            stock.checked_at = now
+            
+            if status == 'skipped':
+                session.commit()
+                print(f"✅ {ticker} は保存済みのデータと同じため、書き込みを省略しました")
+                return {'status': status, 'annual': counts}
+            
+            # 履歴を同じトランザクションで追記
+            _append_history(session, [(ticker, now, stock_history.snapshot_values({
+                **values, 'market_cap_usd': stock.market_cap_usd
+            }, annual_rows))])
+            
+            # 統計サマリーを同じトランザクションで更新
+            _apply_stats_delta(
+                session, 1 if status == 'inserted' else 0, counts['inserted'] - counts['deleted'], country_delta, now
+            )
             
             session.commit()
-            print(f"✅ {analysis_data['ticker']} のデータをPostgreSQLに保存しました")
+            print(f"✅ {ticker} のデータをPostgreSQLに保存しました")
+            return {'status': status, 'annual': counts}
             
         except SQLAlchemyError as e:
             session.rollback()
@@ -209,7 +767,7 @@ class PostgreSQLDatabase:
     
     def get_all_stocks(self):
         """保存されている全銘柄を取得"""
-        session = self.Session()
+        session = self._read_session()
         
         try:
             stocks = session.query(Stock).order_by(Stock.last_updated.desc()).all()
@@ -236,7 +794,7 @@ class PostgreSQLDatabase:
     
     def get_stock_analysis(self, ticker):
         """特定銘柄の分析データを取得"""
-        session = self.Session()
+        session = self._read_session()
         
         try:
             stock = session.query(Stock).filter_by(ticker=ticker).first()
@@ -254,7 +812,14 @@ class PostgreSQLDatabase:
                 'current_price': stock.current_price,
                 'market_cap': stock.market_cap,
                 'current_dividend_yield': stock.current_dividend_yield,
+                'sector': stock.sector,
+                'industry': stock.industry,
                 'last_updated': stock.last_updated.isoformat() if stock.last_updated else None,
+                'fx_rate_usd': stock.fx_rate_usd,
+                'current_price_usd': stock.current_price_usd,
+                'market_cap_usd': stock.market_cap_usd,
+                'financial_currency': stock.financial_currency,
+                'financial_fx_rate_usd': stock.financial_fx_rate_usd,
                 'annual_data': []
             }
             
@@ -276,7 +841,8 @@ class PostgreSQLDatabase:
                     'total_return_without_capex': data.total_return_without_capex,
                     'total_return_with_capex': data.total_return_with_capex,
                     'net_income': data.net_income,
-                    'total_assets': data.total_assets
+                    'total_assets': data.total_assets,
+                    **{column: getattr(data, column) for column in _ANNUAL_USD_COLUMNS}
                 })
             
             return result
@@ -289,13 +855,20 @@ class PostgreSQLDatabase:
     
     def delete_stock(self, ticker):
         """銘柄をデータベースから削除"""
-        session = self.Session()
+        session = self._write_session()
         
         try:
-            stock = session.query(Stock).filter_by(ticker=ticker).first()
+            deleted = _delete_stock(session, ticker, datetime.now())
             
-            if stock:
-                session.delete(stock)  # カスケード削除で年次データも削除
+            if deleted:
+                annual_rows, country_delta, last_updated = deleted
+                
+                # 統計サマリーを同じトランザクションで更新
+                _apply_stats_delta(session, -1, -annual_rows, country_delta)
+                latest = session.query(StatsSummary.last_updated).filter_by(id=1).scalar()
+                if latest is not None and last_updated is not None and last_updated >= latest:
+                    _refresh_last_updated(session)
+                
                 session.commit()
                 print(f"✅ {ticker} をPostgreSQLから削除しました")
             else:
@@ -309,25 +882,20 @@ class PostgreSQLDatabase:
             session.close()
     
     def get_database_stats(self):
-        """データベースの統計情報を取得"""
-        session = self.Session()
+        """データベースの統計情報を取得（サマリーテーブルから1行読むだけ）"""
+        session = self._read_session()
         
         try:
-            stock_count = session.query(Stock).count()
-            annual_data_count = session.query(AnnualData).count()
-            
-            # 国数を取得
-            country_count = session.query(Stock.country).distinct().count()
-            
-            # 最終更新日を取得
-            latest_stock = session.query(Stock).order_by(Stock.last_updated.desc()).first()
-            last_updated = latest_stock.last_updated.isoformat() if latest_stock and latest_stock.last_updated else None
+            summary = session.get(StatsSummary, 1)
+            if summary is None:
+                summary = self._rebuild_stats_summary(session)
+                session.commit()
             
             return {
-                'stock_count': stock_count,
-                'annual_data_count': annual_data_count,
-                'country_count': country_count,
-                'last_updated': last_updated
+                'stock_count': summary.stock_count,
+                'annual_data_count': summary.annual_data_count,
+                'country_count': summary.country_count,
+                'last_updated': summary.last_updated.isoformat() if summary.last_updated else None
             }
             
         except SQLAlchemyError as e:
@@ -341,12 +909,283 @@ class PostgreSQLDatabase:
         finally:
             session.close()
     
-    def export_database(self):
-        """データベース全体をJSONファイルとしてエクスポート"""
-        session = self.Session()
+    def cache_namespace(self):
+        """共有キャッシュのキーに含めるデータベースの識別子（プライマリの接続先。レプリカも同じ識別子）"""
+        url = self.engine.url
+        if url.get_backend_name() == 'sqlite':
+            return db_backend.cache_namespace('sqlite', os.path.abspath(url.database or ''), local=True)
+        return db_backend.cache_namespace(url.get_backend_name(), url.render_as_string(hide_password=True))
+    
+    def get_data_version(self):
+        """書き込みのたびに増えるデータバージョンを取得（キャッシュの無効化判定用）"""
+        session = self._read_session()
+        
+        try:
+            return session.query(StatsSummary.data_version).filter_by(id=1).scalar() or 0
+        finally:
+            session.close()
+    
+    def rebuild_stats_summary(self):
+        """統計サマリーを全件集計から作り直す（管理コマンド用）"""
+        session = self._write_session()
+        
+        try:
+            self._rebuild_stats_summary(session)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"❌ 統計サマリー再構築エラー: {e}")
+            raise
+        finally:
+            session.close()
+        
+        return self.get_database_stats()
+    
+    def _rebuild_stats_summary(self, session):
+        """全件集計でサマリーと国別銘柄数を作り直す"""
+        country_counts = session.query(Stock.country, func.count(Stock.id)).filter(
+            Stock.country.isnot(None)).group_by(Stock.country).all()
+        
+        session.query(StatsCountryCount).delete(synchronize_session=False)
+        for country, count in country_counts:
+            session.add(StatsCountryCount(country=country, stock_count=count))
+        
+        summary = session.get(StatsSummary, 1)
+        if summary is None:
+            summary = StatsSummary(id=1, data_version=0)
+            session.add(summary)
+        
+        summary.stock_count = session.query(Stock).count()
+        summary.annual_data_count = session.query(AnnualData).count()
+        summary.country_count = len(country_counts)
+        summary.last_updated = session.query(func.max(Stock.last_updated)).scalar()
+        summary.data_version = (summary.data_version or 0) + 1
+        session.flush()
+        return summary
+    
+    def search_stocks(self, query, limit):
+        """pg_trgmのインデックスでティッカー・会社名を検索（使えない環境ではNone）"""
+        if self.engine not in _trigram_engines:
+            return None
+        
+        query = query.strip()
+        if not query:
+            return []
+        
+        # 会社名はプロセス内の索引と同じく、全ての単語を含む（最後の単語は単語の前方一致の）銘柄に一致させる
+        import search_index
+        query_words = search_index.words(query)
+        name_params = {
+            f'word{i}': r'\m' + word + (r'\M' if i < len(query_words) - 1 else '')
+            for i, word in enumerate(query_words)
+        }
+        name_match = ' AND '.join(f'company_name ~* :{name}' for name in name_params) or 'FALSE'
+        
+        session = self._read_session()
+        
+        try:
+            rows = session.execute(text(f'''
+                SELECT ticker, company_name, country,
+                       upper(ticker) = upper(:query) AS exact,
+                       ticker ILIKE :prefix AS ticker_prefix,
+                       ({name_match}) AS name_match,
+                       GREATEST(similarity(ticker, :query), word_similarity(:query, company_name)) AS score
+                FROM stocks
+                WHERE ticker ILIKE :prefix
+                   OR ({name_match})
+                   OR ticker % :query
+                   OR :query <% company_name
+                ORDER BY exact DESC, ticker_prefix DESC, name_match DESC, score DESC, ticker
+                LIMIT :limit
+            '''), {
+                'query': query,
+                'prefix': _like_prefix(query),
+                **name_params,
+                'limit': limit
+            }).fetchall()
+            
+            results = []
+            for row in rows:
+                if row.exact:
+                    match, score = 'ticker', 1.0
+                elif row.ticker_prefix:
+                    match, score = 'ticker_prefix', len(query) / len(row.ticker)
+                elif row.name_match:
+                    match, score = 'name', 0.9
+                else:
+                    match, score = 'fuzzy', float(row.score)
+                results.append({
+                    'ticker': row.ticker,
+                    'company_name': row.company_name,
+                    'country': row.country,
+                    'match': match,
+                    'score': round(score, 3)
+                })
+            return results
+            
+        except SQLAlchemyError as e:
+            print(f"❌ 検索エラー: {e}")
+            return None
+        finally:
+            session.close()
+    
+    def compute_aggregates(self, by):
+        """国・セクター・年度ごとの利回り集計をSQLで求める（キャッシュは aggregates.get_aggregates）"""
+        session = self._read_session()
         
         try:
-            stocks = session.query(Stock).order_by(Stock.ticker).all()
+            if self.engine.dialect.name == 'postgresql':
+                rows = session.execute(text(aggregates.postgres_sql(by))).fetchall()
+                return aggregates.rows_from_postgres(rows)
+            
+            summary_rows = session.execute(text(aggregates.summary_sql(by))).fetchall()
+            return aggregates.rows_from_summary(
+                summary_rows,
+                lambda metric: session.execute(text(aggregates.values_sql(by, metric)))
+            )
+        finally:
+            session.close()
+    
+    def get_fx_rates(self):
+        """登録済みの為替レート（通貨 -> 1通貨単位あたりの米ドル）"""
+        session = self._read_session()
+        
+        try:
+            return dict(session.query(FxRate.currency, FxRate.usd_rate).order_by(FxRate.currency).all())
+        finally:
+            session.close()
+    
+    def set_fx_rates(self, rates, replace=False):
+        """為替レートを登録し、同じトランザクションで全件のUSD換算をやり直す（replace時は未指定の通貨を削除）"""
+        session = self._write_session()
+        
+        try:
+            rates = fx_rates.expand_rates(rates)
+            if replace:
+                session.query(FxRate).delete(synchronize_session=False)
+            now = datetime.now()
+            for currency, rate in rates.items():
+                session.execute(text('''
+                    INSERT INTO fx_rates (currency, usd_rate, updated_at) VALUES (:currency, :rate, :now)
+                    ON CONFLICT (currency) DO UPDATE SET usd_rate = excluded.usd_rate, updated_at = excluded.updated_at
+                '''), {'currency': currency, 'rate': rate, 'now': now})
+            result = self._renormalize_usd(session)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"❌ 為替レート登録エラー: {e}")
+            raise
+        finally:
+            session.close()
+        
+        result['rate_count'] = len(rates)
+        return result
+    
+    def renormalize_usd(self):
+        """全銘柄・全年次データのUSD換算カラムを現在のレートで計算し直す"""
+        session = self._write_session()
+        
+        try:
+            result = self._renormalize_usd(session)
+            session.commit()
+            return result
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"❌ USD換算エラー: {e}")
+            raise
+        finally:
+            session.close()
+    
+    def _renormalize_usd(self, session):
+        """renormalize_usd の本体（呼び出し元のトランザクション内で実行）"""
+        for statement in fx_rates.renormalize_sql():
+            session.execute(text(statement))
+        # 読み取りキャッシュ・スナップショットを作り直させる
+        _apply_stats_delta(session)
+        
+        normalized = session.query(func.count(Stock.id)).filter(
+            Stock.fx_rate_usd.isnot(None), Stock.financial_fx_rate_usd.isnot(None)).scalar()
+        missing = [row[0] for row in session.execute(text(fx_rates.missing_currencies_sql()))]
+        return {'normalized_stock_count': normalized, 'missing_currencies': missing}
+    
+    def get_usd_ranking(self, metric, year=None, limit=fx_rates.DEFAULT_RANKING_LIMIT):
+        """USD換算した金額の上位銘柄（年次データの指標はyear年度、省略時は最新年度）"""
+        session = self._read_session()
+        
+        try:
+            sql = fx_rates.ranking_sql(metric)
+            params = {'limit': limit}
+            if metric in fx_rates.RANKED_ANNUAL_COLUMNS:
+                if year is None:
+                    year = session.query(func.max(AnnualData.year)).scalar()
+                params['year'] = year
+            return fx_rates.ranking_result(metric, params.get('year'), session.execute(text(sql), params).fetchall())
+        finally:
+            session.close()
+    
+    def get_stock_history(self, ticker, start=None, end=None, names=stock_history.HISTORY_METRICS,
+                          limit=stock_history.HISTORY_MAX_POINTS):
+        """銘柄の分析値の履歴（start以上end未満、古い順）"""
+        session = self._read_session()
+        
+        try:
+            # 上限を超えたかを知るため1件多く読む
+            params = {'ticker': ticker, 'start': start, 'end': end, 'limit': limit + 1}
+            rows = session.execute(text(stock_history.range_sql(start, end)), params).fetchall()
+            before_row = session.execute(text(stock_history.before_sql()), params).fetchone() if start else None
+            return stock_history.history_result(ticker, names, start, end, before_row, rows, limit)
+        finally:
+            session.close()
+    
+    def get_portfolio_holdings(self, tickers):
+        """保有銘柄の情報と年次データの利回りをまとめて取得（返り値は portfolio.holdings_from_rows の形）"""
+        import portfolio
+        session = self._read_session()
+        
+        try:
+            stock_rows = []
+            annual_rows = []
+            for params in portfolio.query_chunks(tickers):
+                stock_rows += session.execute(text(portfolio.stocks_sql(params)), params).fetchall()
+                annual_rows += session.execute(text(portfolio.annual_sql(params)), params).fetchall()
+            return portfolio.holdings_from_rows(stock_rows, annual_rows)
+        finally:
+            session.close()
+    
+    def mark_checked(self, tickers):
+        """銘柄を取得して確かめた日時を現在時刻にする（分析キャッシュから返した銘柄用。データバージョンは変えない）"""
+        if not tickers:
+            return
+        session = self._write_session()
+        
+        try:
+            session.query(Stock).filter(Stock.ticker.in_(list(tickers))).update(
+                {Stock.checked_at: datetime.now()}, synchronize_session=False
+            )
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            print(f"❌ 確認日時の更新エラー: {e}")
+            raise
+        finally:
+            session.close()
+    
+    def export_database(self, since=None):
+        """データベース全体をJSONファイルとしてエクスポート
+        
+        since（datetime）を指定すると、その後に更新された銘柄と、削除された銘柄（deleted）だけを返す。
+        export_info.next_since は次回の since に使う日時（読み出しを始めた時刻の少し前。次回と重なる変更もある）。
+        """
+        session = self._read_session()
+        
+        try:
+            # 次回の since は読み出しを始める前の時刻から決める
+            started = datetime.now()
+            # since指定時は last_updated のインデックスで変更された銘柄だけを読む
+            query = session.query(Stock)
+            if since is not None:
+                query = query.filter(Stock.last_updated > since)
+            stocks = query.order_by(Stock.ticker).all()
             
             export_data = {
                 'export_info': {
@@ -368,6 +1207,9 @@ class PostgreSQLDatabase:
                     'current_price': stock.current_price,
                     'market_cap': stock.market_cap,
                     'current_dividend_yield': stock.current_dividend_yield,
+                    'sector': stock.sector,
+                    'industry': stock.industry,
+                    'financial_currency': stock.financial_currency,
                     'last_updated': stock.last_updated.isoformat() if stock.last_updated else None,
                     'annual_data': []
                 }
@@ -395,6 +1237,19 @@ class PostgreSQLDatabase:
                 
                 export_data['stocks'].append(stock_data)
             
+            if since is not None:
+                deleted = session.query(StockTombstone.ticker, StockTombstone.deleted_at).filter(
+                    StockTombstone.deleted_at > since).order_by(StockTombstone.ticker).all()
+                export_data['deleted'] = [
+                    {'ticker': ticker, 'deleted_at': deleted_at.isoformat()} for ticker, deleted_at in deleted
+                ]
+                export_data['export_info'].update({
+                    'format_version': '1.1',
+                    'since': since.isoformat(),
+                    'next_since': db_backend.export_next_since(since, started).isoformat(),
+                    'total_deleted': len(deleted)
+                })
+            
             return export_data
             
         except SQLAlchemyError as e:
@@ -402,83 +1257,130 @@ class PostgreSQLDatabase:
         finally:
             session.close()
     
+    def iter_export_batches(self, batch_size=5000):
+        """全銘柄と年次データを銘柄ID順にバッチで取得（列指向エクスポート用）
+        
+        (銘柄の行リスト, 年次データの行リスト) を銘柄batch_size件ごとに返す。
+        年次データの行には銘柄のtickerが含まれる。
+        """
+        session = self._read_session()
+        
+        try:
+            last_id = 0
+            while True:
+                stocks = session.query(Stock.id, *_EXPORT_STOCK_COLUMNS).filter(
+                    Stock.id > last_id).order_by(Stock.id).limit(batch_size).all()
+                if not stocks:
+                    break
+                
+                tickers = {row.id: row.ticker for row in stocks}
+                annual_rows = session.query(AnnualData.stock_id, *_EXPORT_ANNUAL_COLUMNS).filter(
+                    AnnualData.stock_id.in_(list(tickers))
+                ).order_by(AnnualData.stock_id, AnnualData.year.desc()).all()
+                
+                stock_batch = []
+                for row in stocks:
+                    item = row._asdict()
+                    del item['id']
+                    stock_batch.append(item)
+                
+                annual_batch = []
+                for row in annual_rows:
+                    item = row._asdict()
+                    item['ticker'] = tickers[item.pop('stock_id')]
+                    annual_batch.append(item)
+                
+                yield stock_batch, annual_batch
+                last_id = stocks[-1].id
+        finally:
+            session.close()
+    
     def import_database(self, import_data, clear_existing=False):
-        """JSONデータからデータベースをインポート"""
-        session = self.Session()
+        """JSONデータからデータベースをインポート（保存済みの内容と同じ銘柄・年度は書き込まない）"""
+        session = self._write_session()
         
         try:
             if clear_existing:
-                # 既存データを削除（カスケード削除）
+                # 既存データを削除（削除の記録も残す。インポートされる銘柄の記録は書き込み時に消える）
+                session.execute(text('''
+                    INSERT INTO stock_tombstones (ticker, deleted_at) SELECT ticker, :now FROM stocks WHERE true
+                    ON CONFLICT (ticker) DO UPDATE SET deleted_at = excluded.deleted_at
+                '''), {'now': datetime.now()})
+                # 一括削除ではORMのカスケードが効かないため年次データから削除
+                session.query(AnnualData).delete()
                 session.query(Stock).delete()
+                self._rebuild_stats_summary(session)
                 session.commit()
                 print("既存データを削除しました")
             
             imported_count = 0
             updated_count = 0
+            skipped_count = 0
+            country_delta = 0
+            annual_counts = content_hash.empty_counts()
+            
+            # USD換算のレートはまとめて1回読む
+            rates = dict(session.query(FxRate.currency, FxRate.usd_rate).all())
+            
+            # 履歴は最後にまとめて追記する
+            snapshots = []
+            
+            # 差分エクスポートの削除を先に反映（削除後に更新された銘柄は残す。何度適用しても同じ結果になる）
+            deleted_count = 0
+            for item in import_data.get('deleted', []):
+                deleted = _delete_stock(
+                    session, item['ticker'], datetime.fromisoformat(item['deleted_at']), keep_newer=True
+                )
+                if deleted:
+                    deleted_count += 1
+                    annual_counts['deleted'] += deleted[0]
+                    country_delta += deleted[1]
             
             for stock_data in import_data.get('stocks', []):
                 ticker = stock_data.get('ticker')
                 if not ticker:
                     continue
+                stock_rates = fx_rates.stock_rates(rates, stock_data.get('currency'), stock_data.get('financial_currency'))
                 
-                # 既存銘柄をチェック
-                existing_stock = session.query(Stock).filter_by(ticker=ticker).first()
+                # 保存済みの内容と同じ銘柄・年度は書き込まない
+                stock, status, delta, counts = _write_stock(
+                    session,
+                    ticker,
+                    {name: stock_data.get(name) for name in content_hash.STOCK_FIELDS},
+                    stock_data.get('annual_data', []),
+                    datetime.fromisoformat(stock_data['last_updated']) if stock_data.get('last_updated') else None,
+                    stock_rates
+                )
+                country_delta += delta
+                for key, count in counts.items():
+                    annual_counts[key] += count
                 
-                if existing_stock:
-                    # 既存銘柄を更新
-                    existing_stock.company_name = stock_data.get('company_name')
-                    existing_stock.country = stock_data.get('country')
-                    existing_stock.currency = stock_data.get('currency')
-                    existing_stock.current_price = stock_data.get('current_price')
-                    existing_stock.market_cap = stock_data.get('market_cap')
-                    existing_stock.current_dividend_yield = stock_data.get('current_dividend_yield')
-                    if stock_data.get('last_updated'):
-                        existing_stock.last_updated = datetime.fromisoformat(stock_data['last_updated'])
-                    
-                    # 既存の年次データを削除
-                    session.query(AnnualData).filter_by(stock_id=existing_stock.id).delete()
-                    
-                    stock = existing_stock
-                    updated_count += 1
-                else:
-                    # 新規銘柄を追加
-                    stock = Stock(
-                        ticker=ticker,
-                        company_name=stock_data.get('company_name'),
-                        country=stock_data.get('country'),
-                        currency=stock_data.get('currency'),
-                        current_price=stock_data.get('current_price'),
-                        market_cap=stock_data.get('market_cap'),
-                        current_dividend_yield=stock_data.get('current_dividend_yield'),
-                        last_updated=datetime.fromisoformat(stock_data['last_updated']) if stock_data.get('last_updated') else datetime.now()
-                    )
-                    session.add(stock)
-                    session.flush()  # IDを取得するため
+                if status == 'skipped':
+                    skipped_count += 1
+                    continue
+                if status == 'inserted':
                     imported_count += 1
+                else:
+                    updated_count += 1
                 
-                # 年次データをインポート
-                for annual_data in stock_data.get('annual_data', []):
-                    data = AnnualData(
-                        stock_id=stock.id,
-                        year=annual_data.get('year'),
-                        total_revenue=annual_data.get('total_revenue'),
-                        operating_cash_flow=annual_data.get('operating_cash_flow'),
-                        ocf_ratio=annual_data.get('ocf_ratio'),
-                        dividend_amount=annual_data.get('dividend_amount'),
-                        dividend_yield=annual_data.get('dividend_yield'),
-                        buyback_amount=annual_data.get('buyback_amount'),
-                        buyback_yield=annual_data.get('buyback_yield'),
-                        capex_amount=annual_data.get('capex_amount'),
-                        capex_yield=annual_data.get('capex_yield'),
-                        debt_issuance=annual_data.get('debt_issuance'),
-                        debt_repayment=annual_data.get('debt_repayment'),
-                        roi=annual_data.get('roi'),
-                        total_return_without_capex=annual_data.get('total_return_without_capex'),
-                        total_return_with_capex=annual_data.get('total_return_with_capex'),
-                        net_income=annual_data.get('net_income'),
-                        total_assets=annual_data.get('total_assets')
+                snapshots.append((
+                    ticker,
+                    stock.last_updated,
+                    stock_history.snapshot_values(
+                        {**stock_data, 'market_cap_usd': stock.market_cap_usd}, stock_data.get('annual_data', [])
                     )
-                    session.add(data)
+                ))
+            
+            _append_history(session, snapshots)
+            
+            # 統計サマリーを同じトランザクションで更新（インポートでは最終更新日時が古くなり得るので再取得）
+            # 何も変わらなければデータバージョンも上げない（読み取りキャッシュをそのまま使える）
+            session.flush()
+            if imported_count or updated_count or deleted_count:
+                _apply_stats_delta(
+                    session, imported_count - deleted_count, annual_counts['inserted'] - annual_counts['deleted'], country_delta
+                )
+                _refresh_last_updated(session)
             
             session.commit()
             
@@ -486,7 +1388,13 @@ class PostgreSQLDatabase:
                 'success': True,
                 'imported_count': imported_count,
                 'updated_count': updated_count,
-                'total_processed': imported_count + updated_count
+                'skipped_count': skipped_count,
+                'deleted_count': deleted_count,
+                'total_processed': imported_count + updated_count + skipped_count,
+                'annual_inserted_count': annual_counts['inserted'],
+                'annual_updated_count': annual_counts['updated'],
+                'annual_skipped_count': annual_counts['skipped'],
+                'annual_deleted_count': annual_counts['deleted']
             }
             
         except SQLAlchemyError as e:
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""設定に応じてデータベースの実装を選択する
+
+環境変数 DATABASE_BACKEND:
+    sqlalchemy（既定） - database_postgres.PostgreSQLDatabase（DATABASE_URL、未設定時はSQLite。
+                         DATABASE_READ_URL を設定すると読み取りはそちらのレプリカへ）
+    sqlite             - database.StockDatabase（SQLITE_MODE=production でチューニング済みモード）
+
+読み取りをレプリカへ振り分ける場合も、同じリクエスト内で書き込んだ後の読み取りはプライマリで行う
+（リクエストの開始時に begin_request を呼び、書き込み時に mark_write で記録する）。
+"""
+import os
+import socket
+import hashlib
+import contextvars
+from datetime import timedelta
+
+# 差分エクスポートの next_since を読み出し開始時刻からさかのぼらせる秒数
+# （last_updated はコミット前の時刻なので、読み出し中にコミットされた書き込みを次回に取りこぼさないように）
+EXPORT_SINCE_MARGIN = float(os.environ.get('EXPORT_SINCE_MARGIN', '60'))
+
+# リクエストごとの状態（コンテキストをコピーしたスレッドとも同じ辞書を共有する）
+_request_state = contextvars.ContextVar('database_request_state', default=None)
+
+
+def get_database():
+    """設定されたバックエンドのデータベースインスタンスを取得"""
+    backend = os.environ.get('DATABASE_BACKEND', 'sqlalchemy').lower()
+
+    if backend == 'sqlite':
+        from database import StockDatabase
+        return StockDatabase()
+
+    from database_postgres import PostgreSQLDatabase
+    return PostgreSQLDatabase()
+
+
+def cache_namespace(backend, location, local=False):
+    """共有キャッシュのキーに含めるデータベースの識別子（接続先のハッシュ）
+
+    同じキャッシュ（CACHE_PATH のファイルや REDIS_URL）を別のデータベースのインスタンスと共有しても、
+    データバージョンが偶然一致して互いの読み取り結果を返さないようにする。
+    local=True（SQLiteのファイル）はホスト名も含める。
+    """
+    parts = [backend, location] + ([socket.gethostname()] if local else [])
+    return hashlib.blake2b('\0'.join(parts).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def export_next_since(since, started):
+    """差分エクスポートの次回の since（読み出しを始めた時刻から EXPORT_SINCE_MARGIN 秒前、since より前には戻さない）
+
+    前回の読み出しの直前・最中にコミットされた変更は次回にも含まれる（重なった分は内容ハッシュで書き込みを省く）。
+    """
+    return max(since, started - timedelta(seconds=EXPORT_SINCE_MARGIN))
+
+
+def begin_request():
+    """リクエストの開始時に呼ぶ（前のリクエストの書き込みの記録を引き継がない）"""
+    _request_state.set({'wrote': False})
+
+
+def mark_write():
+    """現在のリクエストで書き込んだことを記録（リクエスト外ではこのコンテキストに記録）"""
+    state = _request_state.get()
+    if state is None:
+        _request_state.set({'wrote': True})
+    else:
+        state['wrote'] = True
+
+
+def wrote_in_request():
+    """現在のリクエストで書き込み済みか（読み取りをプライマリで行う必要があるか）"""
+    state = _request_state.get()
+    return state is not None and state['wrote']
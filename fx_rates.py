@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""為替レートと金額のUSD換算
+
+レート（1通貨単位あたりの米ドル）はデータベースの fx_rates テーブルに保持し、
+ファイル（CSV / JSON）から読み込む。金額カラムごとにUSD換算したカラム（<カラム>_usd）を
+書き込み時にまとめて計算して保存し、並べ替え用のインデックスを張るため、
+通貨の異なる銘柄をまたいだランキングもクエリ時の換算なしにインデックスを順に読むだけで求まる。
+
+株価は取引通貨（stocks.currency、補助単位のことがある）、時価総額はその本来の単位の通貨、
+年次データの金額は財務諸表の通貨（stocks.financial_currency、不明なら取引通貨の本来の単位）で換算する。
+ロンドン上場の銘柄（GBp建てでGBPやUSDで決算）やADR（USD建てで自国通貨で決算）は取引通貨と財務諸表の通貨が異なる。
+
+レートを更新したときは renormalize_sql の更新文（銘柄ごとのレートを決める1文と、
+銘柄・年次データのUSD換算カラムを一括で計算し直す各1文）で全件を計算し直す。
+"""
+import csv
+import json
+
+# Yahoo Financeが補助単位で表す通貨: 補助単位 -> (通貨, 倍率)
+MINOR_UNITS = {
+    'GBp': ('GBP', 0.01),
+    'GBX': ('GBP', 0.01),
+    'ZAc': ('ZAR', 0.01),
+    'ILA': ('ILS', 0.01)
+}
+
+# USD換算する金額カラム
+USD_STOCK_COLUMNS = ('current_price', 'market_cap')
+USD_ANNUAL_COLUMNS = (
+    'total_revenue', 'operating_cash_flow', 'dividend_amount', 'buyback_amount', 'capex_amount',
+    'debt_issuance', 'debt_repayment', 'net_income', 'total_assets'
+)
+
+# 並べ替え用のインデックスを張るカラム（年次データは年度ごとのランキング用に (year, カラム)）
+RANKED_STOCK_COLUMNS = ('market_cap',)
+RANKED_ANNUAL_COLUMNS = ('dividend_amount', 'buyback_amount', 'capex_amount', 'total_revenue')
+
+DEFAULT_RANKING_LIMIT = 50
+
+
+def usd_column(name):
+    """金額カラムに対応するUSD換算カラム名"""
+    return f'{name}_usd'
+
+
+def usd_indexes():
+    """並べ替え用インデックスの (インデックス名, テーブル, カラムのリスト)"""
+    indexes = [
+        (f'idx_stocks_{usd_column(name)}', 'stocks', [usd_column(name)]) for name in RANKED_STOCK_COLUMNS
+    ]
+    indexes += [
+        (f'idx_annual_year_{usd_column(name)}', 'annual_data', ['year', usd_column(name)])
+        for name in RANKED_ANNUAL_COLUMNS
+    ]
+    return indexes
+
+
+def load_rates_file(path):
+    """レートのファイルを読む（CSVは currency,usd_rate のヘッダー付き、JSONは {"JPY": 0.0067, ...}）"""
+    with open(path, encoding='utf-8') as f:
+        if path.lower().endswith('.json'):
+            raw = json.load(f)
+            if not isinstance(raw, dict):
+                raise ValueError('JSONは通貨コードをキー、レートを値とするオブジェクトにしてください')
+            items = raw.items()
+        else:
+            reader = csv.DictReader(f)
+            if not reader.fieldnames or not {'currency', 'usd_rate'} <= set(reader.fieldnames):
+                raise ValueError('CSVには currency と usd_rate の列が必要です')
+            items = ((row['currency'], row['usd_rate']) for row in reader)
+
+        rates = {}
+        for currency, rate in items:
+            currency = (currency or '').strip()
+            if not currency:
+                continue
+            try:
+                rate = float(rate)
+            except (TypeError, ValueError):
+                raise ValueError(f'{currency}のレートが数値ではありません: {rate}')
+            if not rate > 0:
+                raise ValueError(f'{currency}のレートは正の数にしてください: {rate}')
+            rates[currency] = rate
+    return expand_rates(rates)
+
+
+def expand_rates(rates):
+    """USD自身と、補助単位の通貨のレートを補う"""
+    rates = dict(rates)
+    rates.setdefault('USD', 1.0)
+    for unit, (currency, factor) in MINOR_UNITS.items():
+        if currency in rates and unit not in rates:
+            rates[unit] = rates[currency] * factor
+    return rates
+
+
+def major_currency(currency):
+    """補助単位の通貨なら本来の通貨（GBp -> GBP）"""
+    return MINOR_UNITS.get(currency, (currency,))[0]
+
+
+def stock_rates(rates, currency, financial_currency):
+    """銘柄の換算レート (株価用, 時価総額用, 年次データ用)。rates は {通貨: レート}（未登録ならNone）"""
+    major = major_currency(currency)
+    return rates.get(currency), rates.get(major), rates.get(major_currency(financial_currency) or major)
+
+
+def _major_currency_sql(column):
+    cases = ' '.join(f"WHEN '{unit}' THEN '{currency}'" for unit, (currency, _) in MINOR_UNITS.items())
+    return f'CASE {column} {cases} ELSE {column} END'
+
+
+def to_usd(value, rate):
+    """金額をUSDに換算（値かレートがなければNone）"""
+    if value is None or rate is None:
+        return None
+    return value * rate
+
+
+def usd_values(row, columns, rate):
+    """行の金額カラムをまとめてUSD換算した {USD換算カラム: 値}"""
+    return {usd_column(name): to_usd(row.get(name), rate) for name in columns}
+
+
+def renormalize_sql():
+    """全銘柄・全年次データのUSD換算カラムを現在のレートで計算し直す更新文（順に実行する）"""
+    major = _major_currency_sql('stocks.currency')
+    financial = f"COALESCE({_major_currency_sql('stocks.financial_currency')}, {major})"
+    annual_columns = ', '.join(
+        f'{usd_column(name)} = annual_data.{name} * stocks.financial_fx_rate_usd' for name in USD_ANNUAL_COLUMNS
+    )
+    return [
+        f'''UPDATE stocks SET
+            fx_rate_usd = (SELECT usd_rate FROM fx_rates WHERE fx_rates.currency = stocks.currency),
+            financial_fx_rate_usd = (SELECT usd_rate FROM fx_rates WHERE fx_rates.currency = {financial})''',
+        f'''UPDATE stocks SET
+            current_price_usd = current_price * fx_rate_usd,
+            market_cap_usd = market_cap * (SELECT usd_rate FROM fx_rates WHERE fx_rates.currency = {major})''',
+        f'UPDATE annual_data SET {annual_columns} FROM stocks WHERE stocks.id = annual_data.stock_id'
+    ]
+
+
+def missing_currencies_sql():
+    """レートが登録されていない取引通貨・財務諸表の通貨の一覧を返すSQL"""
+    major = _major_currency_sql('currency')
+    return f'''
+        SELECT currency FROM stocks WHERE fx_rate_usd IS NULL
+        UNION
+        SELECT COALESCE({_major_currency_sql('financial_currency')}, {major}) FROM stocks WHERE financial_fx_rate_usd IS NULL
+        ORDER BY 1
+    '''
+
+
+def ranking_sql(metric):
+    """USD換算した金額の上位銘柄を返すSQL（並べ替え用インデックスを順に読む）
+
+    パラメータは :limit（年次データのカラムは :year も）。
+    """
+    column = usd_column(metric)
+    if metric in RANKED_STOCK_COLUMNS:
+        return f'''
+            SELECT ticker, company_name, country, currency, NULL, {metric}, {column}
+            FROM stocks WHERE {column} IS NOT NULL
+            ORDER BY {column} DESC LIMIT :limit
+        '''
+    if metric in RANKED_ANNUAL_COLUMNS:
+        return f'''
+            SELECT s.ticker, s.company_name, s.country, s.currency, a.year, a.{metric}, a.{column}
+            FROM annual_data a JOIN stocks s ON s.id = a.stock_id
+            WHERE a.year = :year AND a.{column} IS NOT NULL
+            ORDER BY a.{column} DESC LIMIT :limit
+        '''
+    raise ValueError(
+        f"USD換算のランキングに使えない指標です: {metric}"
+        f"（{', '.join(RANKED_STOCK_COLUMNS + RANKED_ANNUAL_COLUMNS)}）"
+    )
+
+
+def ranking_result(metric, year, rows):
+    """ranking_sql の結果行を応答の形にする"""
+    return {
+        'metric': metric,
+        'year': year,
+        'results': [
+            {
+                'ticker': row[0],
+                'company_name': row[1],
+                'country': row[2],
+                'currency': row[3],
+                'year': row[4],
+                metric: row[5],
+                usd_column(metric): row[6]
+            }
+            for row in rows
+        ]
+    }
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""財務諸表から取り出す指標の定義と、まとめての抽出
+
+各指標は取り出す財務諸表と項目名の候補（優先順）を METRICS に1行で登録する。
+財務諸表ごとに項目名を1回走査して登録済みの全指標の行を決め、
+（指標 × 年度）の2次元配列をまとめて取り出す。
+"""
+import numpy as np
+import pandas as pd
+
+# 指標名 -> (財務諸表, 項目名の候補（先にあるものを優先）)
+METRICS = {
+    'dividends': ('cashflow', (
+        'Cash Dividends Paid',
+        'Common Stock Dividend Paid',
+        'Dividends Paid'
+    )),
+    'repurchase': ('cashflow', (
+        'Repurchase Of Capital Stock',
+        'Repurchase Of Stock',
+        'Purchase Of Stock',
+        'Common Stock Repurchased',
+        'Stock Repurchased',
+        'Purchase of Stock'
+    )),
+    'capex': ('cashflow', (
+        'Capital Expenditure',
+        'Capital Expenditures',
+        'Purchase Of Property Plant Equipment',
+        'Capex',
+        'Purchase of Property, Plant and Equipment'
+    )),
+    'operating_cash_flow': ('cashflow', (
+        'Operating Cash Flow',
+        'Cash Flow From Operating Activities',
+        'Net Cash From Operating Activities',
+        'Cash From Operating Activities',
+        'Cash Flowsfromusedin Operating Activities Direct',  # インドネシア株用
+        'Cash Flows From Used In Operating Activities Direct'
+    )),
+    'debt_issuance': ('cashflow', (
+        'Issuance Of Debt',
+        'Proceeds From Issuance Of Debt',
+        'Long Term Debt Issuance',
+        'Net Long Term Debt Issuance',
+        'Proceeds from Long-term Debt'
+    )),
+    'debt_repayment': ('cashflow', (
+        'Repayment Of Debt',
+        'Long Term Debt Payments',
+        'Repayment of Long-term Debt',
+        'Long Term Debt Repayment'
+    )),
+    'revenue': ('financials', (
+        'Total Revenue',
+        'Revenue',
+        'Net Sales',
+        'Sales'
+    )),
+    'net_income': ('financials', (
+        'Net Income',
+        'Net Income From Continuing Operations',
+        'Net Income Common Stockholders',
+        'Net Income Including Noncontrolling Interests'
+    )),
+    'total_assets': ('balance_sheet', (
+        'Total Assets',
+        'Total Assets as Reported'
+    )),
+}
+
+def statement_metrics(statement):
+    """財務諸表から取り出す指標名（登録順）"""
+    return [name for name, (source, _) in METRICS.items() if source == statement]
+
+
+def resolve_rows(labels, names):
+    """項目名を1回走査し、各指標の行番号を返す（見つからない指標は-1）"""
+    positions = {}
+    for position, label in enumerate(labels):
+        # 同じ項目名が複数ある場合は最初の行を使う
+        positions.setdefault(label, position)
+    rows = np.full(len(names), -1, dtype=np.intp)
+    for i, name in enumerate(names):
+        for alias in METRICS[name][1]:
+            if alias in positions:
+                rows[i] = positions[alias]
+                break
+    return rows
+
+
+class MetricTable:
+    """1つの財務諸表から取り出した（指標 × 年度）の値"""
+
+    def __init__(self, names, labels, years, values):
+        self.names = names
+        self._rows = {name: i for i, name in enumerate(names)}
+        self.labels = labels
+        self.years = years
+        self.values = values
+
+    @property
+    def empty(self):
+        """財務諸表が空（年度がない）"""
+        return not self.years
+
+    def label(self, metric):
+        """指標に使った項目名（見つからなかったらNone）"""
+        return self.labels[self._rows[metric]]
+
+    def row(self, metric):
+        """指標の年度ごとの値（新しい年度順、値がない年度はNaN）"""
+        return self.values[self._rows[metric]]
+
+    def annual(self, metric, limit=3):
+        """値のある年度の (年度, 値) を新しい順に返す（最新limit年度のうち）"""
+        values = self.row(metric)[:limit]
+        return [(year, value) for year, value in zip(self.years[:limit], values.tolist()) if not np.isnan(value)]
+
+
+def extract(statement, packed):
+    """pack_statement した財務諸表から、登録済みの指標をまとめて取り出す"""
+    names = statement_metrics(statement)
+    if not packed or not packed['index']:
+        return MetricTable(names, [None] * len(names), [], np.empty((len(names), 0)))
+
+    labels = tuple(packed['index'])
+    rows = resolve_rows(labels, names)
+    values = packed['values']
+    # 見つからない指標の行はNaNにして、全指標を1回の添字参照で取り出す
+    matrix = np.where((rows >= 0)[:, None], values[np.maximum(rows, 0)], np.nan)
+    years = pd.DatetimeIndex(packed['dates']).year.tolist()
+    return MetricTable(names, [labels[row] if row >= 0 else None for row in rows], years, matrix)
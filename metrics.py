@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Prometheus形式のメトリクスを収集するプロセス内レジストリ
+
+標準ライブラリのみで実装し、リクエスト処理中の計測コストを辞書更新程度に抑える。
+gunicornの複数ワーカー環境では環境変数 METRICS_DIR を設定すると、
+各ワーカーが自プロセスの値をファイルへ定期的に書き出し、/metrics で全ワーカー分を合算する。
+"""
+import os
+import json
+import time
+import glob
+import bisect
+import threading
+import tempfile
+from contextlib import contextmanager
+
+# レイテンシ用の既定バケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# マルチプロセス時の書き出し間隔（秒）
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+
+def _escape(value):
+    """ラベル値をエクスポジション形式用にエスケープ"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    """ラベルを {a="x",b="y"} 形式の文字列に変換"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    """数値をエクスポジション形式に変換"""
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """単調増加カウンター"""
+
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    @staticmethod
+    def merge(target, samples):
+        for key, value in samples:
+            key = tuple(key)
+            target[key] = target.get(key, 0) + value
+
+    def render(self, merged):
+        lines = []
+        for key, value in sorted(merged.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """バケット付きヒストグラム"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [バケットごとの件数(+Inf含む), 合計, 件数]
+                entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = entry
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), [list(entry[0]), entry[1], entry[2]]] for key, entry in self._values.items()]
+
+    @staticmethod
+    def merge(target, samples):
+        for key, (counts, total, count) in samples:
+            key = tuple(key)
+            entry = target.get(key)
+            if entry is None:
+                target[key] = [list(counts), total, count]
+            else:
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+
+    def render(self, merged):
+        lines = []
+        bounds = self.buckets + (float('inf'),)
+        for key, (counts, total, count) in sorted(merged.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """メトリクスの登録・書き出し・エクスポジション出力を行うレジストリ"""
+
+    def __init__(self, multiprocess_dir=None):
+        self._metrics = {}
+        self.multiprocess_dir = multiprocess_dir
+        self._last_flush = 0.0
+        self._flush_lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"メトリクス {metric.name} は既に登録されています")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def snapshot(self):
+        """自プロセスの全メトリクス値を取得"""
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def flush(self):
+        """自プロセスの値をマルチプロセス用ディレクトリへアトミックに書き出す"""
+        if not self.multiprocess_dir:
+            return
+        os.makedirs(self.multiprocess_dir, exist_ok=True)
+        path = os.path.join(self.multiprocess_dir, f'metrics_{os.getpid()}.json')
+        fd, tmp_path = tempfile.mkstemp(dir=self.multiprocess_dir, prefix='.metrics_', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._last_flush = time.monotonic()
+
+    def maybe_flush(self):
+        """前回の書き出しから一定時間経過していれば書き出す（リクエスト毎に呼ばれる想定）"""
+        if not self.multiprocess_dir or time.monotonic() - self._last_flush < FLUSH_INTERVAL:
+            return
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            self.flush()
+        except OSError as e:
+            print(f"⚠️ メトリクス書き出しエラー: {e}")
+        finally:
+            self._flush_lock.release()
+
+    def _collect_snapshots(self):
+        """全ワーカーのスナップショットを取得"""
+        if not self.multiprocess_dir:
+            return [self.snapshot()]
+
+        self.flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.multiprocess_dir, 'metrics_*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # 書き込み途中や削除済みのファイルは無視
+                continue
+        return snapshots
+
+    def render(self):
+        """Prometheusテキストエクスポジション形式で出力"""
+        snapshots = self._collect_snapshots()
+        lines = []
+        for name, metric in self._metrics.items():
+            merged = {}
+            for snapshot in snapshots:
+                metric.merge(merged, snapshot.get(name, []))
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type_name}')
+            lines.extend(metric.render(merged))
+            if name == 'cache_requests_total':
+                lines.extend(_render_cache_hit_ratio(merged))
+        return '\n'.join(lines) + '\n'
+
+
+def _render_cache_hit_ratio(merged):
+    """キャッシュ種別ごとのヒット率を派生ゲージとして出力"""
+    totals = {}
+    for (cache, result), value in merged.items():
+        hits, total = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (value if result == 'hit' else 0), total + value)
+
+    lines = [
+        '# HELP cache_hit_ratio キャッシュヒット率（プロセス起動以降の累計）',
+        '# TYPE cache_hit_ratio gauge',
+    ]
+    for cache, (hits, total) in sorted(totals.items()):
+        ratio = hits / total if total else 0
+        lines.append(f'cache_hit_ratio{_format_labels(("cache",), (cache,))} {_format_value(ratio)}')
+    return lines
+
+
+registry = MetricsRegistry(multiprocess_dir=os.environ.get('METRICS_DIR'))
+
+# HTTP API
+http_requests = registry.counter(
+    'http_requests_total', 'HTTPリクエスト数', ('method', 'route', 'status'))
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'HTTPリクエスト処理時間', ('method', 'route'))
+
+# Yahoo Finance への上流呼び出し
+yahoo_requests = registry.counter(
+    'yahoo_requests_total', 'Yahoo Financeへの取得回数', ('statement',))
+yahoo_errors = registry.counter(
+    'yahoo_errors_total', 'Yahoo Finance取得のエラー数', ('statement',))
+yahoo_throttled = registry.counter(
+    'yahoo_throttled_total', 'Yahoo Financeのレート制限による失敗数', ('statement',))
+yahoo_request_duration = registry.histogram(
+    'yahoo_request_duration_seconds', 'Yahoo Finance取得時間', ('statement',))
+
+# データベース
+db_query_duration = registry.histogram(
+    'db_query_duration_seconds', 'データベースクエリ実行時間', ('backend', 'operation'),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+db_connection_errors = registry.counter(
+    'db_connection_errors_total', 'データベースへの接続失敗数', ('role',))
+db_fallback = registry.counter(
+    'db_fallback_total', 'PostgreSQLに接続できずSQLiteフォールバックのデータベースを使った回数')
+db_pool_checkout_wait = registry.histogram(
+    'db_pool_checkout_wait_seconds', 'コネクションプールからの取得待ち時間', ('backend',),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0))
+
+# キャッシュ
+cache_requests = registry.counter(
+    'cache_requests_total', 'キャッシュ参照数', ('cache', 'result'))
+
+
+def is_throttle_error(error):
+    """レート制限（HTTP 429）に起因する例外かどうかを判定"""
+    if type(error).__name__ == 'YFRateLimitError':
+        return True
+    message = str(error)
+    return '429' in message or 'Too Many Requests' in message or 'Rate limited' in message
+
+
+@contextmanager
+def track_upstream(statement):
+    """Yahoo Financeへの呼び出しを計測"""
+    yahoo_requests.inc(statement=statement)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        yahoo_errors.inc(statement=statement)
+        if is_throttle_error(e):
+            yahoo_throttled.inc(statement=statement)
+        raise
+    finally:
+        yahoo_request_duration.observe(time.perf_counter() - start, statement=statement)
+
+
+def record_cache(cache, hit):
+    """キャッシュのヒット/ミスを記録"""
+    cache_requests.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def sql_operation(statement):
+    """SQL文から操作種別（SELECT, INSERTなど）を取り出す"""
+    stripped = statement.lstrip()
+    if not stripped:
+        return 'OTHER'
+    return stripped.split(None, 1)[0].upper()
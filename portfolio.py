@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""ポートフォリオ全体の株主還元利回り
+
+保有銘柄とウェイトを受け取り、保存済みの年次データを1回のクエリ（銘柄数が多ければ数回）でまとめて読み、
+(指標 × 銘柄 × 年度) の配列にしてウェイト付きの年度ごとの利回りを配列演算でまとめて求める。
+保存されていない銘柄や最後に取得して確かめてから（stocks.checked_at、内容が変わらず書き込みを省いた場合も更新される）
+PORTFOLIO_MAX_AGE_DAYS 日を過ぎた銘柄だけを分析し直す（app.py で並行実行）。
+
+年度ごとの値は、その年度のデータがある銘柄のウェイトで割り戻した加重平均（coverage はそのウェイトの合計）。
+各銘柄の寄与（contribution）はウェイト×値を同じウェイトで割ったもので、年度ごとに合計するとポートフォリオの値になる。
+"""
+import os
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+
+PORTFOLIO_METRICS = [
+    'dividend_yield', 'buyback_yield', 'capex_yield',
+    'total_return_without_capex', 'total_return_with_capex'
+]
+
+MAX_PORTFOLIO_HOLDINGS = int(os.environ.get('MAX_PORTFOLIO_HOLDINGS', '500'))
+
+# この日数より前に取得して確かめた銘柄は分析し直す
+PORTFOLIO_MAX_AGE_DAYS = float(os.environ.get('PORTFOLIO_MAX_AGE_DAYS', '7'))
+
+# 1回のリクエストで分析する銘柄数の上限（超えた分は保存済みのデータを使う）
+MAX_PORTFOLIO_FETCH = int(os.environ.get('MAX_PORTFOLIO_FETCH', '50'))
+
+# 1回のクエリで読む銘柄数（SQLiteのパラメータ数の上限より小さく）
+_QUERY_CHUNK = 500
+
+
+def parse_holdings(data):
+    """保有銘柄の指定を (ティッカーのリスト, 合計1に正規化したウェイトの配列) にする
+
+    holdings は [{"ticker": "AAPL", "weight": 2}, ...] か {"AAPL": 2, ...}。
+    tickers（配列）と weights（同じ長さの配列、省略時は等ウェイト）でも指定できる。同じ銘柄のウェイトは合算する。
+    """
+    holdings = data.get('holdings')
+    if holdings is None:
+        tickers = data.get('tickers') or []
+        weights = data.get('weights')
+        if not isinstance(tickers, list) or (weights is not None and not isinstance(weights, list)):
+            raise ValueError('tickers・weights は配列で指定してください')
+        if weights is not None and len(weights) != len(tickers):
+            raise ValueError('weights は tickers と同じ数だけ指定してください')
+        holdings = [{'ticker': ticker, 'weight': 1 if weights is None else weights[i]} for i, ticker in enumerate(tickers)]
+    elif isinstance(holdings, dict):
+        holdings = [{'ticker': ticker, 'weight': weight} for ticker, weight in holdings.items()]
+    elif not isinstance(holdings, list):
+        raise ValueError('holdings は配列か、ティッカーをキーにしたオブジェクトで指定してください')
+
+    totals = {}
+    for holding in holdings:
+        if not isinstance(holding, dict):
+            raise ValueError('holdings の各要素は {"ticker": ..., "weight": ...} で指定してください')
+        ticker = str(holding.get('ticker') or '').upper().strip()
+        if not ticker:
+            raise ValueError('ティッカーコードが必要です')
+        try:
+            weight = float(holding.get('weight', 1))
+        except (TypeError, ValueError):
+            raise ValueError(f'{ticker} のウェイトは数値で指定してください')
+        if not math.isfinite(weight) or weight < 0:
+            raise ValueError(f'{ticker} のウェイトは0以上の数値で指定してください')
+        totals[ticker] = totals.get(ticker, 0.0) + weight
+
+    if not totals:
+        raise ValueError('保有銘柄を指定してください')
+    if len(totals) > MAX_PORTFOLIO_HOLDINGS:
+        raise ValueError(f'保有銘柄は{MAX_PORTFOLIO_HOLDINGS}銘柄までです')
+    weights = np.array(list(totals.values()), dtype=np.float64)
+    if weights.sum() <= 0:
+        raise ValueError('ウェイトの合計は0より大きくしてください')
+    return list(totals), weights / weights.sum()
+
+
+def query_chunks(tickers):
+    """stocks_sql・annual_sql のパラメータ（QUERY_CHUNK銘柄ずつ）"""
+    for start in range(0, len(tickers), _QUERY_CHUNK):
+        chunk = tickers[start:start + _QUERY_CHUNK]
+        yield {f't{i}': ticker for i, ticker in enumerate(chunk)}
+
+
+def _in_list(params):
+    return ', '.join(f':{name}' for name in params)
+
+
+def stocks_sql(params):
+    """銘柄の情報（パラメータは query_chunks の1つ分。checked_at のない古い行は last_updated を使う）"""
+    return f'''
+        SELECT ticker, company_name, country, currency, last_updated, COALESCE(checked_at, last_updated)
+        FROM stocks WHERE ticker IN ({_in_list(params)})
+    '''
+
+
+def annual_sql(params):
+    """銘柄の年次データの利回り（パラメータは query_chunks の1つ分）"""
+    return f'''
+        SELECT s.ticker, a.year, {', '.join(f'a.{name}' for name in PORTFOLIO_METRICS)}
+        FROM annual_data a JOIN stocks s ON s.id = a.stock_id
+        WHERE s.ticker IN ({_in_list(params)}) AND a.year IS NOT NULL
+    '''
+
+
+def holdings_from_rows(stock_rows, annual_rows):
+    """stocks_sql・annual_sql の結果を銘柄ごとの {情報, 'annual': {年度: 値のタプル}} にする"""
+    holdings = {}
+    for ticker, company_name, country, currency, last_updated, checked_at in stock_rows:
+        holdings[ticker] = {
+            'company_name': company_name,
+            'country': country,
+            'currency': currency,
+            'last_updated': last_updated,
+            'checked_at': checked_at,
+            'annual': {}
+        }
+    for row in annual_rows:
+        holding = holdings.get(row[0])
+        if holding is not None:
+            holding['annual'][row[1]] = row[2:]
+    return holdings
+
+
+def holding_from_analysis(result):
+    """分析結果（analyze_stock_for_web）を holdings_from_rows と同じ形にする"""
+    annual = {}
+    for item in (result.get('total_returns') or {}).get('annual_returns', []):
+        if item.get('year') is not None:
+            annual[item['year']] = tuple(item.get(name) for name in PORTFOLIO_METRICS)
+    now = datetime.now()
+    return {
+        'company_name': result.get('company_name'),
+        'country': result.get('country'),
+        'currency': result.get('currency'),
+        'last_updated': now,
+        'checked_at': now,
+        'annual': annual
+    }
+
+
+def _as_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def needs_fetch(holding, max_age_days, now=None):
+    """保存されていないか、最後に取得して確かめたのが max_age_days 日より前なら True"""
+    if holding is None:
+        return True
+    checked_at = _as_datetime(holding['checked_at'])
+    if checked_at is None:
+        return True
+    return (now or datetime.now()) - checked_at > timedelta(days=max_age_days)
+
+
+def _to_float(value):
+    return None if np.isnan(value) else float(value)
+
+
+def compute_portfolio(tickers, weights, holdings, sources):
+    """ウェイト付きの年度ごとの利回りと銘柄ごとの寄与を求める
+
+    holdings は ticker → holdings_from_rows の形（データのない銘柄は含めない）、
+    sources は ticker → 'database' / 'analyzed' / 'stale'。
+    """
+    years = sorted({year for holding in holdings.values() for year in holding['annual']})
+    year_index = {year: j for j, year in enumerate(years)}
+
+    # (指標 × 銘柄 × 年度) の値（データなしはNaN）
+    values = np.full((len(PORTFOLIO_METRICS), len(tickers), len(years)), np.nan, dtype=np.float64)
+    for i, ticker in enumerate(tickers):
+        holding = holdings.get(ticker)
+        if holding is None or not holding['annual']:
+            continue
+        columns = [year_index[year] for year in holding['annual']]
+        values[:, i, columns] = np.array(list(holding['annual'].values()), dtype=np.float64).T
+
+    valid = ~np.isnan(values)
+    weighted = np.where(valid, values * weights[None, :, None], 0.0)
+    coverage = np.where(valid, weights[None, :, None], 0.0).sum(axis=1)          # (指標 × 年度)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        portfolio = weighted.sum(axis=1) / coverage
+        contributions = np.where(valid, weighted / coverage[:, None, :], np.nan)
+
+    # 各銘柄の最新年度の値による現在の利回り
+    has_data = valid.any(axis=0)                                                  # (銘柄 × 年度)
+    latest_values = np.full((len(PORTFOLIO_METRICS), len(tickers)), np.nan)
+    latest_index = np.full(len(tickers), -1)
+    if years:
+        latest_index = np.where(has_data.any(axis=1), len(years) - 1 - np.argmax(has_data[:, ::-1], axis=1), -1)
+        latest_values = np.where(latest_index >= 0, values[:, np.arange(len(tickers)), latest_index], np.nan)
+    latest_valid = ~np.isnan(latest_values)
+    latest_coverage = np.where(latest_valid, weights, 0.0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        latest = np.where(latest_valid, latest_values * weights, 0.0).sum(axis=1) / latest_coverage
+        latest_contributions = np.where(latest_valid, latest_values * weights / latest_coverage[:, None], np.nan)
+
+    result_years = []
+    for j, year in enumerate(years):
+        result_years.append({
+            'year': int(year),
+            'metrics': {
+                name: {'value': _to_float(portfolio[m, j]), 'coverage': float(coverage[m, j])}
+                for m, name in enumerate(PORTFOLIO_METRICS)
+            }
+        })
+
+    result_holdings = []
+    for i, ticker in enumerate(tickers):
+        holding = holdings.get(ticker) or {}
+        last_updated = _as_datetime(holding.get('last_updated'))
+        checked_at = _as_datetime(holding.get('checked_at'))
+        entry = {
+            'ticker': ticker,
+            'weight': float(weights[i]),
+            'source': sources.get(ticker, 'missing'),
+            'company_name': holding.get('company_name'),
+            'country': holding.get('country'),
+            'last_updated': last_updated.isoformat() if last_updated else None,
+            'checked_at': checked_at.isoformat() if checked_at else None,
+            'latest_year': int(years[latest_index[i]]) if latest_index[i] >= 0 else None,
+            'latest': {
+                name: {'value': _to_float(latest_values[m, i]), 'contribution': _to_float(latest_contributions[m, i])}
+                for m, name in enumerate(PORTFOLIO_METRICS)
+            },
+            'annual': []
+        }
+        for j in np.flatnonzero(has_data[i]):
+            entry['annual'].append({
+                'year': int(years[j]),
+                **{name: {'value': _to_float(values[m, i, j]), 'contribution': _to_float(contributions[m, i, j])}
+                   for m, name in enumerate(PORTFOLIO_METRICS)}
+            })
+        result_holdings.append(entry)
+
+    return {
+        'holding_count': len(tickers),
+        'metrics': PORTFOLIO_METRICS,
+        'latest': {
+            name: {'value': _to_float(latest[m]), 'coverage': float(latest_coverage[m])}
+            for m, name in enumerate(PORTFOLIO_METRICS)
+        },
+        'years': result_years,
+        'holdings': result_holdings
+    }
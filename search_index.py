@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""ティッカー・会社名の検索（オートコンプリート用）
+
+PostgreSQLでは pg_trgm のGINインデックスを使ってデータベース側で検索する。
+SQLite、またはpg_trgmが使えない環境では、保存済み銘柄からプロセス内の索引を作って検索する。
+索引はデータ更新の通知（invalidate）か、データバージョンの変化を検知したときに作り直す。
+
+プロセス内の索引:
+- ティッカーと会社名の各単語を昇順に並べたリスト（前方一致を二分探索で探す）
+- 3文字組（trigram）からティッカー・単語への転置索引（前方一致で足りないときのあいまい検索。
+  pg_trgmのword_similarityと同様に、最も近い単語との類似度を銘柄の類似度とする）
+"""
+import re
+import time
+import heapq
+import bisect
+import threading
+from collections import Counter
+
+import metrics
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+# あいまい検索で候補とする類似度の下限（pg_trgmの既定値と同じ）
+SIMILARITY_THRESHOLD = 0.3
+
+# データバージョンの確認間隔（秒）
+VERSION_CHECK_INTERVAL = 1.0
+
+_WORD_PATTERN = re.compile(r'[0-9a-z]+')
+
+
+def words(text):
+    """検索語・会社名の単語（英数字の並び、小文字）"""
+    return _WORD_PATTERN.findall(text.lower())
+
+
+def trigrams(text):
+    """pg_trgmと同様に、単語ごとに前に空白2つ・後ろに空白1つを付けて3文字組を作る"""
+    result = set()
+    for word in _WORD_PATTERN.findall(text.lower()):
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class PrefixIndex:
+    """保存済み銘柄の前方一致・あいまい検索用索引（作成後は読み取り専用）"""
+
+    def __init__(self, stocks, data_version=None):
+        self.data_version = data_version
+        self.entries = [
+            {'ticker': stock['ticker'], 'company_name': stock.get('company_name'), 'country': stock.get('country')}
+            for stock in stocks
+        ]
+
+        ticker_keys = []
+        word_keys = []
+        # あいまい検索の対象語（ティッカーと会社名の各単語）: (3文字組の数, 銘柄番号)
+        self._terms = []
+        postings = {}
+        for i, entry in enumerate(self.entries):
+            ticker = entry['ticker'].upper()
+            words = set(_WORD_PATTERN.findall((entry['company_name'] or '').lower()))
+            ticker_keys.append((ticker, i))
+            word_keys.extend((word, i) for word in words)
+
+            for term in [ticker] + sorted(words):
+                grams = trigrams(term)
+                if not grams:
+                    continue
+                term_id = len(self._terms)
+                self._terms.append((len(grams), i))
+                for gram in grams:
+                    postings.setdefault(gram, []).append(term_id)
+
+        ticker_keys.sort()
+        word_keys.sort()
+        self._ticker_keys = ticker_keys
+        self._word_keys = word_keys
+        self._postings = postings
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _prefix_matches(keys, prefix):
+        """昇順のキー列から前方一致する要素を順に返す"""
+        i = bisect.bisect_left(keys, (prefix,))
+        while i < len(keys) and keys[i][0].startswith(prefix):
+            yield keys[i]
+            i += 1
+
+    def search(self, query, limit=DEFAULT_LIMIT):
+        """完全一致 → ティッカー前方一致 → 会社名の単語前方一致 → あいまい一致の順に返す"""
+        query = query.strip()
+        if not query:
+            return []
+
+        results = []
+        seen = set()
+
+        def add(i, match, score):
+            if i not in seen and len(results) < limit:
+                seen.add(i)
+                results.append(dict(self.entries[i], match=match, score=round(score, 3)))
+
+        # 完全一致は前方一致の先頭に並ぶ
+        ticker_query = query.upper()
+        for ticker, i in self._prefix_matches(self._ticker_keys, ticker_query):
+            if ticker == ticker_query:
+                add(i, 'ticker', 1.0)
+            else:
+                add(i, 'ticker_prefix', len(ticker_query) / len(ticker))
+            if len(results) >= limit:
+                return results
+
+        # 会社名は全ての単語が（最後の単語は前方一致で）含まれる銘柄に絞る。
+        # 最後の単語が一致した語に近いほど、会社名が短いほど上位にする
+        query_words = words(query)
+        if query_words:
+            *leading, last = query_words
+            scores = {}
+            for key, i in self._prefix_matches(self._word_keys, last):
+                if i not in seen:
+                    scores[i] = max(scores.get(i, 0.0), 0.5 + 0.4 * len(last) / len(key))
+            for word in leading:
+                if not scores:
+                    break
+                exact = {i for key, i in self._prefix_matches(self._word_keys, word) if key == word}
+                scores = {i: score for i, score in scores.items() if i in exact}
+            ranked = heapq.nsmallest(limit - len(results), scores.items(), key=lambda item: (
+                -item[1], len(self.entries[item[0]]['company_name'] or ''), self.entries[item[0]]['ticker']))
+            for i, score in ranked:
+                add(i, 'name', score)
+                if len(results) >= limit:
+                    return results
+
+        # 前方一致で足りなければ3文字組の転置索引からあいまい一致を探す
+        query_grams = trigrams(query)
+        if not query_grams:
+            return results
+        shared_counts = Counter()
+        for gram in query_grams:
+            shared_counts.update(self._postings.get(gram, ()))
+        best = {}
+        for term_id, shared in shared_counts.items():
+            gram_count, i = self._terms[term_id]
+            if i in seen:
+                continue
+            score = shared / (len(query_grams) + gram_count - shared)
+            if score >= SIMILARITY_THRESHOLD and score > best.get(i, 0.0):
+                best[i] = score
+        scored = heapq.nsmallest(limit - len(results), ((score, i) for i, score in best.items()),
+                                 key=lambda item: (-item[0], self.entries[item[1]]['ticker']))
+        for score, i in scored:
+            add(i, 'fuzzy', score)
+            if len(results) >= limit:
+                break
+        return results
+
+
+class SearchIndexManager:
+    """プロセス内索引の保持と作り直しを管理"""
+
+    def __init__(self, db_factory):
+        self.db_factory = db_factory
+        self._index = None
+        self._stale = True
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """データ更新を通知（次の検索時に作り直す）"""
+        self._stale = True
+
+    def get_index(self):
+        """最新の索引を取得（作り直しが必要なら作成）"""
+        index = self._index
+        now = time.monotonic()
+        if index is not None and not self._stale and now - self._last_check < VERSION_CHECK_INTERVAL:
+            metrics.record_cache('search_index', True)
+            return index
+
+        db = self.db_factory()
+        version = db.get_data_version()
+        self._last_check = now
+        if index is not None and not self._stale and index.data_version == version:
+            metrics.record_cache('search_index', True)
+            return index
+
+        metrics.record_cache('search_index', False)
+        with self._lock:
+            # ロック待ちの間に他のスレッドが作成済みなら再利用する
+            if self._index is not None and self._index.data_version == version and not self._stale:
+                return self._index
+            self._stale = False
+            self._index = PrefixIndex(db.get_all_stocks(), data_version=version)
+            return self._index
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """プロセス内で共有するSearchIndexManagerを取得"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            from db_backend import get_database
+            _manager = SearchIndexManager(get_database)
+        return _manager
+
+
+def search(db, query, limit=DEFAULT_LIMIT):
+    """データベースの索引（pg_trgm）が使えればそれを、なければプロセス内索引で検索"""
+    limit = max(1, min(limit, MAX_LIMIT))
+    search_stocks = getattr(db, 'search_stocks', None)
+    if search_stocks is not None:
+        results = search_stocks(query, limit)
+        if results is not None:
+            return {'query': query, 'strategy': 'trigram', 'results': results}
+    index = get_manager().get_index()
+    return {'query': query, 'strategy': 'memory', 'results': index.search(query, limit)}
@@ -1,23 +1,303 @@
 #!/usr/bin/env python3
 import yfinance as yf
-import requests
+import os
 import json
+import time
+import threading
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
-from database_postgres import PostgreSQLDatabase as StockDatabase
+import metrics
+import metric_registry
+
+# 情報・財務諸表を並行して取得する共有スレッドプールの最大スレッド数（全分析で共有）
+STATEMENT_FETCH_WORKERS = int(os.environ.get('STATEMENT_FETCH_WORKERS', '16'))
+
+# 1回の分析で情報・財務諸表の取得を待つ上限（秒）
+ANALYSIS_TIMEOUT = float(os.environ.get('ANALYSIS_TIMEOUT', '30'))
+
+_fetch_executor = None
+_fetch_executor_lock = threading.Lock()
+
+def get_fetch_executor():
+    """情報・財務諸表の取得に使う共有スレッドプールを取得"""
+    global _fetch_executor
+    with _fetch_executor_lock:
+        if _fetch_executor is None:
+            _fetch_executor = ThreadPoolExecutor(
+                max_workers=STATEMENT_FETCH_WORKERS, thread_name_prefix='statement-fetch'
+            )
+        return _fetch_executor
+
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool(processes=None):
+    """財務諸表の抽出・計算に使う共有プロセスプールを取得（最初の呼び出しでプロセス数が決まる）
+    
+    スレッドを使うプロセスでforkするとロックが壊れることがあるため、spawnで起動する。
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=processes or os.cpu_count(),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _process_pool
+
+class AnalysisTimeout(Exception):
+    """情報・財務諸表の取得が制限時間内に終わらなかった"""
+
+class AnalysisCancelled(Exception):
+    """分析が取り消された（クライアントの切断など）"""
+
+class InvalidTicker(Exception):
+    """存在しない・上場廃止などで分析できない銘柄
+    
+    error_class: 'not_found'（銘柄が見つからない）または 'delisted'（株価・時価総額がない）
+    cached: 以前の失敗を記憶していたため、取得せずに送出した場合はTrue
+    """
+    
+    MESSAGES = {
+        'not_found': '{ticker}は見つかりませんでした（ティッカーコードを確認してください）',
+        'delisted': '{ticker}の株価・時価総額を取得できませんでした（上場廃止の可能性があります）'
+    }
+    
+    def __init__(self, ticker, error_class, cached=False):
+        # プロセスプールから例外を受け渡せるよう、引数をそのままargsにする
+        super().__init__(ticker, error_class, cached)
+        self.ticker = ticker
+        self.error_class = error_class
+        self.cached = cached
+    
+    def __str__(self):
+        return self.MESSAGES[self.error_class].format(ticker=self.ticker)
+
+def classify_lookup_failure(error=None, info=None):
+    """情報（info）の取得結果から、銘柄が存在しない・上場廃止かを判定（判定できなければNone）
+    
+    レート制限・タイムアウトなどの一時的な失敗は記憶すべきでないため None を返す。
+    """
+    if error is not None:
+        if isinstance(error, (AnalysisTimeout, AnalysisCancelled)) or metrics.is_throttle_error(error):
+            return None
+        text = str(error).lower()
+        if '404' in text or 'not found' in text or 'no data found' in text:
+            return 'not_found'
+        return None
+    if not info or not any(info.get(key) for key in ('longName', 'shortName', 'quoteType')):
+        return 'not_found'
+    if not any(info.get(key) for key in ('marketCap', 'currentPrice', 'regularMarketPrice')):
+        return 'delisted'
+    return None
+
+class StatementSet:
+    """1回の分析で使う情報・財務諸表（同じものは1度だけ取得して使い回す）
+    
+    prefetch で必要なものを共有スレッドプールで並行して取得し始め、get で結果を待つ。
+    待ち時間は分析全体の制限時間（timeout秒）までで、超えたら未開始の取得を取り消して
+    AnalysisTimeout を送出する。各セクションの取得処理は例外を握りつぶして空の結果を返すため、
+    制限時間切れ・取り消しは check() で改めて確認する。
+    """
+
+    def __init__(self, analyzer, ticker, timeout=None):
+        self.analyzer = analyzer
+        self.ticker = ticker
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self._futures = {}
+        self._packed = {}
+        self._tables = {}
+        self._lock = threading.Lock()
+        self._error = None
+
+    def _fetch(self, name):
+        if self._error is not None:
+            raise self._error
+        # 共有キャッシュにあればそれを使う
+        cache = self.analyzer.cache
+        cache_key = f'statement:{self.ticker}:{name}'
+        packed = cache.get(cache_key)
+        metrics.record_cache('statement', packed is not None)
+        if packed is not None:
+            self._packed[name] = packed
+            return unpack_statement(name, packed)
+        
+        # yfinanceのTickerはスレッドセーフではないため、取得ごとに作る
+        value = self.analyzer._fetch_statement(yf.Ticker(self.ticker), name)
+        try:
+            packed = pack_statement(name, value)
+        except (TypeError, ValueError):
+            packed = None
+        self._packed[name] = packed
+        # 空の情報・財務諸表（一時的な取得失敗のことがある）はキャッシュしない
+        if packed and (name == 'info' or packed['index']):
+            import cache_backend
+            cache.set(cache_key, packed, cache_backend.STATEMENT_TTL.get(name, cache_backend.STATEMENT_TTL['default']))
+        return value
+
+    def prefetch(self, names):
+        """まだ取得していない情報・財務諸表の取得を共有スレッドプールで並行して始める"""
+        executor = get_fetch_executor()
+        with self._lock:
+            for name in names:
+                if name not in self._futures and self._error is None:
+                    self._futures[name] = executor.submit(self._fetch, name)
+
+    def get(self, name):
+        """情報・財務諸表を取得（取得に失敗した場合は、再取得せず同じ例外を送出）"""
+        with self._lock:
+            future = self._futures.get(name)
+            fetch_here = future is None
+            if fetch_here:
+                future = self._futures[name] = Future()
+        
+        if fetch_here:
+            # prefetchしていないものは呼び出し元のスレッドで取得する
+            try:
+                future.set_result(self._fetch(name))
+            except Exception as e:
+                future.set_exception(e)
+        
+        try:
+            return future.result(timeout=self.remaining())
+        except FutureTimeoutError:
+            self.cancel(AnalysisTimeout(f"{self.ticker}の財務データの取得が時間内に終わりませんでした"))
+            raise self._error
+
+    def table(self, name):
+        """財務諸表から登録済みの指標をまとめて取り出した表（metric_registry.MetricTable）"""
+        self.get(name)
+        if name not in self._tables:
+            self._tables[name] = metric_registry.extract(name, self._packed.get(name))
+        return self._tables[name]
+
+    def remaining(self):
+        """制限時間までの残り秒数（制限なしならNone）"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def futures(self, names):
+        """取得を始めた情報・財務諸表のうち、指定したもののFuture（非同期に完了を待つ用）"""
+        with self._lock:
+            return [self._futures[name] for name in names if name in self._futures]
+
+    def cancel(self, error=None):
+        """未開始の取得を取り消す（実行中の取得は終わるのを待たず、結果を捨てる）"""
+        with self._lock:
+            if self._error is None:
+                self._error = error or AnalysisCancelled(f"{self.ticker}の分析が取り消されました")
+            for future in self._futures.values():
+                future.cancel()
+
+    def check(self):
+        """制限時間切れ・取り消しが起きていれば例外を送出"""
+        if self._error is not None:
+            raise self._error
+
+# 分析に使う情報（info）の項目（プロセス間で受け渡すときはこれだけを送る）
+INFO_KEYS = (
+    'marketCap', 'currentPrice', 'regularMarketPrice', 'sharesOutstanding', 'dividendYield', 'dividendRate',
+    'longName', 'shortName', 'quoteType', 'country', 'currency', 'financialCurrency', 'sector', 'industry'
+)
+
+def pack_statement(name, value):
+    """情報・財務諸表をプロセス間で受け渡す形（項目名・決算日・float64の2次元配列）にする"""
+    if value is None:
+        return None
+    if name == 'info':
+        return {key: value[key] for key in INFO_KEYS if key in value}
+    try:
+        values = value.to_numpy(dtype='float64', na_value=np.nan)
+    except (TypeError, ValueError):
+        values = value.apply(pd.to_numeric, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+    return {
+        'index': [str(label) for label in value.index],
+        'dates': np.asarray(pd.to_datetime(value.columns), dtype='datetime64[ns]'),
+        'values': values
+    }
+
+def unpack_statement(name, packed):
+    """pack_statement の逆変換"""
+    if packed is None or name == 'info':
+        return packed
+    return pd.DataFrame(packed['values'], index=packed['index'], columns=pd.DatetimeIndex(packed['dates']))
+
+class PackedStatements:
+    """pack_statement した情報・財務諸表（StatementSet と同じ get で取り出す。プロセスプール側で使う）"""
+
+    def __init__(self, ticker, packed, errors):
+        self.ticker = ticker
+        self.packed = packed
+        self.errors = errors
+        self._values = {}
+        self._tables = {}
+
+    def get(self, name):
+        if name in self.errors:
+            raise RuntimeError(self.errors[name])
+        if name not in self._values:
+            self._values[name] = unpack_statement(name, self.packed[name])
+        return self._values[name]
+
+    def table(self, name):
+        if name in self.errors:
+            raise RuntimeError(self.errors[name])
+        if name not in self._tables:
+            self._tables[name] = metric_registry.extract(name, self.packed[name])
+        return self._tables[name]
+
+    def check(self):
+        pass
+
+    def cancel(self, error=None):
+        pass
 
 class StockAnalyzer:
     """株式の配当と自社株買いを分析するクラス"""
     
-    def __init__(self):
-        self.db = StockDatabase()
+    def __init__(self, db=None, cache=None):
+        self._db = db
+        self._cache = cache
+    
+    @property
+    def db(self):
+        """データベース（保存時に初めて接続する）"""
+        if self._db is None:
+            from db_backend import get_database
+            self._db = get_database()
+        return self._db
+    
+    @property
+    def cache(self):
+        """取得した財務諸表と分析結果の共有キャッシュ（cache_backend）"""
+        if self._cache is None:
+            import cache_backend
+            self._cache = cache_backend.get_cache()
+        return self._cache
     
-    def get_stock_data(self, ticker):
+    def _cached_analysis(self, ticker, planned, analyze):
+        """分析結果を共有キャッシュから取得（なければ analyze() の結果を保存して返す）"""
+        import cache_backend
+        return self.cache.get_or_set(
+            f"analysis:{ticker}:{','.join(planned)}", analyze,
+            ttl=cache_backend.ANALYSIS_TTL, metric='analysis'
+        )
+    
+    def _fetch_statement(self, stock, name):
+        """yfinanceのTickerから情報・財務諸表を取得（上流呼び出しを計測）"""
+        with metrics.track_upstream(name):
+            return getattr(stock, name)
+    
+    def get_stock_data(self, ticker, statements=None):
         """ティッカーコードから株式データを取得"""
         try:
             # 入力されたティッカーをそのまま使用（Yahoo Financeと同じ形式）
-            stock = yf.Ticker(ticker)
-            info = stock.info
+            statements = statements or StatementSet(self, ticker)
+            info = statements.get('info')
             
             # 基本情報を取得
             market_cap = info.get('marketCap', 0)
@@ -38,6 +318,9 @@ class StockAnalyzer:
                 'dividend_rate': dividend_rate,
                 'country': info.get('country', 'N/A'),
                 'currency': info.get('currency', 'USD'),
+                'financial_currency': info.get('financialCurrency'),  # 財務諸表の通貨（取引通貨と異なることがある）
+                'sector': info.get('sector'),
+                'industry': info.get('industry'),
                 'info': info
             }
         except Exception as e:
@@ -50,7 +333,7 @@ class StockAnalyzer:
             stock = yf.Ticker(ticker)
             
             # キャッシュフロー計算書を取得
-            cashflow = stock.cashflow
+            cashflow = self._fetch_statement(stock, 'cashflow')
             
             if cashflow is not None and not cashflow.empty:
                 print(f"  キャッシュフロー計算書の利用可能な期間:")
@@ -58,14 +341,7 @@ class StockAnalyzer:
                 print(f"    期間: {cashflow.columns.tolist()}")
                 
                 # 自社株買い（Repurchase Of Stock）を探す
-                repurchase_keys = [
-                    'Repurchase Of Capital Stock',
-                    'Repurchase Of Stock',
-                    'Purchase Of Stock', 
-                    'Common Stock Repurchased',
-                    'Stock Repurchased',
-                    'Purchase of Stock'
-                ]
+                repurchase_keys = metric_registry.METRICS['repurchase'][1]
                 
                 repurchase_data = {
                     'latest': 0,
@@ -116,7 +392,7 @@ class StockAnalyzer:
         """Capital Expenditure（設備投資）データを取得"""
         try:
             stock = yf.Ticker(ticker)
-            cashflow = stock.cashflow
+            cashflow = self._fetch_statement(stock, 'cashflow')
             
             capex_data = {
                 'latest': 0,
@@ -128,13 +404,7 @@ class StockAnalyzer:
                 print(f"  Capital Expenditure取得:")
                 
                 # CapExの項目を探す
-                capex_keys = [
-                    'Capital Expenditure',
-                    'Capital Expenditures',
-                    'Purchase Of Property Plant Equipment',
-                    'Capex',
-                    'Purchase of Property, Plant and Equipment'
-                ]
+                capex_keys = metric_registry.METRICS['capex'][1]
                 
                 found_key = None
                 for key in capex_keys:
@@ -180,7 +450,7 @@ class StockAnalyzer:
             stock = yf.Ticker(ticker)
             
             # キャッシュフロー計算書から配当支払額を取得
-            cashflow = stock.cashflow
+            cashflow = self._fetch_statement(stock, 'cashflow')
             
             dividend_data = {'annual_data': []}
             
@@ -188,11 +458,7 @@ class StockAnalyzer:
                 print(f"  配当履歴の取得:")
                 
                 # 配当支払い項目を探す
-                dividend_keys = [
-                    'Cash Dividends Paid',
-                    'Common Stock Dividend Paid',
-                    'Dividends Paid'
-                ]
+                dividend_keys = metric_registry.METRICS['dividends'][1]
                 
                 found_key = None
                 for key in dividend_keys:
@@ -215,7 +481,7 @@ class StockAnalyzer:
                 if not found_key:
                     print(f"    配当データが見つかりませんでした")
                     # フォールバック: 現在の配当レートを使用
-                    current_info = stock.info
+                    current_info = self._fetch_statement(stock, 'info')
                     current_dividend = current_info.get('dividendRate', 0)
                     shares_outstanding = current_info.get('sharesOutstanding', 0)
                     
@@ -471,71 +737,298 @@ class StockAnalyzer:
             'total_returns': total_returns
         }
     
-    def analyze_stock_for_web(self, ticker):
-        """Web用の株式分析（出力なし）"""
-        # 基本データ取得
-        stock_data = self.get_stock_data(ticker)
-        if not stock_data:
-            return None
+    # Web用分析で順に返すセクション
+    WEB_SECTIONS = ('basic', 'dividends', 'buybacks', 'capex', 'revenue', 'debt', 'roi', 'totals')
+    
+    # セクションごとに取得が必要な情報・財務諸表
+    SECTION_STATEMENTS = {
+        'basic': ('info',),
+        'dividends': ('cashflow',),
+        'buybacks': ('cashflow',),
+        'capex': ('cashflow',),
+        'revenue': ('financials', 'cashflow'),
+        'debt': ('cashflow',),
+        'roi': ('financials', 'balance_sheet'),
+        'totals': ()
+    }
+    
+    # 計算に他のセクションの結果を使うセクション
+    SECTION_DEPENDENCIES = {
+        'totals': ('dividends', 'buybacks', 'capex', 'revenue')
+    }
+    
+    @classmethod
+    def plan_sections(cls, sections=None):
+        """要求されたセクションから、計算するセクションと取得する情報・財務諸表を決める
         
-        # 自社株買い情報取得（出力を抑制）
-        repurchase_data = self.get_financial_statements_silent(ticker)
+        sections が None なら全セクション。基本データ（時価総額など）は全セクションの計算に
+        使うため常に含め、依存するセクションも加える。
+        返り値: (計算するセクション, 取得する情報・財務諸表) をそれぞれ WEB_SECTIONS の順で
+        """
+        if sections is None:
+            requested = set(cls.WEB_SECTIONS)
+        else:
+            requested = set(sections)
+            unknown = requested - set(cls.WEB_SECTIONS)
+            if unknown:
+                raise ValueError(
+                    f"未対応のセクションです: {', '.join(sorted(unknown))}"
+                    f"（指定可能: {', '.join(cls.WEB_SECTIONS)}）"
+                )
         
-        # 配当履歴取得（出力を抑制）
-        dividend_data = self.get_dividend_history_silent(ticker)
+        requested.add('basic')
+        for section in list(requested):
+            requested.update(cls.SECTION_DEPENDENCIES.get(section, ()))
+        planned = tuple(section for section in cls.WEB_SECTIONS if section in requested)
         
-        # CapExデータ取得（出力を抑制）
-        capex_data = self.get_capex_data_silent(ticker)
+        statements = []
+        for section in planned:
+            for name in cls.SECTION_STATEMENTS[section]:
+                if name not in statements:
+                    statements.append(name)
+        return planned, tuple(statements)
+    
+    def iter_analysis_for_web(self, ticker, sections=None, timeout=None, statements=None):
+        """Web用の株式分析をセクションごとに返す（出力なし）
         
-        # Revenue & Cash Flowデータ取得（出力を抑制）
-        revenue_cashflow_data = self.get_revenue_and_cashflow_data_silent(ticker)
+        (セクション名, 分析結果に加える項目の辞書) を WEB_SECTIONS の順に返す。
+        sections を指定すると、そのセクション（と計算に必要なセクション）だけを計算し、
+        使わない財務諸表は取得しない。必要な財務諸表は最初に共有スレッドプールで並行して取得し始め、
+        同じ財務諸表は1回の分析で1度だけ取得する。
+        取得が timeout 秒（既定は ANALYSIS_TIMEOUT）で終わらなければ AnalysisTimeout を送出し、
+        途中で閉じられた場合は未開始の取得を取り消す。
+        statements に StatementSet を渡すと、それを使って取得する（呼び出し元で取得の完了を待つ場合。
+        start_statements で作る）。
+        存在しない・上場廃止の銘柄は InvalidTicker を送出し、しばらくの間は取得せずに同じ例外を送出する。
+        それ以外の理由で基本データが取得できなければ何も返さない。
+        データベースへは全セクションを計算した場合のみ、totals を返す前に保存する
+        （一部のセクションだけでは保存済みの年次データを欠けた値で上書きしてしまうため）。
+        """
+        if statements is None:
+            planned, _, statements = self.start_statements(ticker, sections, timeout)
+        else:
+            planned, statement_names = self.plan_sections(sections)
+            statements.prefetch(statement_names)
+        try:
+            yield from self._iter_sections(ticker, planned, statements)
+        except InvalidTicker as e:
+            self.remember_invalid_ticker(e)
+            raise
+        finally:
+            statements.cancel()
+    
+    def start_statements(self, ticker, sections=None, timeout=None):
+        """分析を始める（記憶している無効な銘柄なら取得せずに InvalidTicker を送出）
         
-        # 債務データ取得（出力を抑制）
-        debt_data = self.get_debt_data_silent(ticker)
+        返り値: (計算するセクション, 取得する情報・財務諸表, 取得を始めた StatementSet)
+        """
+        self.reject_invalid_ticker(ticker)
+        planned, statement_names = self.plan_sections(sections)
+        statements = StatementSet(self, ticker, ANALYSIS_TIMEOUT if timeout is None else timeout)
+        statements.prefetch(statement_names)
+        return planned, statement_names, statements
+    
+    def reject_invalid_ticker(self, ticker):
+        """存在しない・上場廃止として記憶している銘柄なら InvalidTicker を送出"""
+        entry = self.cache.get(f'invalid_ticker:{ticker}')
+        metrics.record_cache('invalid_ticker', entry is not None)
+        if entry is not None:
+            raise InvalidTicker(ticker, entry['error_class'], cached=True)
+    
+    def remember_invalid_ticker(self, error):
+        """存在しない・上場廃止の銘柄を短い期間記憶する（期間は種類ごとに cache_backend.INVALID_TICKER_TTL）"""
+        if error.cached:
+            return
+        import cache_backend
+        self.cache.set(
+            f'invalid_ticker:{error.ticker}',
+            {'error_class': error.error_class, 'recorded_at': datetime.now().isoformat()},
+            ttl=cache_backend.INVALID_TICKER_TTL[error.error_class]
+        )
+    
+    def forget_invalid_tickers(self, ticker=None):
+        """記憶している無効な銘柄を消す（tickerを省略すると全て）。消した件数を返す"""
+        if ticker is None:
+            return self.cache.clear('invalid_ticker:')
+        key = f'invalid_ticker:{ticker}'
+        if self.cache.get(key) is None:
+            return 0
+        self.cache.delete(key)
+        return 1
+    
+    def _iter_sections(self, ticker, planned, statements, save=True):
+        """iter_analysis_for_webの本体（計算するセクションと取得中の財務諸表を受け取る）"""
+        # 存在しない・上場廃止の銘柄は他のセクションを計算せずに終える
+        try:
+            error_class = classify_lookup_failure(info=statements.get('info'))
+        except (AnalysisTimeout, AnalysisCancelled):
+            raise
+        except Exception as e:
+            error_class = classify_lookup_failure(error=e)
+        if error_class is not None:
+            raise InvalidTicker(ticker, error_class)
         
-        # ROIデータ取得（出力を抑制）
-        roi_data = self.get_roi_data_silent(ticker)
+        # 基本データ取得
+        stock_data = self.get_stock_data(ticker, statements)
+        if not stock_data:
+            statements.check()
+            return
         
-        # 各種利回り計算
         current_dividend_yield = self.calculate_dividend_yield(stock_data)
-        buyback_yields = self.calculate_buyback_equivalent_yield_silent(stock_data, repurchase_data)
-        capex_yields = self.calculate_capex_equivalent_yield_silent(stock_data, capex_data)
-        total_returns = self.calculate_total_shareholder_return(stock_data['market_cap'], dividend_data, buyback_yields, capex_yields, revenue_cashflow_data)
-        
-        # 分析結果を構造化
-        analysis_result = {
+        basic = {
             'ticker': ticker,
             'company_name': stock_data['company_name'],
             'country': stock_data.get('country', 'N/A'),
             'currency': stock_data.get('currency', 'USD'),
+            'financial_currency': stock_data.get('financial_currency'),
+            'sector': stock_data.get('sector'),
+            'industry': stock_data.get('industry'),
             'current_price': stock_data['current_price'],
             'market_cap': stock_data['market_cap'],
             'dividend_rate': stock_data['dividend_rate'],
-            'current_dividend_yield': current_dividend_yield,
-            'dividend_data': dividend_data,
-            'repurchase_data': repurchase_data,
-            'buyback_yields': buyback_yields,
-            'capex_data': capex_data,
-            'capex_yields': capex_yields,
-            'revenue_cashflow_data': revenue_cashflow_data,
-            'debt_data': debt_data,
-            'roi_data': roi_data,
-            'total_returns': total_returns
+            'current_dividend_yield': current_dividend_yield
         }
+        yield 'basic', basic
+        analysis_result = dict(basic)
         
-        # データベースに保存
-        try:
-            self.db.save_stock_analysis(analysis_result)
-        except Exception as e:
-            print(f"データベース保存エラー: {e}")
+        # 配当履歴取得（出力を抑制）
+        if 'dividends' in planned:
+            dividend_data = self.get_dividend_history_silent(ticker, statements)
+            analysis_result['dividend_data'] = dividend_data
+            statements.check()
+            yield 'dividends', {'dividend_data': dividend_data}
         
+        # 自社株買い情報取得（出力を抑制）
+        if 'buybacks' in planned:
+            repurchase_data = self.get_financial_statements_silent(ticker, statements)
+            buyback_yields = self.calculate_buyback_equivalent_yield_silent(stock_data, repurchase_data)
+            analysis_result.update(repurchase_data=repurchase_data, buyback_yields=buyback_yields)
+            statements.check()
+            yield 'buybacks', {'repurchase_data': repurchase_data, 'buyback_yields': buyback_yields}
+        
+        # CapExデータ取得（出力を抑制）
+        if 'capex' in planned:
+            capex_data = self.get_capex_data_silent(ticker, statements)
+            capex_yields = self.calculate_capex_equivalent_yield_silent(stock_data, capex_data)
+            analysis_result.update(capex_data=capex_data, capex_yields=capex_yields)
+            statements.check()
+            yield 'capex', {'capex_data': capex_data, 'capex_yields': capex_yields}
+        
+        # Revenue & Cash Flowデータ取得（出力を抑制）
+        if 'revenue' in planned:
+            revenue_cashflow_data = self.get_revenue_and_cashflow_data_silent(ticker, statements)
+            analysis_result['revenue_cashflow_data'] = revenue_cashflow_data
+            statements.check()
+            yield 'revenue', {'revenue_cashflow_data': revenue_cashflow_data}
+        
+        # 債務データ取得（出力を抑制）
+        if 'debt' in planned:
+            debt_data = self.get_debt_data_silent(ticker, statements)
+            analysis_result['debt_data'] = debt_data
+            statements.check()
+            yield 'debt', {'debt_data': debt_data}
+        
+        # ROIデータ取得（出力を抑制）
+        if 'roi' in planned:
+            roi_data = self.get_roi_data_silent(ticker, statements)
+            analysis_result['roi_data'] = roi_data
+            statements.check()
+            yield 'roi', {'roi_data': roi_data}
+        
+        if 'totals' not in planned:
+            return
+        
+        # 総合株主還元率を計算
+        total_returns = self.calculate_total_shareholder_return(stock_data['market_cap'], dividend_data, buyback_yields, capex_yields, revenue_cashflow_data)
+        analysis_result['total_returns'] = total_returns
+        
+        # 全セクションを計算した分析結果のみデータベースに保存
+        if save and planned == self.WEB_SECTIONS:
+            try:
+                self.db.save_stock_analysis(analysis_result)
+            except Exception as e:
+                print(f"データベース保存エラー: {e}")
+        
+        yield 'totals', {'total_returns': total_returns}
+    
+    def analyze_stock_for_web(self, ticker, sections=None, timeout=None):
+        """Web用の株式分析（出力なし、sectionsで計算するセクションを絞れる）
+        
+        結果は共有キャッシュに保存し、有効期限内の同じ分析にはそれを返す。
+        """
+        def analyze():
+            analysis_result = {}
+            for _, fields in self.iter_analysis_for_web(ticker, sections, timeout):
+                analysis_result.update(fields)
+            return analysis_result or None
+        
+        planned, _ = self.plan_sections(sections)
+        return self._cached_analysis(ticker, planned, analyze)
+    
+    def analyze_stock_in_process(self, ticker, sections=None, timeout=None, processes=None):
+        """Web用の株式分析の財務諸表の抽出・計算をプロセスプールで行う（一括処理用）
+        
+        取得はこれまで通り共有スレッドプールで行い、取得した財務諸表を数値配列にして
+        プロセスプールへ送る。pandasでの抽出・計算がGILを握り続けないため、
+        多数の銘柄を並行して分析するときに全コアを使える。保存はこのプロセスで行う。
+        結果は analyze_stock_for_web と同じ。
+        """
+        planned, _ = self.plan_sections(sections)
+        
+        def analyze():
+            _, statement_names, statements = self.start_statements(ticker, sections, timeout)
+            try:
+                packed, errors = self.pack_statements(statements, statement_names)
+            finally:
+                statements.cancel()
+            
+            try:
+                items = get_process_pool(processes).submit(
+                    compute_packed_analysis, ticker, sections, packed, errors
+                ).result()
+            except InvalidTicker as e:
+                self.remember_invalid_ticker(e)
+                raise
+            return self.finish_packed_analysis(planned, items)
+        
+        return self._cached_analysis(ticker, planned, analyze)
+    
+    def pack_statements(self, statements, names):
+        """取得した情報・財務諸表をプロセス間で受け渡す形にする
+        
+        返り値: (名前ごとの pack_statement の結果, 取得に失敗したものの名前ごとのエラーメッセージ)
+        """
+        packed = {}
+        errors = {}
+        for name in names:
+            try:
+                packed[name] = pack_statement(name, statements.get(name))
+            except (AnalysisTimeout, AnalysisCancelled):
+                raise
+            except Exception as e:
+                errors[name] = str(e)
+        return packed, errors
+    
+    def finish_packed_analysis(self, planned, items):
+        """プロセスプールで計算したセクションをまとめ、全セクションなら保存する"""
+        analysis_result = {}
+        for _, fields in items:
+            analysis_result.update(fields)
+        if not analysis_result:
+            return None
+        
+        if planned == self.WEB_SECTIONS:
+            try:
+                self.db.save_stock_analysis(analysis_result)
+            except Exception as e:
+                print(f"データベース保存エラー: {e}")
         return analysis_result
     
-    def get_financial_statements_silent(self, ticker):
+    def get_financial_statements_silent(self, ticker, statements=None):
         """財務諸表から自社株買い情報を取得（出力なし）"""
         try:
-            stock = yf.Ticker(ticker)
-            cashflow = stock.cashflow
+            statements = statements or StatementSet(self, ticker)
+            cashflow = statements.table('cashflow')
             
             repurchase_data = {
                 'latest': 0,
@@ -543,73 +1036,36 @@ class StockAnalyzer:
                 'annual_data': []
             }
             
-            if cashflow is not None and not cashflow.empty:
-                repurchase_keys = [
-                    'Repurchase Of Capital Stock',
-                    'Repurchase Of Stock',
-                    'Purchase Of Stock', 
-                    'Common Stock Repurchased',
-                    'Stock Repurchased',
-                    'Purchase of Stock'
+            if not cashflow.empty:
+                repurchase_data['annual_data'] = [
+                    {'year': year, 'amount': abs(value)} for year, value in cashflow.annual('repurchase')
                 ]
-                
-                for key in repurchase_keys:
-                    if key in cashflow.index:
-                        annual_amounts = []
-                        
-                        for i, (date, value) in enumerate(cashflow.loc[key].items()):
-                            if i < 3:  # 過去3年分
-                                if pd.notna(value):
-                                    amount = abs(value)
-                                    annual_amounts.append(amount)
-                                    repurchase_data['annual_data'].append({
-                                        'year': date.year,
-                                        'amount': amount
-                                    })
-                        
-                        if annual_amounts:
-                            repurchase_data['latest'] = annual_amounts[0]
-                            repurchase_data['three_year_avg'] = sum(annual_amounts) / len(annual_amounts)
-                        
-                        break
-                
-                return repurchase_data
+                annual_amounts = [data['amount'] for data in repurchase_data['annual_data']]
+                if annual_amounts:
+                    repurchase_data['latest'] = annual_amounts[0]
+                    repurchase_data['three_year_avg'] = sum(annual_amounts) / len(annual_amounts)
             
-            return {'latest': 0, 'three_year_avg': 0, 'annual_data': []}
+            return repurchase_data
             
         except Exception as e:
             return {'latest': 0, 'three_year_avg': 0, 'annual_data': []}
     
-    def get_dividend_history_silent(self, ticker):
+    def get_dividend_history_silent(self, ticker, statements=None):
         """過去3年分の配当履歴を取得（出力なし）"""
         try:
-            stock = yf.Ticker(ticker)
-            cashflow = stock.cashflow
+            statements = statements or StatementSet(self, ticker)
+            cashflow = statements.table('cashflow')
             
             dividend_data = {'annual_data': []}
             
-            if cashflow is not None and not cashflow.empty:
-                dividend_keys = [
-                    'Cash Dividends Paid',
-                    'Common Stock Dividend Paid',
-                    'Dividends Paid'
+            if not cashflow.empty:
+                dividend_data['annual_data'] = [
+                    {'year': year, 'amount': abs(value)} for year, value in cashflow.annual('dividends')
                 ]
                 
-                for key in dividend_keys:
-                    if key in cashflow.index:
-                        for i, (date, value) in enumerate(cashflow.loc[key].items()):
-                            if i < 3:  # 過去3年分
-                                if pd.notna(value):
-                                    dividend_amount = abs(value)
-                                    dividend_data['annual_data'].append({
-                                        'year': date.year,
-                                        'amount': dividend_amount
-                                    })
-                        break
-                
                 if not dividend_data['annual_data']:
                     # フォールバック
-                    current_info = stock.info
+                    current_info = statements.get('info')
                     current_dividend = current_info.get('dividendRate', 0)
                     shares_outstanding = current_info.get('sharesOutstanding', 0)
                     
@@ -655,9 +1111,9 @@ class StockAnalyzer:
             stock = yf.Ticker(ticker)
             
             # 損益計算書からRevenue取得
-            financials = stock.financials
+            financials = self._fetch_statement(stock, 'financials')
             # キャッシュフロー計算書からOperating Cash Flow取得
-            cashflow = stock.cashflow
+            cashflow = self._fetch_statement(stock, 'cashflow')
             
             revenue_cashflow_data = {
                 'annual_data': []
@@ -669,22 +1125,10 @@ class StockAnalyzer:
             if financials is not None and not financials.empty and cashflow is not None and not cashflow.empty:
                 
                 # Revenue項目を探す
-                revenue_keys = [
-                    'Total Revenue',
-                    'Revenue',
-                    'Net Sales',
-                    'Sales'
-                ]
+                revenue_keys = metric_registry.METRICS['revenue'][1]
                 
                 # Operating Cash Flow項目を探す
-                ocf_keys = [
-                    'Operating Cash Flow',
-                    'Cash Flow From Operating Activities',
-                    'Net Cash From Operating Activities',
-                    'Cash From Operating Activities',
-                    'Cash Flowsfromusedin Operating Activities Direct',  # インドネシア株用
-                    'Cash Flows From Used In Operating Activities Direct'
-                ]
+                ocf_keys = metric_registry.METRICS['operating_cash_flow'][1]
                 
                 revenue_key = None
                 ocf_key = None
@@ -738,11 +1182,11 @@ class StockAnalyzer:
             print(f"Revenue/Cash Flowデータの取得に失敗: {e}")
             return {'annual_data': []}
     
-    def get_capex_data_silent(self, ticker):
+    def get_capex_data_silent(self, ticker, statements=None):
         """Capital Expenditure（設備投資）データを取得（出力なし）"""
         try:
-            stock = yf.Ticker(ticker)
-            cashflow = stock.cashflow
+            statements = statements or StatementSet(self, ticker)
+            cashflow = statements.table('cashflow')
             
             capex_data = {
                 'latest': 0,
@@ -750,92 +1194,40 @@ class StockAnalyzer:
                 'annual_data': []
             }
             
-            if cashflow is not None and not cashflow.empty:
-                capex_keys = [
-                    'Capital Expenditure',
-                    'Capital Expenditures',
-                    'Purchase Of Property Plant Equipment',
-                    'Capex',
-                    'Purchase of Property, Plant and Equipment'
+            if not cashflow.empty:
+                capex_data['annual_data'] = [
+                    {'year': year, 'amount': abs(value)} for year, value in cashflow.annual('capex')
                 ]
-                
-                for key in capex_keys:
-                    if key in cashflow.index:
-                        annual_amounts = []
-                        for i, (date, value) in enumerate(cashflow.loc[key].items()):
-                            if i < 3:  # 過去3年分
-                                if pd.notna(value):
-                                    amount = abs(value)
-                                    annual_amounts.append(amount)
-                                    capex_data['annual_data'].append({
-                                        'year': date.year,
-                                        'amount': amount
-                                    })
-                        
-                        if annual_amounts:
-                            capex_data['latest'] = annual_amounts[0]
-                            capex_data['three_year_avg'] = sum(annual_amounts) / len(annual_amounts)
-                        break
+                annual_amounts = [data['amount'] for data in capex_data['annual_data']]
+                if annual_amounts:
+                    capex_data['latest'] = annual_amounts[0]
+                    capex_data['three_year_avg'] = sum(annual_amounts) / len(annual_amounts)
             
             return capex_data
             
         except Exception as e:
             return {'latest': 0, 'three_year_avg': 0, 'annual_data': []}
     
-    def get_debt_data_silent(self, ticker):
+    def get_debt_data_silent(self, ticker, statements=None):
         """債務発行・返済データを取得（出力なし）"""
         try:
-            stock = yf.Ticker(ticker)
-            cashflow = stock.cashflow
+            statements = statements or StatementSet(self, ticker)
+            cashflow = statements.table('cashflow')
             
             debt_data = {
                 'issuance': {'annual_data': []},
                 'repayment': {'annual_data': []}
             }
             
-            if cashflow is not None and not cashflow.empty:
-                # 債務発行の項目を探す
-                issuance_keys = [
-                    'Issuance Of Debt',
-                    'Proceeds From Issuance Of Debt',
-                    'Long Term Debt Issuance',
-                    'Net Long Term Debt Issuance',
-                    'Proceeds from Long-term Debt'
+            if not cashflow.empty:
+                # 債務発行は正の値のみ
+                debt_data['issuance']['annual_data'] = [
+                    {'year': year, 'amount': abs(value) if value > 0 else 0}
+                    for year, value in cashflow.annual('debt_issuance')
                 ]
-                
-                # 債務返済の項目を探す
-                repayment_keys = [
-                    'Repayment Of Debt',
-                    'Long Term Debt Payments',
-                    'Repayment of Long-term Debt',
-                    'Long Term Debt Repayment'
+                debt_data['repayment']['annual_data'] = [
+                    {'year': year, 'amount': abs(value)} for year, value in cashflow.annual('debt_repayment')
                 ]
-                
-                # 債務発行データを取得
-                for key in issuance_keys:
-                    if key in cashflow.index:
-                        for i, (date, value) in enumerate(cashflow.loc[key].items()):
-                            if i < 3:  # 過去3年分
-                                if pd.notna(value):
-                                    amount = abs(value) if value > 0 else 0  # 正の値のみ
-                                    debt_data['issuance']['annual_data'].append({
-                                        'year': date.year,
-                                        'amount': amount
-                                    })
-                        break
-                
-                # 債務返済データを取得
-                for key in repayment_keys:
-                    if key in cashflow.index:
-                        for i, (date, value) in enumerate(cashflow.loc[key].items()):
-                            if i < 3:  # 過去3年分
-                                if pd.notna(value):
-                                    amount = abs(value)  # 絶対値を取得
-                                    debt_data['repayment']['annual_data'].append({
-                                        'year': date.year,
-                                        'amount': amount
-                                    })
-                        break
             
             return debt_data
             
@@ -845,49 +1237,18 @@ class StockAnalyzer:
                 'repayment': {'annual_data': []}
             }
     
-    def get_roi_data_silent(self, ticker):
+    def get_roi_data_silent(self, ticker, statements=None):
         """ROI（総資産利益率）データを取得（出力なし）"""
         try:
-            stock = yf.Ticker(ticker)
-            financials = stock.financials
-            balance_sheet = stock.balance_sheet
+            statements = statements or StatementSet(self, ticker)
+            financials = statements.table('financials')
+            balance_sheet = statements.table('balance_sheet')
             
             roi_data = {'annual_data': []}
             
-            if financials is not None and not financials.empty and balance_sheet is not None and not balance_sheet.empty:
-                # 純利益の項目を探す
-                net_income_keys = [
-                    'Net Income',
-                    'Net Income From Continuing Operations',
-                    'Net Income Common Stockholders',
-                    'Net Income Including Noncontrolling Interests'
-                ]
-                
-                # 総資産の項目を探す
-                total_assets_keys = [
-                    'Total Assets',
-                    'Total Assets as Reported'
-                ]
-                
-                # 純利益データを取得
-                net_income_data = {}
-                for key in net_income_keys:
-                    if key in financials.index:
-                        for i, (date, value) in enumerate(financials.loc[key].items()):
-                            if i < 3:  # 過去3年分
-                                if pd.notna(value):
-                                    net_income_data[date.year] = value
-                        break
-                
-                # 総資産データを取得
-                total_assets_data = {}
-                for key in total_assets_keys:
-                    if key in balance_sheet.index:
-                        for i, (date, value) in enumerate(balance_sheet.loc[key].items()):
-                            if i < 3:  # 過去3年分
-                                if pd.notna(value):
-                                    total_assets_data[date.year] = value
-                        break
+            if not financials.empty and not balance_sheet.empty:
+                net_income_data = dict(financials.annual('net_income'))
+                total_assets_data = dict(balance_sheet.annual('total_assets'))
                 
                 # ROI計算
                 for year in net_income_data:
@@ -931,55 +1292,44 @@ class StockAnalyzer:
         
         return {'annual_yields': annual_yields}
     
-    def get_revenue_and_cashflow_data_silent(self, ticker):
+    def get_revenue_and_cashflow_data_silent(self, ticker, statements=None):
         """Total RevenueとOperating Cash Flowデータを取得（出力なし）"""
         try:
-            stock = yf.Ticker(ticker)
-            financials = stock.financials
-            cashflow = stock.cashflow
+            statements = statements or StatementSet(self, ticker)
+            financials = statements.table('financials')
+            cashflow = statements.table('cashflow')
             
             revenue_cashflow_data = {'annual_data': []}
             
-            if financials is not None and not financials.empty and cashflow is not None and not cashflow.empty:
-                revenue_keys = ['Total Revenue', 'Revenue', 'Net Sales', 'Sales']
-                ocf_keys = ['Operating Cash Flow', 'Cash Flow From Operating Activities', 'Net Cash From Operating Activities', 'Cash From Operating Activities', 'Cash Flowsfromusedin Operating Activities Direct', 'Cash Flows From Used In Operating Activities Direct']
-                
-                revenue_key = None
-                ocf_key = None
+            if not financials.empty and not cashflow.empty and financials.label('revenue') and cashflow.label('operating_cash_flow'):
+                revenue_data = financials.row('revenue').tolist()
+                ocf_data = cashflow.row('operating_cash_flow').tolist()
                 
-                for key in revenue_keys:
-                    if key in financials.index:
-                        revenue_key = key
-                        break
-                
-                for key in ocf_keys:
-                    if key in cashflow.index:
-                        ocf_key = key
-                        break
-                
-                if revenue_key and ocf_key:
-                    revenue_data = financials.loc[revenue_key]
-                    ocf_data = cashflow.loc[ocf_key]
+                for i in range(min(3, len(revenue_data), len(ocf_data))):
+                    rev_value = revenue_data[i]
+                    ocf_value = ocf_data[i]
                     
-                    for i in range(min(3, len(revenue_data), len(ocf_data))):
-                        rev_date, rev_value = list(revenue_data.items())[i]
-                        ocf_date, ocf_value = list(ocf_data.items())[i]
+                    if financials.years[i] == cashflow.years[i] and pd.notna(rev_value) and pd.notna(ocf_value):
+                        ocf_ratio = (ocf_value / rev_value) * 100 if rev_value != 0 else 0
                         
-                        if rev_date.year == ocf_date.year and pd.notna(rev_value) and pd.notna(ocf_value):
-                            ocf_ratio = (ocf_value / rev_value) * 100 if rev_value != 0 else 0
-                            
-                            revenue_cashflow_data['annual_data'].append({
-                                'year': rev_date.year,
-                                'total_revenue': abs(rev_value),
-                                'operating_cash_flow': ocf_value,
-                                'ocf_ratio': ocf_ratio
-                            })
+                        revenue_cashflow_data['annual_data'].append({
+                            'year': financials.years[i],
+                            'total_revenue': abs(rev_value),
+                            'operating_cash_flow': ocf_value,
+                            'ocf_ratio': ocf_ratio
+                        })
             
             return revenue_cashflow_data
             
         except Exception as e:
             return {'annual_data': []}
 
+def compute_packed_analysis(ticker, sections, packed, errors):
+    """プロセスプールで実行する抽出・計算（保存はしない）。返り値: (セクション名, 項目の辞書) のリスト"""
+    analyzer = StockAnalyzer()
+    planned, _ = analyzer.plan_sections(sections)
+    return list(analyzer._iter_sections(ticker, planned, PackedStatements(ticker, packed, errors), save=False))
+
 def demo():
     """デモ実行関数"""
     analyzer = StockAnalyzer()
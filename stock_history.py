@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""銘柄ごとの分析値の履歴（追記のみ）
+
+保存・インポートのたびに、株価に連動する値（株価・時価総額・利回り）を
+(ticker, as_of) をキーとした stock_history テーブルへ追記する。stocks・annual_data は
+上書きされるが、履歴は削除・更新しない（銘柄を削除しても残る）。
+
+小さく保つため、直前の履歴と値がすべて同じなら追記しない（値が変わった時点だけを持つ）。
+このため、ある時点の値は「その時点以前で最新の履歴」の値になる。
+SQLiteではキー順に格納する（WITHOUT ROWID）ので、銘柄・期間を指定した読み取りは
+主キーの範囲を順に読むだけで求まる。
+"""
+import os
+from datetime import datetime, timedelta
+
+# 銘柄の値
+HISTORY_STOCK_METRICS = ('current_price', 'market_cap', 'market_cap_usd', 'current_dividend_yield')
+# 最新年度（fiscal_year）の年次データの値
+HISTORY_ANNUAL_METRICS = (
+    'dividend_yield', 'buyback_yield', 'capex_yield', 'total_return_without_capex', 'total_return_with_capex'
+)
+HISTORY_METRICS = ('fiscal_year',) + HISTORY_STOCK_METRICS + HISTORY_ANNUAL_METRICS
+
+# 1回の読み取りで返す履歴の件数の上限
+HISTORY_MAX_POINTS = int(os.environ.get('HISTORY_MAX_POINTS', '5000'))
+
+_COLUMNS_SQL = ', '.join(HISTORY_METRICS)
+
+
+def snapshot_values(stock_values, annual_rows):
+    """銘柄の値と年次データの行から、履歴に記録する値を作る"""
+    values = {name: stock_values.get(name) for name in HISTORY_STOCK_METRICS}
+    rows = [row for row in annual_rows if row.get('year') is not None]
+    latest = max(rows, key=lambda row: row['year']) if rows else {}
+    values['fiscal_year'] = latest.get('year')
+    values.update({name: latest.get(name) for name in HISTORY_ANNUAL_METRICS})
+    return values
+
+
+def unchanged(previous, values):
+    """直前の履歴の行（HISTORY_METRICSの順）と値がすべて同じか"""
+    return previous is not None and tuple(previous) == tuple(values[name] for name in HISTORY_METRICS)
+
+
+def insert_sql():
+    """履歴を1行追記する（同じ銘柄・時点の行が既にあれば何もしない）"""
+    placeholders = ', '.join(f':{name}' for name in HISTORY_METRICS)
+    return f'''
+        INSERT INTO stock_history (ticker, as_of, {_COLUMNS_SQL})
+        VALUES (:ticker, :as_of, {placeholders})
+        ON CONFLICT (ticker, as_of) DO NOTHING
+    '''
+
+
+def previous_sql():
+    """as_of 時点以前で最新の履歴（パラメータは :ticker, :as_of）"""
+    return f'''
+        SELECT {_COLUMNS_SQL} FROM stock_history
+        WHERE ticker = :ticker AND as_of <= :as_of
+        ORDER BY as_of DESC LIMIT 1
+    '''
+
+
+def insert_params(ticker, as_of, values):
+    """insert_sql のパラメータ"""
+    return {'ticker': ticker, 'as_of': as_of, **values}
+
+
+def parse_time(value, end=False):
+    """クエリパラメータの日時（ISO形式）をdatetimeにする（日付だけのendは翌日0時、不正ならValueError）"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'日時はISO形式（例: 2024-01-31）で指定してください: {value}')
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def parse_metrics(value):
+    """返す値の指定（カンマ区切り、省略時は全て）"""
+    if not value:
+        return HISTORY_METRICS
+    names = tuple(name.strip() for name in value.split(',') if name.strip())
+    unknown = [name for name in names if name not in HISTORY_METRICS]
+    if unknown:
+        raise ValueError(f"履歴にない値です: {', '.join(unknown)}（{', '.join(HISTORY_METRICS)}）")
+    return names
+
+
+def range_sql(start, end):
+    """期間内の履歴を新しい順に :limit 件返す（パラメータは :ticker, :limit と、指定があれば :start, :end）
+
+    件数が上限を超える期間では、推移の表示に必要な新しい側を残す。
+    """
+    conditions = ['ticker = :ticker']
+    if start is not None:
+        conditions.append('as_of >= :start')
+    if end is not None:
+        conditions.append('as_of < :end')
+    return f'''
+        SELECT as_of, {_COLUMNS_SQL} FROM stock_history
+        WHERE {' AND '.join(conditions)}
+        ORDER BY as_of DESC LIMIT :limit
+    '''
+
+
+def before_sql():
+    """期間の開始より前で最新の履歴（期間の開始時点の値。パラメータは :ticker, :start）"""
+    return f'''
+        SELECT as_of, {_COLUMNS_SQL} FROM stock_history
+        WHERE ticker = :ticker AND as_of < :start
+        ORDER BY as_of DESC LIMIT 1
+    '''
+
+
+def _point(row, names):
+    as_of = row[0]
+    point = {'as_of': as_of.isoformat() if hasattr(as_of, 'isoformat') else as_of}
+    values = dict(zip(HISTORY_METRICS, row[1:]))
+    point.update((name, values[name]) for name in names)
+    return point
+
+
+def history_result(ticker, names, start, end, before_row, rows, limit):
+    """range_sql（limit + 1 件まで読んだ新しい順の行）・before_sql の結果を古い順の応答の形にする
+
+    limit 件を超えていれば古い側を省き、truncated を True にする（省いた分は to を
+    points の最初の as_of にして読み直せる）。
+    """
+    truncated = len(rows) > limit
+    rows = rows[:limit][::-1]
+    return {
+        'ticker': ticker,
+        'from': start.isoformat() if start else None,
+        'to': end.isoformat() if end else None,
+        'metrics': list(names),
+        # 期間の開始時点で有効な値（期間内に変化がなくても推移を描けるように）
+        'previous': _point(before_row, names) if before_row else None,
+        'points': [_point(row, names) for row in rows],
+        'truncated': truncated
+    }
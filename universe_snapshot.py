@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""保存済み全銘柄の最新年度指標をメモリマップしたスナップショット
+
+データベースから各銘柄の最新年度の指標を集めてNumPy配列（.npy）として書き出し、
+各ワーカーは np.load(mmap_mode='r') で読み込む。同じファイルをページキャッシュ上で共有するため、
+gunicornのワーカー数が増えてもメモリは1つ分で済み、スクリーニングやランキングはDBに触れずに配列演算で答えられる。
+
+ディレクトリ構成:
+    <UNIVERSE_SNAPSHOT_DIR>/CURRENT          現在のスナップショット名（os.replaceでアトミックに切り替え）
+    <UNIVERSE_SNAPSHOT_DIR>/v<版>-<時刻>/    tickers.npy, company_names.npy, countries.npy,
+                                             years.npy, values.npy, sorted_values.npy,
+                                             country_sorted_values.npy, country_valid_counts.npy,
+                                             manifest.json
+
+パーセンタイル順位と分位点は、作成時に指標ごと（全体・国別）に並べ替えた配列から
+二分探索と添字計算で求めるため、リクエスト時に並べ替えは発生しない。
+"""
+import os
+import json
+import time
+import fcntl
+import shutil
+import threading
+from datetime import datetime
+
+import numpy as np
+
+SNAPSHOT_DIR = os.environ.get('UNIVERSE_SNAPSHOT_DIR', 'universe_snapshot')
+
+# データバージョンの確認間隔（秒）
+REFRESH_INTERVAL = float(os.environ.get('UNIVERSE_REFRESH_INTERVAL', '10'))
+
+# CURRENTファイルの確認間隔（秒）
+RELOAD_CHECK_INTERVAL = 1.0
+
+# 残しておく旧スナップショットの数（読み込み中のワーカーのため）
+KEEP_SNAPSHOTS = 3
+
+# 銘柄単位の指標
+STOCK_METRICS = ['current_price', 'market_cap', 'current_dividend_yield', 'market_cap_usd']
+
+# 最新年度の年次指標
+ANNUAL_METRICS = [
+    'dividend_amount', 'dividend_yield', 'buyback_amount', 'buyback_yield',
+    'capex_amount', 'capex_yield', 'total_return_without_capex', 'total_return_with_capex',
+    'total_revenue', 'operating_cash_flow', 'ocf_ratio', 'roi',
+    'dividend_amount_usd', 'buyback_amount_usd', 'capex_amount_usd', 'total_revenue_usd'
+]
+
+METRICS = STOCK_METRICS + ANNUAL_METRICS
+
+# 分布として返す分位点
+QUANTILE_LEVELS = (0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95)
+
+_ARRAY_FILES = (
+    'tickers', 'company_names', 'countries', 'years', 'values',
+    'sorted_values', 'country_sorted_values', 'country_valid_counts'
+)
+
+
+class SnapshotView:
+    """読み込み済みスナップショット（配列はメモリマップ）"""
+
+    def __init__(self, path, manifest, arrays):
+        self.path = path
+        self.version = manifest['data_version']
+        self.built_at = manifest['built_at']
+        self.metrics = manifest['metrics']
+        self.metric_index = {name: i for i, name in enumerate(self.metrics)}
+        self.tickers = arrays['tickers']            # 昇順に並んだティッカー
+        self.company_names = arrays['company_names']
+        self.countries = arrays['countries']
+        self.years = arrays['years']
+        self.values = arrays['values']              # (銘柄数 × 指標数)
+        # 指標ごとに昇順に並べた値（NaNは末尾）
+        self.sorted_values = arrays['sorted_values']                # (指標数 × 銘柄数)
+        self.valid_counts = manifest['valid_counts']
+        # 指標ごとに（国, 値）の順に並べた値。国の範囲は country_offsets で示す
+        self.country_sorted_values = arrays['country_sorted_values']  # (指標数 × 銘柄数)
+        self.country_valid_counts = arrays['country_valid_counts']    # (指標数 × 国数)
+        self.country_index = {name: i for i, name in enumerate(manifest['countries'])}
+        self.country_offsets = manifest['country_offsets']
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def lookup(self, ticker):
+        """ティッカーの行番号を二分探索で取得（なければNone）"""
+        i = int(np.searchsorted(self.tickers, ticker))
+        if i < len(self.tickers) and self.tickers[i] == ticker:
+            return i
+        return None
+
+    def column(self, metric):
+        """指標の列を取得"""
+        if metric not in self.metric_index:
+            raise ValueError(f"未対応の指標です: {metric}（指定可能: {', '.join(self.metrics)}）")
+        return self.values[:, self.metric_index[metric]]
+
+    def sorted_column(self, metric, country=None):
+        """指標の有効値を昇順で取得（country指定時はその国のみ。該当なしは空配列）"""
+        j = self.metric_index.get(metric)
+        if j is None:
+            raise ValueError(f"未対応の指標です: {metric}（指定可能: {', '.join(self.metrics)}）")
+        if country is None:
+            return self.sorted_values[j, :self.valid_counts[j]]
+        c = self.country_index.get(country)
+        if c is None:
+            return self.sorted_values[j, :0]
+        start = self.country_offsets[c]
+        return self.country_sorted_values[j, start:start + int(self.country_valid_counts[j, c])]
+
+    def country_mask(self, country):
+        """国で絞り込むマスク"""
+        return self.countries == country
+
+    def row(self, i):
+        """1銘柄分の指標を辞書で取得"""
+        item = {
+            'ticker': str(self.tickers[i]),
+            'company_name': str(self.company_names[i]),
+            'country': str(self.countries[i]) or None,
+            'year': int(self.years[i]) if self.years[i] > 0 else None
+        }
+        for name, value in zip(self.metrics, self.values[i]):
+            item[name] = None if np.isnan(value) else float(value)
+        return item
+
+    def info(self):
+        return {
+            'data_version': self.version,
+            'built_at': self.built_at,
+            'stock_count': len(self)
+        }
+
+
+def _collect_latest_rows(db):
+    """全銘柄について最新年度の年次データと銘柄情報を1行にまとめる"""
+    rows = []
+    for stock_rows, annual_rows in db.iter_export_batches():
+        latest = {}
+        for annual in annual_rows:
+            ticker = annual['ticker']
+            if ticker not in latest or (annual['year'] or 0) > (latest[ticker]['year'] or 0):
+                latest[ticker] = annual
+        for stock in stock_rows:
+            rows.append((stock, latest.get(stock['ticker'])))
+    return rows
+
+
+def _to_float(value):
+    return np.nan if value is None else float(value)
+
+
+def build_snapshot(db, directory=SNAPSHOT_DIR):
+    """スナップショットを作成してCURRENTをアトミックに切り替える"""
+    os.makedirs(directory, exist_ok=True)
+
+    # 集計中の書き込みを取りこぼさないよう、版は読み出し前に取得する
+    data_version = db.get_data_version()
+    rows = _collect_latest_rows(db)
+    rows.sort(key=lambda item: item[0]['ticker'])
+
+    values = np.full((len(rows), len(METRICS)), np.nan, dtype=np.float64)
+    years = np.zeros(len(rows), dtype=np.int32)
+    for i, (stock, annual) in enumerate(rows):
+        for j, name in enumerate(STOCK_METRICS):
+            values[i, j] = _to_float(stock.get(name))
+        if annual:
+            years[i] = annual['year'] or 0
+            for j, name in enumerate(ANNUAL_METRICS, start=len(STOCK_METRICS)):
+                values[i, j] = _to_float(annual.get(name))
+
+    countries = np.array([stock['country'] or '' for stock, _ in rows], dtype=str)
+    country_names, country_codes = np.unique(countries, return_inverse=True)
+    country_sizes = np.bincount(country_codes, minlength=len(country_names))
+    valid = ~np.isnan(values)
+
+    # 国ごとの範囲は指標によらず同じで、範囲内の有効値の数だけが指標ごとに異なる
+    country_sorted = np.empty((len(METRICS), len(rows)), dtype=np.float64)
+    for j in range(len(METRICS)):
+        order = np.lexsort((values[:, j], country_codes))
+        country_sorted[j] = values[order, j]
+    country_valid_counts = np.zeros((len(METRICS), len(country_names)), dtype=np.int64)
+    for j in range(len(METRICS)):
+        country_valid_counts[j] = np.bincount(country_codes[valid[:, j]], minlength=len(country_names))
+
+    arrays = {
+        'tickers': np.array([stock['ticker'] for stock, _ in rows], dtype=str),
+        'company_names': np.array([stock['company_name'] or '' for stock, _ in rows], dtype=str),
+        'countries': countries,
+        'years': years,
+        'values': values,
+        'sorted_values': np.sort(values.T, axis=1),
+        'country_sorted_values': country_sorted,
+        'country_valid_counts': country_valid_counts
+    }
+    manifest = {
+        'data_version': data_version,
+        'built_at': datetime.now().isoformat(),
+        'stock_count': len(rows),
+        'metrics': METRICS,
+        'valid_counts': valid.sum(axis=0).tolist(),
+        'countries': country_names.tolist(),
+        'country_offsets': np.concatenate(([0], np.cumsum(country_sizes)[:-1])).astype(int).tolist()
+            if len(country_names) else []
+    }
+
+    name = f"v{data_version}-{time.time_ns()}"
+    build_dir = os.path.join(directory, f".build-{name}")
+    os.makedirs(build_dir)
+    for key, array in arrays.items():
+        np.save(os.path.join(build_dir, f'{key}.npy'), array)
+    with open(os.path.join(build_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+    os.rename(build_dir, os.path.join(directory, name))
+
+    # CURRENTを差し替えて公開
+    tmp_pointer = os.path.join(directory, f'.CURRENT-{os.getpid()}')
+    with open(tmp_pointer, 'w') as f:
+        f.write(name)
+    os.replace(tmp_pointer, os.path.join(directory, 'CURRENT'))
+
+    _cleanup_old_snapshots(directory, keep=name)
+    return manifest
+
+
+def _cleanup_old_snapshots(directory, keep):
+    """古いスナップショットを削除（メモリマップ中のファイルは削除後も読める）"""
+    snapshots = sorted(
+        (entry for entry in os.listdir(directory) if entry.startswith('v') and entry != keep),
+        key=lambda entry: int(entry.rsplit('-', 1)[1])
+    )
+    for entry in snapshots[:max(0, len(snapshots) - (KEEP_SNAPSHOTS - 1))]:
+        shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+
+def load_snapshot(directory=SNAPSHOT_DIR):
+    """CURRENTが指すスナップショットをメモリマップで読み込む（なければNone）"""
+    try:
+        with open(os.path.join(directory, 'CURRENT')) as f:
+            name = f.read().strip()
+        path = os.path.join(directory, name)
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        arrays = {key: np.load(os.path.join(path, f'{key}.npy'), mmap_mode='r') for key in _ARRAY_FILES}
+    except (OSError, ValueError):
+        return None
+    return SnapshotView(path, manifest, arrays)
+
+
+class SnapshotManager:
+    """スナップショットの読み込み・切り替えとバックグラウンド再生成を管理"""
+
+    def __init__(self, directory=SNAPSHOT_DIR, db_factory=None):
+        self.directory = directory
+        self.db_factory = db_factory
+        self._view = None
+        self._pointer = None
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def current(self):
+        """現在のスナップショットを取得（CURRENTの変更は一定間隔で確認）"""
+        now = time.monotonic()
+        if now - self._last_check >= RELOAD_CHECK_INTERVAL:
+            self._last_check = now
+            pointer = self._read_pointer()
+            if pointer != self._pointer:
+                with self._lock:
+                    view = load_snapshot(self.directory)
+                    if view is not None:
+                        self._view = view
+                        self._pointer = pointer
+        return self._view
+
+    def _read_pointer(self):
+        try:
+            with open(os.path.join(self.directory, 'CURRENT')) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def start(self):
+        """バックグラウンド再生成スレッドを起動（起動済みなら何もしない）"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='universe-snapshot', daemon=True)
+                self._thread.start()
+
+    def notify_write(self):
+        """データ更新を通知して再生成を促す"""
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh_if_stale()
+            except Exception as e:
+                print(f"⚠️ スナップショット再生成エラー: {e}")
+            self._wake.wait(REFRESH_INTERVAL)
+            self._wake.clear()
+
+    def refresh_if_stale(self):
+        """データバージョンが進んでいれば再生成（複数ワーカー間はファイルロックで1つに絞る）"""
+        db = self.db_factory()
+        view = self.current()
+        if view is not None and view.version == db.get_data_version():
+            return False
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # ロック待ちの間に他のワーカーが作成済みなら何もしない
+                view = load_snapshot(self.directory)
+                if view is not None and view.version == db.get_data_version():
+                    self._last_check = 0.0
+                    return False
+                build_snapshot(db, self.directory)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self._last_check = 0.0
+        return True
+
+
+def screen(view, metric, min_value=None, max_value=None, country=None, order='desc', limit=50):
+    """指標の範囲・国で絞り込み、指標順に並べて返す"""
+    column = view.column(metric)
+    mask = ~np.isnan(column)
+    if min_value is not None:
+        mask &= column >= min_value
+    if max_value is not None:
+        mask &= column <= max_value
+    if country:
+        mask &= view.country_mask(country)
+
+    candidates = np.flatnonzero(mask)
+    selected = column[candidates]
+    keys = -selected if order == 'desc' else selected
+
+    # 上位limit件だけを部分ソート
+    if limit is not None and len(candidates) > limit:
+        top = np.argpartition(keys, limit - 1)[:limit]
+        ordered = top[np.argsort(keys[top], kind='stable')]
+    else:
+        ordered = np.argsort(keys, kind='stable')
+
+    return {
+        'total_matches': int(len(candidates)),
+        'results': [view.row(int(candidates[i])) for i in ordered]
+    }
+
+
+def rank_of(view, metric, ticker, country=None):
+    """銘柄の指標値と、全体（country指定時はその国内）での順位（降順）を返す"""
+    i = view.lookup(ticker)
+    if i is None:
+        return None
+
+    column = view.column(metric)
+    if country:
+        column = column[view.country_mask(country)]
+    column = column[~np.isnan(column)]
+
+    value = view.column(metric)[i]
+    if np.isnan(value):
+        return {'ticker': ticker, 'metric': metric, 'value': None, 'rank': None, 'total': int(len(column))}
+    return {
+        'ticker': ticker,
+        'metric': metric,
+        'value': float(value),
+        'rank': int(np.count_nonzero(column > value)) + 1,
+        'total': int(len(column))
+    }
+
+
+def summarize(view, metric, country=None):
+    """指標の件数・平均・最小・最大を返す"""
+    column = view.column(metric)
+    if country:
+        column = column[view.country_mask(country)]
+    column = column[~np.isnan(column)]
+    if len(column) == 0:
+        return {'metric': metric, 'count': 0, 'mean': None, 'min': None, 'max': None}
+    return {
+        'metric': metric,
+        'count': int(len(column)),
+        'mean': float(column.mean()),
+        'min': float(column.min()),
+        'max': float(column.max())
+    }
+
+
+def percentile_rank(sorted_values, value):
+    """昇順配列の中での値のパーセンタイル順位（0〜100、同値は中間順位）"""
+    if value is None or np.isnan(value) or len(sorted_values) == 0:
+        return None
+    below = int(np.searchsorted(sorted_values, value, side='left'))
+    at_or_below = int(np.searchsorted(sorted_values, value, side='right'))
+    return (below + (at_or_below - below) / 2) / len(sorted_values) * 100
+
+
+def quantiles(sorted_values, levels=QUANTILE_LEVELS):
+    """昇順配列から分位点を線形補間で求める（np.quantileと同じ定義、並べ替えなし）"""
+    count = len(sorted_values)
+    if count == 0:
+        return None
+    result = {}
+    for level in levels:
+        position = level * (count - 1)
+        lower = int(np.floor(position))
+        upper = min(lower + 1, count - 1)
+        value = sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+        result[f'p{int(round(level * 100))}'] = float(value)
+    return result
+
+
+def latest_metric_values(stock_data):
+    """get_stock_analysis形式のデータから、スナップショットと同じ指標の最新値を取り出す"""
+    annual = max(stock_data.get('annual_data') or [], key=lambda row: row.get('year') or 0, default={})
+    values = {name: stock_data.get(name) for name in STOCK_METRICS}
+    values.update({name: annual.get(name) for name in ANNUAL_METRICS})
+    return values
+
+
+def percentile_report(view, stock_data):
+    """銘柄の各指標について、全体・国内でのパーセンタイル順位と分布を返す"""
+    country = stock_data.get('country') or ''
+    metrics = {}
+    for name, value in latest_metric_values(stock_data).items():
+        value = None if value is None else float(value)
+        overall = view.sorted_column(name)
+        domestic = view.sorted_column(name, country)
+        metrics[name] = {
+            'value': value,
+            'percentile': percentile_rank(overall, value),
+            'country_percentile': percentile_rank(domestic, value),
+            'universe_quantiles': quantiles(overall),
+            'country_quantiles': quantiles(domestic)
+        }
+    return {
+        'country': country or None,
+        'snapshot': view.info(),
+        'metrics': metrics
+    }
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    """プロセス内で共有するSnapshotManagerを取得"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            from db_backend import get_database
+            _manager = SnapshotManager(SNAPSHOT_DIR, db_factory=get_database)
+            _manager.start()
+        return _manager
@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""WSGIサーバー（gunicornなど）用のエントリーポイント
+
+app モジュールはインポートしただけではウォームアップを始めないため、サーバーではこちらを読み込む。
+
+起動:
+    gunicorn wsgi:app --bind 0.0.0.0:8080
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from app import app, start_warm_up  # noqa: E402
+
+start_warm_up()